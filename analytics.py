@@ -0,0 +1,232 @@
+"""
+Агрегация метрик отправок: open rate / click rate в разрезах.
+
+MetricsResult — общий формат результата и для SQL-агрегации
+(db.get_campaign_metrics), и для расчёта по DataFrame в памяти
+(compute_metrics). В каждой таблице колонки sent / opened / clicked (int64)
+и open_rate / click_rate (float64).
+
+compute_metrics() один раз превращает статус в int8-флаги sent / opened / clicked,
+кодирует разрезы целыми кодами и считает все разрезы за один проход
+по строкам: bincount по комбинированному ключу, затем суммирование
+маленького куба по осям. Python-лямбд на группу нет.
+
+merge_metrics() складывает результаты по частям отправок — так считает
+параллельный режим (parallel_analytics.py).
+"""
+
+from collections.abc import Iterable
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+
+OPENED_STATUSES = ("OPENED", "CLICKED")
+CLICKED_STATUSES = ("CLICKED",)
+# Запланированные, но ещё не отправленные письма в sent не входят
+PENDING_STATUSES = ("PLANNED",)
+
+COUNT_COLUMNS = ["sent", "opened", "clicked"]
+# Колонки отправок, которых достаточно для compute_metrics() по всем разрезам
+METRICS_COLUMNS = ("campaign_id", "campaign_name", "sent_at", "send_status", "gender", "segment")
+
+# Разрез -> ключевые колонки (первая колонка определяет группу)
+DIMENSIONS = {
+    "campaign": ["campaign_id", "campaign_name"],
+    "daily": ["sent_date"],
+    "gender": ["gender"],
+    "segment": ["segment"],
+}
+
+# Больше ячеек куба — считаем разрезы по отдельности, чтобы не раздувать память
+MAX_CUBE_CELLS = 20_000_000
+
+
+@dataclass(frozen=True)
+class MetricsResult:
+    """
+    Метрики по выбранным отправкам.
+
+    total    — одна строка sent / opened / clicked / open_rate / click_rate;
+    campaign — по кампаниям (campaign_id, campaign_name), по убыванию sent;
+    daily    — по дням отправки (sent_date);
+    gender   — по полу клиентов (без пустых значений);
+    segment  — по сегментам клиентов (без пустых значений).
+    """
+
+    total: pd.DataFrame
+    campaign: pd.DataFrame
+    daily: pd.DataFrame
+    gender: pd.DataFrame
+    segment: pd.DataFrame
+
+
+def with_rates(df: pd.DataFrame) -> pd.DataFrame:
+    """Привести счётчики к int64 и добавить open_rate / click_rate."""
+    df[COUNT_COLUMNS] = df[COUNT_COLUMNS].astype("int64")
+    sent = df["sent"].where(df["sent"] > 0)
+    df["open_rate"] = (df["opened"] / sent).fillna(0.0).astype("float64")
+    df["click_rate"] = (df["clicked"] / sent).fillna(0.0).astype("float64")
+    return df
+
+
+def empty_table(keys: list[str]) -> pd.DataFrame:
+    return with_rates(pd.DataFrame(columns=keys + COUNT_COLUMNS))
+
+
+def sort_table(dim: str, df: pd.DataFrame) -> pd.DataFrame:
+    """Порядок строк, в котором таблицы показываются на странице."""
+    if dim == "campaign":
+        return df.sort_values("sent", ascending=False, ignore_index=True, kind="stable")
+    return df.sort_values(DIMENSIONS[dim][0], ignore_index=True)
+
+
+def _status_flags(status: pd.Series) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    int8-флаги sent / opened / clicked.
+
+    Статус кодируется целыми кодами (для категорий — готовые коды), а UPPER
+    и сравнение выполняются только над уникальными значениями.
+    """
+    if isinstance(status.dtype, pd.CategoricalDtype):
+        codes, uniques = status.cat.codes.to_numpy(), status.cat.categories
+    else:
+        codes, uniques = pd.factorize(status)
+
+    normalized = pd.Index(uniques).astype(str).str.upper()
+    # код -1 (NaN) указывает на последний элемент таблицы
+    sent_lut = np.append(~normalized.isin(PENDING_STATUSES), True).astype(np.int8)
+    opened_lut = np.append(normalized.isin(OPENED_STATUSES), False).astype(np.int8)
+    clicked_lut = np.append(normalized.isin(CLICKED_STATUSES), False).astype(np.int8)
+    return sent_lut[codes], opened_lut[codes], clicked_lut[codes]
+
+
+def _dimension_keys(df: pd.DataFrame, dim: str) -> tuple[np.ndarray, pd.DataFrame]:
+    """Коды группы (-1 для пропусков) и таблица значений ключевых колонок по кодам."""
+    keys = [k for k in DIMENSIONS[dim] if k in df.columns]
+
+    if dim == "daily" and "sent_date" not in df.columns:
+        # Номер дня прямо из datetime64 — без хеширования и объектов date
+        days = pd.to_datetime(df["sent_at"]).to_numpy().astype("M8[D]").view(np.int64)
+        valid = days != np.iinfo(np.int64).min
+        if not valid.any():
+            return np.full(len(df), -1), pd.DataFrame({"sent_date": []})
+        first_day = days[valid].min()
+        codes = np.where(valid, days - first_day, -1)
+        span = int(codes.max()) + 1
+        labels = pd.DataFrame({
+            "sent_date": (np.arange(span) + first_day).astype("M8[D]").astype(object),
+        })
+        return codes, labels
+
+    codes, uniques = pd.factorize(df[keys[0]])
+    labels = pd.DataFrame({keys[0]: uniques})
+    if len(keys) > 1:
+        # остальные колонки ключа берём из первой строки каждой группы
+        valid = codes >= 0
+        first_rows = pd.Series(np.flatnonzero(valid)).groupby(codes[valid]).first()
+        for key in keys[1:]:
+            labels[key] = df[key].to_numpy()[first_rows.to_numpy()]
+    return codes, labels
+
+
+def _finish(dim: str, labels: pd.DataFrame, counts: np.ndarray) -> pd.DataFrame:
+    """Собрать таблицу разреза из меток и счётчиков [sent, opened, clicked] по кодам."""
+    table = labels.copy()
+    for i, column in enumerate(COUNT_COLUMNS):
+        table[column] = counts[i]
+    table = table[table["sent"] > 0].reset_index(drop=True)
+    return sort_table(dim, with_rates(table))
+
+
+def compute_metrics(
+    df: pd.DataFrame,
+    dims: tuple[str, ...] = tuple(DIMENSIONS),
+) -> MetricsResult:
+    """
+    Посчитать метрики по DataFrame отправок за один векторный проход.
+
+    Ожидаемые колонки: send_status (или status), campaign_id / campaign_name,
+    sent_date или sent_at, gender, segment. Неподходящие разрезы
+    (нет колонок или не запрошены в dims) возвращаются пустыми таблицами.
+    """
+    status = df["send_status"] if "send_status" in df.columns else df["status"]
+    sent, opened, clicked = _status_flags(status)
+
+    total = with_rates(pd.DataFrame({
+        "sent": [int(sent.sum(dtype=np.int64))],
+        "opened": [int(opened.sum(dtype=np.int64))],
+        "clicked": [int(clicked.sum(dtype=np.int64))],
+    }))
+
+    tables = {dim: empty_table(DIMENSIONS[dim]) for dim in DIMENSIONS}
+    active = [
+        dim for dim in dims
+        if any(k in df.columns for k in DIMENSIONS[dim])
+        or (dim == "daily" and "sent_at" in df.columns)
+    ]
+    if not active or df.empty:
+        return MetricsResult(total=total, **tables)
+
+    encoded = {dim: _dimension_keys(df, dim) for dim in active}
+    # +1: нулевая ячейка оси — пропуск (NaN), она отбрасывается при выдаче
+    sizes = [len(encoded[dim][1]) + 1 for dim in active]
+
+    if int(np.prod(sizes, dtype=np.float64)) <= MAX_CUBE_CELLS:
+        # Один проход: комбинированный ключ всех разрезов -> куб счётчиков
+        key = np.zeros(len(df), dtype=np.int64)
+        for dim, size in zip(active, sizes):
+            key = key * size + (encoded[dim][0] + 1)
+        cells = int(np.prod(sizes))
+        cube = np.stack([
+            np.bincount(key, weights=sent, minlength=cells),
+            np.bincount(key, weights=opened, minlength=cells),
+            np.bincount(key, weights=clicked, minlength=cells),
+        ]).reshape([3] + sizes)
+
+        for axis, dim in enumerate(active, start=1):
+            other_axes = tuple(a for a in range(1, len(sizes) + 1) if a != axis)
+            counts = cube.sum(axis=other_axes)[:, 1:]
+            tables[dim] = _finish(dim, encoded[dim][1], counts)
+    else:
+        for dim in active:
+            codes, labels = encoded[dim]
+            valid = codes >= 0
+            n = len(labels)
+            counts = np.stack([
+                np.bincount(codes[valid], weights=sent[valid], minlength=n),
+                np.bincount(codes[valid], weights=opened[valid], minlength=n),
+                np.bincount(codes[valid], weights=clicked[valid], minlength=n),
+            ])
+            tables[dim] = _finish(dim, labels, counts)
+
+    return MetricsResult(total=total, **tables)
+
+
+def merge_metrics(results: Iterable[MetricsResult]) -> MetricsResult:
+    """
+    Сложить результаты compute_metrics() по непересекающимся частям отправок.
+
+    Счётчики складываются по ключам разрезов, доли считаются заново
+    по суммам — результат точно совпадает с расчётом по всем строкам сразу
+    (с точностью до порядка кампаний с равным sent).
+    """
+    results = list(results)
+    totals = [r.total[COUNT_COLUMNS] for r in results]
+    total = pd.concat(totals).sum().to_frame().T if totals else pd.DataFrame([[0, 0, 0]], columns=COUNT_COLUMNS)
+
+    tables = {}
+    for dim, keys in DIMENSIONS.items():
+        parts = [getattr(r, dim) for r in results if not getattr(r, dim).empty]
+        if not parts:
+            tables[dim] = empty_table(keys)
+            continue
+        merged = (
+            pd.concat(parts, ignore_index=True)
+            .groupby(keys, sort=False, observed=True, as_index=False)[COUNT_COLUMNS]
+            .sum()
+        )
+        tables[dim] = sort_table(dim, with_rates(merged))
+
+    return MetricsResult(total=with_rates(total.reset_index(drop=True)), **tables)
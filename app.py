@@ -1,21 +1,112 @@
-import streamlit as st
+import os
+from dataclasses import asdict
+from datetime import datetime, time as dt_time, timezone
+
 import pandas as pd
+import streamlit as st
 
+import audience_index
+import cache as db_cache
+import export
+import frequency_cap
+import parallel_analytics
+import perf
+import snapshot
+
+from audience import AudienceSpec
+from personalization import compiled_template
+from sketches import error_bound
 from db import (
-    get_clients,
     get_templates,
     create_campaign,
-    create_campaign_clients,
+    create_campaign_clients_for_audience,
+    schedule_campaign,
+    get_campaign_runs,
+    get_campaign_suppressions,
+    count_audience,
+    preview_audience,
+    get_audience_options,
+    get_campaign_recipients,
     get_campaigns,
-    get_campaign_clients_joined,
-    get_reactivation_candidates,
+    get_campaign_metrics,
+    get_sent_date_bounds,
+    get_sends_page,
+    get_unique_reach,
+    pool_stats,
 )
 
 st.set_page_config(page_title="Email-рассылки", layout="wide")
 
 st.title("Система email-рассылок и аналитики")
 
-page = st.sidebar.radio("Страница", ["Рассылка", "Аналитика"])
+page = st.sidebar.radio("Страница", ["Рассылка", "Аналитика", "Производительность"])
+
+cache_stats = db_cache.stats()
+st.sidebar.caption(
+    f"Кэш БД: попаданий {cache_stats['hits']}, промахов {cache_stats['misses']}, "
+    f"записей {cache_stats['entries']}/{cache_stats['max_entries']}"
+)
+for role, pool in pool_stats().items():
+    st.sidebar.caption(
+        f"Пул БД ({role}): занято {pool['checked_out']} из {pool['size']}"
+        f" (+{pool['overflow']} сверх), ожидание ср. {pool['wait_avg_ms']:.1f} мс,"
+        f" макс. {pool['wait_max_ms']:.1f} мс, выдач сверх пула {pool['overflow_checkouts']},"
+        f" таймаутов {pool['timeouts']}"
+    )
+
+
+def keyset_pager(key: str, filters: tuple, fetch, page_size: int = 100) -> pd.DataFrame:
+    """
+    Страница таблицы с навигацией по ключу (keyset-пагинация).
+
+    fetch(after, limit) -> (страница, ключ следующей страницы или None).
+    В session_state хранится стек ключей просмотренных страниц; при смене
+    filters навигация начинается заново.
+    """
+    state = st.session_state.setdefault(key, {"filters": filters, "cursors": [None]})
+    if state["filters"] != filters:
+        state.update(filters=filters, cursors=[None])
+
+    page_df, next_cursor = fetch(state["cursors"][-1], page_size)
+
+    back_col, first_col, info_col, next_col = st.columns([1, 1, 2, 1])
+    if back_col.button("← Назад", key=f"{key}_back", disabled=len(state["cursors"]) == 1):
+        state["cursors"].pop()
+        st.rerun()
+    if first_col.button("В начало", key=f"{key}_first", disabled=len(state["cursors"]) == 1):
+        state["cursors"] = [None]
+        st.rerun()
+    info_col.caption(f"Страница {len(state['cursors'])}, строк на странице: {len(page_df)}")
+    if next_col.button("Далее →", key=f"{key}_next", disabled=next_cursor is None):
+        state["cursors"].append(next_cursor)
+        st.rerun()
+    return page_df
+
+
+def _recipients_page(campaign_id: int):
+    def fetch(after, limit):
+        df = get_campaign_recipients(campaign_id, limit, after)
+        cursor = None
+        if len(df) == limit:
+            cursor = (df["sent_at"].iloc[-1].to_pydatetime(), int(df["send_id"].iloc[-1]))
+        return df, cursor
+    return fetch
+
+
+def _show_suppressed(campaign_id: int) -> None:
+    """Сообщить, скольких клиентов отсекло ограничение частоты (frequency_cap.py)."""
+    if not frequency_cap.enabled():
+        return
+    suppressed = get_campaign_suppressions(campaign_id)
+    if not suppressed.empty:
+        st.info(
+            f"Не включено клиентов: {len(suppressed)} — у них уже "
+            f"{frequency_cap.FREQUENCY_CAP_SENDS} и больше писем за "
+            f"{frequency_cap.FREQUENCY_CAP_DAYS} дн."
+        )
+        with st.expander("Отсечённые клиенты"):
+            st.dataframe(suppressed, use_container_width=True)
+
 
 if page == "Рассылка":
     st.header("Создание кампании")
@@ -23,13 +114,13 @@ if page == "Рассылка":
 
     # Загружаем данные из БД
     templates_df = get_templates()
-    clients_df = get_clients()
+    audience_options = get_audience_options()
 
     if templates_df.empty:
         st.error("В базе нет ни одного шаблона писем.")
         st.stop()
 
-    if clients_df.empty:
+    if not audience_options["segment"] and not audience_options["gender"]:
         st.error("В базе нет ни одного клиента.")
         st.stop()
 
@@ -55,71 +146,144 @@ if page == "Рассылка":
             templates_df["id"] == selected_template_id, "type"
         ].iloc[0]
 
-        # подготовка списка клиентов
-        client_options = {
-            f"{row['id']}: {row['full_name']} ({row['email']}) [{row['segment']}]": row["id"]
-            for _, row in clients_df.iterrows()
-        }
+        # аудитория задаётся фильтрами, клиенты выбираются в БД
+        st.markdown("**Аудитория**")
+
+        selected_segments = st.multiselect(
+            "Сегменты (пусто — все)",
+            options=audience_options["segment"],
+        )
+        selected_genders = st.multiselect(
+            "Пол (пусто — любой)",
+            options=audience_options["gender"],
+        )
+
+        created_from = created_to = None
+        if st.checkbox("Фильтр по дате регистрации"):
+            created_range = st.date_input("Дата регистрации", value=())
+            if isinstance(created_range, tuple) and len(created_range) == 2:
+                created_from, created_to = created_range
 
         # автоподбор уснувших для WINBACK
-        reactive_default_labels = []
-        reactive_info = ""
-
-        if selected_template_type.upper() == "WINBACK":
-            inactive_days = 30
-            react_df = get_reactivation_candidates(inactive_days)
-
-            if not react_df.empty:
-                react_ids = set(react_df["id"].tolist())
-                reactive_default_labels = [
-                    label for label, cid in client_options.items() if cid in react_ids
-                ]
-                reactive_info = (
-                    f"Найдено {len(react_ids)} клиентов для реактивации "
-                    f"(нет активности {inactive_days}+ дней)."
+        activity_modes = [
+            "Любая активность",
+            "Была активность за последние N дней",
+            "Нет активности N+ дней (реактивация)",
+        ]
+        is_winback = selected_template_type.upper() == "WINBACK"
+
+        activity_mode = st.selectbox(
+            "Активность",
+            options=activity_modes,
+            index=2 if is_winback else 0,
+        )
+        activity_days = None
+        if activity_mode != activity_modes[0]:
+            activity_days = int(
+                st.number_input("N дней", min_value=1, value=30, step=1)
+            )
+
+        audience_spec = AudienceSpec(
+            segments=tuple(selected_segments),
+            genders=tuple(selected_genders),
+            created_from=created_from,
+            created_to=created_to,
+            active_within_days=activity_days if activity_mode == activity_modes[1] else None,
+            inactive_days=activity_days if activity_mode == activity_modes[2] else None,
+        )
+        # число клиентов — по индексу в памяти (AUDIENCE_INDEX=1) или запросом в БД
+        if audience_index.enabled():
+            audience_size = audience_index.count_audience(audience_spec)
+        else:
+            audience_size = count_audience(audience_spec)
+
+        if is_winback and audience_spec.inactive_days is not None:
+            if audience_size:
+                st.info(
+                    f"Найдено {audience_size} клиентов для реактивации "
+                    f"(нет активности {audience_spec.inactive_days}+ дней)."
                 )
             else:
-                reactive_info = (
+                st.info(
                     "Клиентов для реактивации не найдено. "
-                    "Выберите получателей вручную."
+                    "Измените условия аудитории."
                 )
 
-        if reactive_info:
-            st.info(reactive_info)
-
-        selected_client_labels = st.multiselect(
-            "Кому отправляем",
-            options=list(client_options.keys()),
-            default=reactive_default_labels,
-        )
-        selected_client_ids = [client_options[label] for label in selected_client_labels]
+        audience_preview = preview_audience(audience_spec)
+        with st.expander("Примеры клиентов из аудитории"):
+            st.dataframe(audience_preview, use_container_width=True)
 
         # имя кампании
         default_campaign_name = "Новая кампания"
         campaign_name = st.text_input("Название кампании", value=default_campaign_name)
 
-        create_clicked = st.button("Создать кампанию и отправить", use_container_width=True)
+        # реальная отправка по SMTP через планировщик (scheduler.py) вместо симуляции
+        schedule_send = st.checkbox("Запланировать отправку по SMTP")
+        if schedule_send:
+            now_utc = datetime.now(timezone.utc)
+            date_col, time_col = st.columns(2)
+            planned_date = date_col.date_input("Дата отправки (UTC)", value=now_utc.date())
+            planned_time = time_col.time_input(
+                "Время отправки (UTC)", value=dt_time(now_utc.hour, now_utc.minute)
+            )
+
+        create_clicked = st.button(
+            "Создать и запланировать" if schedule_send else "Создать кампанию и отправить",
+            use_container_width=True,
+        )
 
     # ПРАВАЯ КОЛОНКА: СВОДКА
     with right_col:
         st.subheader("Сводка кампании")
         st.markdown(f"**Выбранный шаблон:**  \n{selected_template_label}")
         st.markdown(f"**Тип кампании:**  `{selected_template_type}`")
-        st.markdown(f"**Выбрано клиентов:**  **{len(selected_client_ids)}**")
+        st.markdown(f"**Клиентов в аудитории:**  **{audience_size}**")
 
-        # небольшой превью-шаблон
+        # превью письма: шаблон с подстановками для первых клиентов аудитории
         template_row = templates_df[templates_df["id"] == selected_template_id].iloc[0]
-        with st.expander("Посмотреть тему и текст письма (общий вид)"):
-            st.markdown(f"**Тема:** {template_row['subject']}")
-            st.markdown("**Тело письма:**")
-            st.write(template_row["body_male"])
+        compiled = compiled_template(
+            template_row["id"],
+            template_row.get("version", 1),
+            template_row["subject"],
+            template_row["body_male"],
+            template_row["body_female"],
+        )
+        with st.expander("Посмотреть тему и текст письма"):
+            for gender, label in (("M", "Клиент"), ("F", "Клиентка")):
+                sample = audience_preview[audience_preview["gender"] == gender].head(1)
+                if sample.empty:
+                    recipient = (None, "client@example.com", gender, label, "")
+                else:
+                    client = sample.iloc[0]
+                    recipient = (
+                        client["id"], client["email"], gender,
+                        client["full_name"] or "", client["segment"] or "",
+                    )
+                subject, body = compiled.render(recipient)
+                st.markdown(f"**{label}:** {recipient[1]}")
+                st.markdown(f"**Тема:** {subject}")
+                st.write(body)
 
     # Обработка кнопки
     if create_clicked:
         if not campaign_name.strip():
             st.warning("Введите название кампании.")
-        elif not selected_client_ids:
-            st.warning("Выберите хотя бы одного клиента.")
+        elif not audience_size:
+            st.warning("В выбранной аудитории нет ни одного клиента.")
+        elif schedule_send:
+            campaign_id, planned_count = schedule_campaign(
+                name=campaign_name.strip(),
+                template_id=selected_template_id,
+                spec=audience_spec,
+                planned_at=datetime.combine(planned_date, planned_time),
+                description=f"Запланировано из интерфейса Streamlit, шаблон id={selected_template_id}",
+            )
+            st.success(
+                f"Кампания запланирована (id={campaign_id}) на "
+                f"{planned_date:%d.%m.%Y} {planned_time:%H:%M} UTC. "
+                f"Получателей: {planned_count}. Письма отправит планировщик (scheduler.py)."
+            )
+            _show_suppressed(campaign_id)
         else:
             campaign_id = create_campaign(
                 name=campaign_name.strip(),
@@ -127,57 +291,91 @@ if page == "Рассылка":
                 description=f"Создано из интерфейса Streamlit, шаблон id={selected_template_id}",
             )
 
-            sent_count = create_campaign_clients(campaign_id, selected_client_ids)
+            if audience_index.enabled():
+                sent_count = audience_index.create_campaign_clients_for_audience(
+                    campaign_id, audience_spec
+                )
+            else:
+                sent_count = create_campaign_clients_for_audience(campaign_id, audience_spec)
 
             st.success(
                 f"Кампания успешно создана (id={campaign_id}). "
                 f"Отправлено писем: {sent_count}."
             )
+            _show_suppressed(campaign_id)
+            # список получателей листается страницами и после перезапуска скрипта
+            st.session_state["created_campaign"] = (campaign_id, sent_count)
+
+    if "created_campaign" in st.session_state:
+        campaign_id, sent_count = st.session_state["created_campaign"]
+        st.subheader(f"Список получателей кампании (id={campaign_id}, всего {sent_count})")
+        result_clients = keyset_pager(
+            "recipients_pager", (campaign_id,), _recipients_page(campaign_id)
+        )[["client_id", "full_name", "email", "segment"]].rename(
+            columns={
+                "full_name": "ФИО",
+                "email": "Email",
+                "segment": "Сегмент",
+            }
+        )
+        st.dataframe(result_clients, use_container_width=True)
 
-            result_clients = clients_df[clients_df["id"].isin(selected_client_ids)][
-                ["id", "full_name", "email", "segment"]
-            ].rename(
-                columns={
-                    "id": "client_id",
-                    "full_name": "ФИО",
-                    "email": "Email",
-                    "segment": "Сегмент",
-                }
-            )
-
-            st.subheader("Список получателей кампании")
-            st.dataframe(result_clients, use_container_width=True)
+    with st.expander("Запуски отправки запланированных кампаний"):
+        runs = get_campaign_runs()
+        if runs.empty:
+            st.caption("Запусков ещё не было.")
+        else:
+            st.dataframe(runs, use_container_width=True)
 
 # СТРАНИЦА «АНАЛИТИКА»
 elif page == "Аналитика":
     st.header("Аналитика кампаний")
 
-    df = get_campaign_clients_joined()
-
-    if df.empty:
-        st.info("Данных по отправкам пока нет.")
-        st.stop()
-
-    # Приводим к удобному виду
-    df["sent_at"] = pd.to_datetime(df["sent_at"])
-    df["sent_date"] = df["sent_at"].dt.date
-    df["status_norm"] = df["send_status"].str.upper()
+    campaigns_df = get_campaigns()
 
     # Фильтры (sidebar)
     # Выбор кампаний
-    campaign_names = sorted(df["campaign_name"].unique())
+    with perf.span("app.analytics.campaign_names"):
+        campaign_names = sorted(campaigns_df["name"].dropna().unique())
     selected_campaigns = st.sidebar.multiselect(
         "Выбор кампании",
         options=campaign_names,
         default=campaign_names,  # по умолчанию все
     )
 
-    if selected_campaigns:
-        df = df[df["campaign_name"].isin(selected_campaigns)]
+    # Выбраны все (или ни одной) — без фильтра: запросы идут по индексам
+    # (sent_at, id) без списка id, а ключи кэша не тащат все id кампаний
+    campaign_ids = None
+    if selected_campaigns and set(selected_campaigns) != set(campaign_names):
+        with perf.span("app.analytics.campaign_ids"):
+            campaign_ids = campaigns_df.loc[
+                campaigns_df["name"].isin(selected_campaigns), "id"
+            ].tolist()
+
+    # Источник агрегатов: локальный снимок (если задан SNAPSHOT_DIR) или БД
+    if snapshot.enabled():
+        sync_report = snapshot.sync_if_stale()
+        if sync_report is not None:
+            st.sidebar.caption(
+                f"Снимок обновлён: +{sync_report.new_rows} новых, "
+                f"{sync_report.changed_rows} изменённых строк"
+            )
+        sent_date_bounds = snapshot.get_sent_date_bounds
+        # ANALYTICS_WORKERS > 1 — части снимка считаются в пуле процессов
+        if parallel_analytics.enabled():
+            campaign_metrics = parallel_analytics.get_campaign_metrics
+        else:
+            campaign_metrics = snapshot.get_campaign_metrics
+    else:
+        sent_date_bounds = get_sent_date_bounds
+        campaign_metrics = get_campaign_metrics
 
     # Фильтр по дате отправки
-    min_date = df["sent_date"].min()
-    max_date = df["sent_date"].max()
+    min_date, max_date = sent_date_bounds(campaign_ids)
+
+    if min_date is None:
+        st.info("Данных по отправкам пока нет.")
+        st.stop()
 
     date_range = st.sidebar.date_input(
         "Период отправки",
@@ -189,42 +387,42 @@ elif page == "Аналитика":
     else:
         start_date = end_date = date_range
 
-    if start_date and end_date:
-        df = df[(df["sent_date"] >= start_date) & (df["sent_date"] <= end_date)]
+    # Агрегаты считаются в SQL или по снимку, сюда приходят только итоговые таблицы
+    with perf.span("app.analytics.metrics"):
+        metrics = campaign_metrics(
+            campaign_ids,
+            date_from=start_date or None,
+            date_to=end_date or None,
+        )
+    total = metrics.total.iloc[0]
 
-    if df.empty:
+    if total["sent"] == 0:
         st.warning("По выбранным фильтрам данных нет.")
         st.stop()
 
     # метрики
-    sent_total = len(df)
-    opened_total = df["status_norm"].isin(["OPENED", "CLICKED"]).sum()
-    clicked_total = (df["status_norm"] == "CLICKED").sum()
-
-    open_rate_total = opened_total / sent_total if sent_total > 0 else 0
-    click_rate_total = clicked_total / sent_total if sent_total > 0 else 0
-
     col1, col2, col3 = st.columns(3)
-    col1.metric("Отправлено писем", sent_total)
-    col2.metric("Open rate", f"{open_rate_total:.1%}")
-    col3.metric("Click rate", f"{click_rate_total:.1%}")
+    col1.metric("Отправлено писем", int(total["sent"]))
+    col2.metric("Open rate", f"{total['open_rate']:.1%}")
+    col3.metric("Click rate", f"{total['click_rate']:.1%}")
+
+    # уникальные клиенты — оценка по HLL-скетчам кампаний-дней (всегда из БД)
+    with perf.span("app.analytics.unique_reach"):
+        reach = get_unique_reach(
+            campaign_ids,
+            date_from=start_date or None,
+            date_to=end_date or None,
+        )
+    reach_help = f"Оценка HyperLogLog, погрешность до ±{error_bound():.1%} с вероятностью 95%"
+    col4, col5, _ = st.columns(3)
+    col4.metric("Уникальных получателей (≈)", f"{reach['reach']:,}".replace(",", " "), help=reach_help)
+    col5.metric("Уникальных открывших (≈)", f"{reach['openers']:,}".replace(",", " "), help=reach_help)
 
     st.markdown("---")
 
     # Таблица метрик по кампаниям
-    agg_campaign = (
-        df.groupby("campaign_name")
-          .agg(
-              sent=("cc_id", "size"),
-              opened=("status_norm", lambda s: s.isin(["OPENED", "CLICKED"]).sum()),
-              clicked=("status_norm", lambda s: (s == "CLICKED").sum()),
-          )
-    )
-
-    agg_campaign["open_rate"] = agg_campaign["opened"] / agg_campaign["sent"]
-    agg_campaign["click_rate"] = agg_campaign["clicked"] / agg_campaign["sent"]
-
-    agg_campaign = agg_campaign.reset_index().sort_values("sent", ascending=False)
+    with perf.span("app.analytics.campaign_table"):
+        agg_campaign = metrics.campaign.drop(columns=["campaign_id"])
 
     st.subheader("Метрики по кампаниям")
     st.dataframe(agg_campaign, use_container_width=True)
@@ -237,41 +435,20 @@ elif page == "Аналитика":
 
     #вкладка "Общая статистика"
     with tab_overall:
-        st.subheader("Метрики по кампаниям")
-
-        st.dataframe(agg_campaign, use_container_width=True)
-
         st.subheader("Динамика отправок по дням")
-        daily_agg = (
-            df.groupby("sent_date")
-            .agg(
-                sent=("cc_id", "size"),
-                opened=("status_norm", lambda s: s.isin(["OPENED", "CLICKED"]).sum()),
-                clicked=("status_norm", lambda s: (s == "CLICKED").sum()),
-            )
-            .sort_index()
-        )
+        with perf.span("app.analytics.daily_chart"):
+            daily_agg = metrics.daily.set_index("sent_date")
         st.line_chart(daily_agg[["sent", "opened", "clicked"]])
 
     #вкладка "По полу"
     with tab_gender:
         st.subheader("Разрез по полу (gender)")
-        df_gender = df.dropna(subset=["gender"])
+        with perf.span("app.analytics.gender_table"):
+            agg_gender = metrics.gender.set_index("gender")
 
-        if df_gender.empty:
+        if agg_gender.empty:
             st.info("Нет данных о поле клиентов.")
         else:
-            agg_gender = (
-                df_gender.groupby("gender")
-                .agg(
-                    sent=("cc_id", "size"),
-                    opened=("status_norm", lambda s: s.isin(["OPENED", "CLICKED"]).sum()),
-                    clicked=("status_norm", lambda s: (s == "CLICKED").sum()),
-                )
-            )
-            agg_gender["open_rate"] = agg_gender["opened"] / agg_gender["sent"]
-            agg_gender["click_rate"] = agg_gender["clicked"] / agg_gender["sent"]
-
             st.write("Таблица по полу:")
             st.dataframe(agg_gender.reset_index(), use_container_width=True)
 
@@ -281,26 +458,126 @@ elif page == "Аналитика":
     #вкладка "По сегментам"
     with tab_segment:
         st.subheader("Разрез по сегментам (segment)")
-        df_segment = df.dropna(subset=["segment"])
+        with perf.span("app.analytics.segment_table"):
+            agg_segment = metrics.segment.set_index("segment")
 
-        if df_segment.empty:
+        if agg_segment.empty:
             st.info("Нет данных о сегментах клиентов.")
         else:
-            agg_segment = (
-                df_segment.groupby("segment")
-                .agg(
-                    sent=("cc_id", "size"),
-                    opened=("status_norm", lambda s: s.isin(["OPENED", "CLICKED"]).sum()),
-                    clicked=("status_norm", lambda s: (s == "CLICKED").sum()),
-                )
-            )
-            agg_segment["open_rate"] = agg_segment["opened"] / agg_segment["sent"]
-            agg_segment["click_rate"] = agg_segment["clicked"] / agg_segment["sent"]
-
             st.write("Таблица по сегментам:")
             st.dataframe(agg_segment.reset_index(), use_container_width=True)
 
             st.write("График open_rate / click_rate по сегментам:")
             st.bar_chart(agg_segment[["open_rate", "click_rate"]])
 
+    st.markdown("---")
 
+    # Отдельные отправки: фильтры уходят в SQL, страницы читаются по ключу (sent_at, id)
+    st.subheader("Отправки")
+    with perf.span("app.analytics.sends_page"):
+        sends_page = keyset_pager(
+            "sends_pager",
+            (tuple(campaign_ids or ()), start_date, end_date),
+            lambda after, limit: get_sends_page(
+                campaign_ids, start_date or None, end_date or None, after, limit
+            ),
+        )
+    st.dataframe(sends_page, use_container_width=True)
+
+    # Выгрузка тех же отправок файлом: строки пишутся потоково, без DataFrame в памяти
+    with st.expander("Выгрузить отправки в файл"):
+        st.caption(
+            f"Все отправки выбранных кампаний за период, не больше "
+            f"{export.EXPORT_APP_MAX_ROWS:,} строк: файл для скачивания целиком "
+            f"держится в памяти. Большие выгрузки — из консоли: python export.py.".replace(",", " ")
+        )
+        export_format = st.radio("Формат", export.FORMATS, horizontal=True, format_func=str.upper)
+        if st.button("Выгрузить"):
+            export_bar = st.progress(0.0, text="Подсчёт строк...")
+
+            def _export_progress(rows: int, total: int) -> None:
+                export_bar.progress(
+                    min(rows / total, 1.0) if total else 1.0,
+                    text=f"Выгружено строк: {rows:,} из {total:,}".replace(",", " "),
+                )
+
+            # прошлая выгрузка этой сессии больше не нужна
+            previous_export = st.session_state.pop("export_report", None)
+            if previous_export is not None and os.path.exists(previous_export.path):
+                os.remove(previous_export.path)
+            try:
+                st.session_state["export_report"] = export.export_sends(
+                    export.app_export_path(export_format),
+                    campaign_ids,
+                    start_date or None,
+                    end_date or None,
+                    export_format,
+                    _export_progress,
+                    max_rows=export.EXPORT_APP_MAX_ROWS,
+                )
+            except export.ExportTooLarge as exc:
+                export_bar.empty()
+                st.warning(
+                    f"Слишком большая выгрузка для приложения ({exc}). "
+                    "Сузьте фильтры или выгрузите из консоли: python export.py."
+                )
+
+        export_report = st.session_state.get("export_report")
+        if export_report is not None and os.path.exists(export_report.path):
+            with open(export_report.path, "rb") as export_file:
+                st.download_button(
+                    f"Скачать {os.path.basename(export_report.path)} "
+                    f"({export_report.rows:,} строк, {export_report.bytes / 2**20:.1f} МБ)".replace(",", " "),
+                    export_file,
+                    file_name=os.path.basename(export_report.path),
+                    mime="text/csv" if export_report.format == "csv" else "application/octet-stream",
+                )
+
+
+# СТРАНИЦА «ПРОИЗВОДИТЕЛЬНОСТЬ»
+elif page == "Производительность":
+    st.header("Производительность")
+    st.caption(
+        "Время запросов к БД и шагов обработки в этом процессе приложения. "
+        "Замеры общие для всех сессий; буфер хранит последние "
+        f"{perf.PERF_BUFFER_SIZE} записей."
+    )
+
+    collect = st.toggle("Собирать замеры", value=perf.enabled())
+    if collect and not perf.enabled():
+        perf.enable()
+    elif not collect and perf.enabled():
+        perf.disable()
+
+    col1, col2 = st.columns(2)
+    if col1.button("Очистить буфер"):
+        perf.clear()
+    col2.download_button(
+        "Скачать JSON",
+        data=perf.export_json(),
+        file_name="perf.json",
+        mime="application/json",
+    )
+
+    summary = perf.summary()
+    if summary.empty:
+        st.info("Замеров пока нет: включите сбор и откройте другие страницы.")
+        st.stop()
+
+    st.subheader("Запросы к БД")
+    st.dataframe(
+        summary[summary["kind"] == "query"].drop(columns=["kind"]),
+        use_container_width=True,
+    )
+
+    st.subheader("Функции и шаги страниц")
+    st.dataframe(
+        summary[summary["kind"] == "span"].drop(columns=["kind", "rows_avg"]),
+        use_container_width=True,
+    )
+
+    with st.expander("Последние записи"):
+        st.dataframe(
+            pd.DataFrame([asdict(r) for r in perf.records()[-200:]]).iloc[::-1],
+            use_container_width=True,
+        )
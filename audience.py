@@ -0,0 +1,80 @@
+"""
+Аудитории рассылок, заданные фильтрами, а не списком client_id.
+
+AudienceSpec описывает аудиторию (сегменты, пол, дата регистрации,
+давность активности или правило реактивации) и превращается в SQL-условие
+над clients (алиас cl) с присоединённой client_activity (алиас a).
+Подсчёт, превью и создание получателей выполняются в db.py целиком
+на стороне БД, поэтому id клиентов не проходят через Python.
+"""
+
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+
+
+# FROM-часть, к которой применяется условие аудитории
+AUDIENCE_FROM_SQL = """
+    FROM clients cl
+    LEFT JOIN client_activity a ON a.client_id = cl.id
+"""
+
+
+@dataclass(frozen=True)
+class AudienceSpec:
+    """
+    Фильтр аудитории. Пустые поля не ограничивают выборку.
+
+    segments / genders   — допустимые значения clients.segment / clients.gender;
+    created_from / _to   — дата регистрации клиента (включительно);
+    active_within_days   — была активность (открытие/клик) за последние N дней;
+    inactive_days        — правило реактивации, как в get_reactivation_candidates():
+                           последняя активность, а если её не было — последняя
+                           отправка, старше N дней.
+    """
+
+    segments: tuple[str, ...] = ()
+    genders: tuple[str, ...] = ()
+    created_from: date | None = None
+    created_to: date | None = None
+    active_within_days: int | None = None
+    inactive_days: int | None = None
+
+    @classmethod
+    def reactivation(cls, inactive_days: int = 30) -> "AudienceSpec":
+        """Аудитория «уснувших» клиентов для WINBACK-рассылок."""
+        return cls(inactive_days=inactive_days)
+
+
+def audience_filter(spec: AudienceSpec) -> tuple[str, dict]:
+    """Собрать WHERE-условие по спецификации и параметры к нему."""
+    conditions = []
+    params = {}
+    now = datetime.now(timezone.utc)
+
+    if spec.segments:
+        conditions.append("cl.segment = ANY(:aud_segments)")
+        params["aud_segments"] = list(spec.segments)
+    if spec.genders:
+        conditions.append("cl.gender = ANY(:aud_genders)")
+        params["aud_genders"] = list(spec.genders)
+    if spec.created_from is not None:
+        conditions.append("cl.created_at >= :aud_created_from")
+        params["aud_created_from"] = spec.created_from
+    if spec.created_to is not None:
+        conditions.append("cl.created_at < :aud_created_to_excl")
+        params["aud_created_to_excl"] = spec.created_to + timedelta(days=1)
+    if spec.active_within_days is not None:
+        conditions.append("a.last_activity_at >= :aud_active_since")
+        params["aud_active_since"] = now - timedelta(days=spec.active_within_days)
+    if spec.inactive_days is not None:
+        conditions.append("COALESCE(a.last_activity_at, a.last_sent_at) < :aud_inactive_cutoff")
+        params["aud_inactive_cutoff"] = now - timedelta(days=spec.inactive_days)
+
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params
+
+
+def audience_source_sql(spec: AudienceSpec) -> tuple[str, dict]:
+    """Подзапрос с колонкой client_id для всех клиентов аудитории."""
+    where, params = audience_filter(spec)
+    return f"SELECT cl.id AS client_id {AUDIENCE_FROM_SQL} {where}", params
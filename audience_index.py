@@ -0,0 +1,461 @@
+"""
+Индекс аудиторий в памяти: битовые маски client_id для мгновенных подсчётов.
+
+Для каждого значения clients.segment и clients.gender хранится битовая маска
+(NumPy, 64-битные слова, бит i — клиент с id = i), плюс маска всех клиентов.
+Условия по времени (дата регистрации, давность активности из client_activity)
+считаются по колонкам datetime64 один раз на границу и кэшируются как такие же
+маски до следующего обновления индекса; граница «N дней назад» округляется
+вниз до минуты, поэтому повторные запросы попадают в кэш.
+
+Запросы собираются из масок операциями & (И), | (ИЛИ), - и ~ (НЕ):
+
+    index = audience_index.get_index()
+    vip = index.segment("VIP") & index.gender("F") & ~index.active_within(30)
+    vip.count()      # popcount по словам маски — микросекунды
+    vip.ids()        # массив client_id по возрастанию
+
+AudienceSpec вычисляется так же (query(), count(), ids()) и даёт то же
+множество, что SQL-фильтр audience_filter(). Выбранные id сразу передаются
+в db.create_campaign_clients() — без повторного отбора в БД.
+
+Обновление инкрементальное, как у локального снимка (snapshot.py): строки
+clients и client_activity с updated_at не раньше водяного знака
+(миграция 011) перечитываются и переставляют биты только у изменённых
+клиентов. Маски не меняются на месте — обновление создаёт новые массивы,
+поэтому уже выданные Bitmap остаются согласованными. Если число клиентов
+в БД не совпало с индексом (клиентов удаляли), индекс загружается заново.
+
+Включается переменной AUDIENCE_INDEX=1: тогда приложение считает аудиторию
+по индексу и создаёт получателей по его id. Память — около 30 байт
+на клиента плюс по 1 биту на клиента на каждую маску.
+
+    python -m benchmarks.bench_audience_index            # без БД
+    python -m benchmarks.bench_audience_index --db       # сверка с count_audience
+"""
+
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+import db
+from audience import AUDIENCE_FROM_SQL, AudienceSpec
+from perf import timed
+
+
+AUDIENCE_INDEX = os.getenv("AUDIENCE_INDEX", "0") == "1"
+# Как часто индекс досинхронизируется перед подсчётом аудитории
+AUDIENCE_INDEX_REFRESH_SECONDS = int(os.getenv("AUDIENCE_INDEX_REFRESH_SECONDS", "60"))
+AUDIENCE_INDEX_OVERLAP_SECONDS = int(os.getenv("AUDIENCE_INDEX_OVERLAP_SECONDS", "0"))
+
+# Сколько масок по времени держать в кэше
+MAX_DERIVED_BITMAPS = 256
+
+INDEX_SELECT = f"""
+    SELECT
+        cl.id,
+        cl.segment,
+        cl.gender,
+        cl.created_at,
+        a.last_activity_at,
+        COALESCE(a.last_activity_at, a.last_sent_at) AS last_seen_at
+    {AUDIENCE_FROM_SQL}
+"""
+
+CHANGED_FILTER = """
+    WHERE cl.id IN (
+        SELECT id FROM clients WHERE updated_at >= :since
+        UNION
+        SELECT client_id FROM client_activity WHERE updated_at >= :since
+    )
+"""
+
+TIME_COLUMNS = ("created_at", "last_activity_at", "last_seen_at")
+VALUE_COLUMNS = ("segment", "gender")
+
+if hasattr(np, "bitwise_count"):
+    def _popcount(words: np.ndarray) -> int:
+        return int(np.bitwise_count(words).sum(dtype=np.int64))
+else:
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(words: np.ndarray) -> int:
+        return int(_POPCOUNT8[words.view(np.uint8)].sum(dtype=np.int64))
+
+
+def _pack(mask: np.ndarray) -> np.ndarray:
+    """Булев массив длины, кратной 64, в слова маски."""
+    return np.packbits(mask, bitorder="little").view("<u8")
+
+
+def _with_bits(words: np.ndarray, ids: np.ndarray, value: bool) -> np.ndarray:
+    """Копия маски с установленными (value=True) или снятыми битами ids."""
+    words = words.copy()
+    ids = np.asarray(ids, dtype=np.int64)
+    bits = np.left_shift(np.uint64(1), (ids & 63).astype(np.uint64))
+    if value:
+        np.bitwise_or.at(words, ids >> 6, bits)
+    else:
+        np.bitwise_and.at(words, ids >> 6, ~bits)
+    return words
+
+
+def _has_bits(words: np.ndarray, ids: np.ndarray) -> np.ndarray:
+    """Для каждого id — установлен ли его бит."""
+    ids = np.asarray(ids, dtype=np.int64)
+    return (words[ids >> 6] >> (ids & 63).astype(np.uint64)) & np.uint64(1) == 1
+
+
+def _pad(words: np.ndarray, size: int) -> np.ndarray:
+    if len(words) >= size:
+        return words
+    return np.concatenate([words, np.zeros(size - len(words), dtype=words.dtype)])
+
+
+class Bitmap:
+    """
+    Множество client_id одной маской. Операции возвращают новый Bitmap;
+    ~ дополняет до всех клиентов индекса на момент создания маски.
+    """
+
+    __slots__ = ("words", "_universe")
+
+    def __init__(self, words: np.ndarray, universe: np.ndarray):
+        self.words = words
+        self._universe = universe
+
+    def _aligned(self, other: "Bitmap") -> tuple[np.ndarray, np.ndarray]:
+        size = max(len(self.words), len(other.words))
+        return _pad(self.words, size), _pad(other.words, size)
+
+    def __and__(self, other: "Bitmap") -> "Bitmap":
+        a, b = self._aligned(other)
+        return Bitmap(a & b, self._universe)
+
+    def __or__(self, other: "Bitmap") -> "Bitmap":
+        a, b = self._aligned(other)
+        return Bitmap(a | b, self._universe)
+
+    def __sub__(self, other: "Bitmap") -> "Bitmap":
+        a, b = self._aligned(other)
+        return Bitmap(a & ~b, self._universe)
+
+    def __invert__(self) -> "Bitmap":
+        return Bitmap(self._universe, self._universe) - self
+
+    def count(self) -> int:
+        """Число клиентов в множестве."""
+        return _popcount(self.words)
+
+    def __len__(self) -> int:
+        return self.count()
+
+    def ids(self) -> np.ndarray:
+        """client_id множества по возрастанию."""
+        return np.flatnonzero(np.unpackbits(self.words.view(np.uint8), bitorder="little"))
+
+
+@dataclass(frozen=True)
+class RefreshReport:
+    """Итог обновления индекса."""
+
+    full: bool
+    changed_rows: int
+    clients: int
+    seconds: float
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+
+
+def _seconds(values: pd.Series) -> np.ndarray:
+    return pd.to_datetime(values).to_numpy().astype("datetime64[s]")
+
+
+class AudienceIndex:
+    """Битовые маски аудиторий по данным clients и client_activity."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._refresh_lock = threading.RLock()
+        self._capacity = 0
+        self._universe = np.zeros(0, dtype="<u8")
+        self._codes: dict[str, np.ndarray] = {}
+        self._values: dict[str, list[str]] = {column: [] for column in VALUE_COLUMNS}
+        self._bitmaps: dict[tuple[str, int], np.ndarray] = {}
+        self._times: dict[str, np.ndarray] = {}
+        self._derived: dict[tuple, np.ndarray] = {}
+        self._clients = 0
+        self.watermark: datetime | None = None
+        self.refreshed_at: float | None = None
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> "AudienceIndex":
+        """Индекс по готовому DataFrame с колонками INDEX_SELECT (без БД)."""
+        index = cls()
+        index._load(frame)
+        return index
+
+    # ---------- загрузка ----------
+
+    def _grow(self, max_id: int) -> None:
+        """Расширить массивы, чтобы поместился клиент max_id."""
+        if max_id < self._capacity:
+            return
+        capacity = max(max_id + 1, int(self._capacity * 1.25))
+        capacity = (capacity + 63) // 64 * 64
+        extra = capacity - self._capacity
+        for column in VALUE_COLUMNS:
+            self._codes[column] = np.concatenate([
+                self._codes.get(column, np.zeros(0, dtype=np.int16)),
+                np.full(extra, -1, dtype=np.int16),
+            ])
+        for column in TIME_COLUMNS:
+            self._times[column] = np.concatenate([
+                self._times.get(column, np.zeros(0, dtype="datetime64[s]")),
+                np.full(extra, np.datetime64("NaT"), dtype="datetime64[s]"),
+            ])
+        words = capacity // 64
+        self._universe = _pad(self._universe, words)
+        self._bitmaps = {key: _pad(bitmap, words) for key, bitmap in self._bitmaps.items()}
+        self._capacity = capacity
+
+    def _encode(self, column: str, values: pd.Series) -> np.ndarray:
+        """Коды значений колонки (-1 — NULL), новые значения дописываются в словарь."""
+        dictionary = self._values[column]
+        codes = np.full(len(values), -1, dtype=np.int16)
+        for value in values.dropna().unique():
+            if value not in dictionary:
+                dictionary.append(value)
+            codes[(values == value).to_numpy()] = dictionary.index(value)
+        return codes
+
+    def _load(self, frame: pd.DataFrame) -> None:
+        """Построить индекс заново по всем клиентам."""
+        ids = frame["id"].to_numpy(dtype=np.int64)
+        self._capacity = 0
+        self._codes, self._times, self._bitmaps = {}, {}, {}
+        self._values = {column: [] for column in VALUE_COLUMNS}
+        self._universe = np.zeros(0, dtype="<u8")
+        self._grow(int(ids.max()) if len(ids) else 0)
+
+        present = np.zeros(self._capacity, dtype=bool)
+        present[ids] = True
+        self._universe = _pack(present)
+        for column in VALUE_COLUMNS:
+            self._codes[column][ids] = self._encode(column, frame[column])
+            for code in range(len(self._values[column])):
+                self._bitmaps[column, code] = _pack(self._codes[column] == code)
+        for column in TIME_COLUMNS:
+            self._times[column][ids] = _seconds(frame[column])
+        self._derived = {}
+        self._clients = len(ids)
+
+    def _apply(self, frame: pd.DataFrame) -> None:
+        """Переставить биты только у изменённых клиентов."""
+        ids = frame["id"].to_numpy(dtype=np.int64)
+        if not len(ids):
+            return
+        self._grow(int(ids.max()))
+
+        self._clients += int(np.count_nonzero(~_has_bits(self._universe, ids)))
+        self._universe = _with_bits(self._universe, ids, True)
+        for column in VALUE_COLUMNS:
+            old = self._codes[column][ids]
+            new = self._encode(column, frame[column])
+            self._codes[column][ids] = new
+            for code in np.unique(np.concatenate([old, new])):
+                if code < 0:
+                    continue
+                bitmap = self._bitmaps.get((column, int(code)), np.zeros_like(self._universe))
+                bitmap = _with_bits(bitmap, ids[(old == code) & (new != code)], False)
+                self._bitmaps[column, int(code)] = _with_bits(bitmap, ids[(new == code) & (old != code)], True)
+        for column in TIME_COLUMNS:
+            self._times[column][ids] = _seconds(frame[column])
+        self._derived = {}
+
+    @timed
+    def refresh(self, full: bool = False) -> RefreshReport:
+        """
+        Досинхронизировать индекс с БД (первый вызов или full=True — полная загрузка).
+
+        Запросы выполняются в одной REPEATABLE READ транзакции: изменения
+        и число клиентов для проверки удалений согласованы между собой.
+        """
+        started = time.perf_counter()
+        # обновления идут по очереди, чтобы более старое чтение не перезаписало новое
+        with self._refresh_lock:
+            full = full or self.watermark is None
+            with db.get_engine().connect() as conn:
+                conn = conn.execution_options(isolation_level="REPEATABLE READ")
+                watermark = db.updated_watermark(conn)
+                if full:
+                    frame = pd.read_sql(text(INDEX_SELECT), conn)
+                else:
+                    since = self.watermark - timedelta(seconds=AUDIENCE_INDEX_OVERLAP_SECONDS)
+                    frame = pd.read_sql(text(INDEX_SELECT + CHANGED_FILTER), conn, params={"since": since})
+                    total = conn.execute(text("SELECT COUNT(*) FROM clients")).scalar_one()
+
+            with self._lock:
+                if full:
+                    self._load(frame)
+                else:
+                    self._apply(frame)
+                self.watermark = watermark
+                self.refreshed_at = time.monotonic()
+                clients = self._clients
+
+            if not full and clients != total:
+                return self.refresh(full=True)
+        return RefreshReport(
+            full=full, changed_rows=len(frame), clients=clients, seconds=time.perf_counter() - started,
+        )
+
+    # ---------- маски ----------
+
+    def _bitmap(self, words: np.ndarray) -> Bitmap:
+        return Bitmap(words, self._universe)
+
+    def all(self) -> Bitmap:
+        """Все клиенты."""
+        with self._lock:
+            return self._bitmap(self._universe)
+
+    def _values_bitmap(self, column: str, values: tuple[str, ...]) -> Bitmap:
+        with self._lock:
+            words = np.zeros_like(self._universe)
+            for value in values:
+                if value in self._values[column]:
+                    words = words | self._bitmaps[column, self._values[column].index(value)]
+            return self._bitmap(words)
+
+    def segment(self, *values: str) -> Bitmap:
+        """Клиенты любого из сегментов values."""
+        return self._values_bitmap("segment", values)
+
+    def gender(self, *values: str) -> Bitmap:
+        """Клиенты любого из значений пола values."""
+        return self._values_bitmap("gender", values)
+
+    def _time_bitmap(self, column: str, op: str, bound: datetime) -> Bitmap:
+        key = (column, op, bound)
+        with self._lock:
+            words = self._derived.get(key)
+            if words is None:
+                values = self._times[column]
+                cutoff = np.datetime64(bound, "s")
+                # NaT не проходит ни одно сравнение — как NULL в SQL
+                words = _pack(values >= cutoff if op == ">=" else values < cutoff)
+                if len(self._derived) >= MAX_DERIVED_BITMAPS:
+                    self._derived.clear()
+                self._derived[key] = words
+            return self._bitmap(words)
+
+    def created_between(self, date_from: date | None = None, date_to: date | None = None) -> Bitmap:
+        """Дата регистрации в [date_from, date_to] включительно."""
+        result = self.all()
+        if date_from is not None:
+            result &= self._time_bitmap("created_at", ">=", datetime.combine(date_from, datetime.min.time()))
+        if date_to is not None:
+            bound = datetime.combine(date_to + timedelta(days=1), datetime.min.time())
+            result &= self._time_bitmap("created_at", "<", bound)
+        return result
+
+    def active_within(self, days: int) -> Bitmap:
+        """Была активность (открытие/клик) за последние days дней."""
+        return self._time_bitmap("last_activity_at", ">=", _now() - timedelta(days=days))
+
+    def inactive(self, days: int) -> Bitmap:
+        """Правило реактивации: последняя активность или отправка старше days дней."""
+        return self._time_bitmap("last_seen_at", "<", _now() - timedelta(days=days))
+
+    # ---------- аудитории ----------
+
+    def query(self, spec: AudienceSpec) -> Bitmap:
+        """Маска аудитории spec — то же множество, что audience_filter(spec)."""
+        result = self.all()
+        if spec.segments:
+            result &= self.segment(*spec.segments)
+        if spec.genders:
+            result &= self.gender(*spec.genders)
+        if spec.created_from is not None or spec.created_to is not None:
+            result &= self.created_between(spec.created_from, spec.created_to)
+        if spec.active_within_days is not None:
+            result &= self.active_within(spec.active_within_days)
+        if spec.inactive_days is not None:
+            result &= self.inactive(spec.inactive_days)
+        return result
+
+    def count(self, spec: AudienceSpec) -> int:
+        """Число клиентов в аудитории."""
+        return self.query(spec).count()
+
+    def ids(self, spec: AudienceSpec) -> np.ndarray:
+        """client_id аудитории по возрастанию."""
+        return self.query(spec).ids()
+
+    def stats(self) -> dict:
+        """Размер индекса: клиенты, маски и занятая память."""
+        with self._lock:
+            arrays = [*self._codes.values(), *self._times.values(), self._universe,
+                      *self._bitmaps.values(), *self._derived.values()]
+            return {
+                "clients": self._clients,
+                "bitmaps": len(self._bitmaps) + 1,
+                "derived_bitmaps": len(self._derived),
+                "memory_bytes": sum(a.nbytes for a in arrays),
+            }
+
+
+_index: AudienceIndex | None = None
+_index_lock = threading.Lock()
+
+
+def enabled() -> bool:
+    """Индекс включён переменной AUDIENCE_INDEX=1."""
+    return AUDIENCE_INDEX
+
+
+def get_index() -> AudienceIndex:
+    """Общий для процесса индекс; при первом обращении загружается из БД."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = AudienceIndex()
+            index.refresh()
+            _index = index
+        return _index
+
+
+def refresh_if_stale(max_age_seconds: int = AUDIENCE_INDEX_REFRESH_SECONDS) -> RefreshReport | None:
+    """Досинхронизировать индекс, если с прошлого обновления прошло больше max_age_seconds."""
+    index = get_index()
+    if time.monotonic() - index.refreshed_at < max_age_seconds:
+        return None
+    return index.refresh()
+
+
+@timed
+def count_audience(spec: AudienceSpec) -> int:
+    """Число клиентов в аудитории по индексу (аналог db.count_audience)."""
+    refresh_if_stale()
+    return get_index().count(spec)
+
+
+@timed
+def create_campaign_clients_for_audience(campaign_id: int, spec: AudienceSpec) -> int:
+    """
+    Создать получателей кампании по id из индекса (аналог
+    db.create_campaign_clients_for_audience). Перед выборкой индекс
+    досинхронизируется, чтобы не пропустить только что добавленных клиентов.
+    """
+    index = get_index()
+    index.refresh()
+    return db.create_campaign_clients(campaign_id, index.ids(spec))
@@ -0,0 +1,115 @@
+"""
+Бенчмарк агрегаций страницы «Аналитика»: прежний pandas-код с лямбдами
+против analytics.compute_metrics().
+
+Данные синтетические, база не нужна:
+
+    python -m benchmarks.bench_analytics --rows 10000000
+
+Прежний вариант воспроизводит код app.py до переноса агрегаций в analytics.py:
+четыре groupby().agg() с лямбдами и повторный расчёт таблицы по кампаниям.
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from analytics import compute_metrics
+
+
+def make_frame(rows: int, campaigns: int = 200, days: int = 365, seed: int = 0) -> pd.DataFrame:
+    """DataFrame в формате get_campaign_clients_joined() (строки — object, как из read_sql)."""
+    rng = np.random.default_rng(seed)
+
+    campaign_ids = rng.integers(1, campaigns + 1, rows)
+    campaign_names = np.array([f"Кампания {i}" for i in range(campaigns + 1)], dtype=object)
+    start = np.datetime64("2025-01-01T00:00:00", "s")
+
+    return pd.DataFrame({
+        "cc_id": np.arange(1, rows + 1),
+        "campaign_id": campaign_ids,
+        "client_id": rng.integers(1, 1_000_000, rows),
+        "sent_at": start + rng.integers(0, days * 86_400, rows).astype("m8[s]"),
+        "send_status": np.array(["CLICKED", "OPENED", "SENT", "BOUNCED"], dtype=object)[
+            np.searchsorted([0.2, 0.8, 0.95], rng.random(rows), side="right")
+        ],
+        "campaign_name": campaign_names[campaign_ids],
+        "gender": np.array(["M", "F", None], dtype=object)[
+            rng.choice(3, rows, p=[0.49, 0.49, 0.02])
+        ],
+        "segment": np.array(["new", "active", "churn_risk", "vip"], dtype=object)[
+            rng.integers(0, 4, rows)
+        ],
+    })
+
+
+def legacy_metrics(df: pd.DataFrame) -> dict:
+    """Агрегации в том виде, в каком они были в app.py."""
+    df = df.copy()
+    df["sent_at"] = pd.to_datetime(df["sent_at"])
+    df["sent_date"] = df["sent_at"].dt.date
+    df["status_norm"] = df["send_status"].str.upper()
+
+    sent_total = len(df)
+    opened_total = df["status_norm"].isin(["OPENED", "CLICKED"]).sum()
+    clicked_total = (df["status_norm"] == "CLICKED").sum()
+
+    def agg(frame, key):
+        result = frame.groupby(key).agg(
+            sent=("cc_id", "size"),
+            opened=("status_norm", lambda s: s.isin(["OPENED", "CLICKED"]).sum()),
+            clicked=("status_norm", lambda s: (s == "CLICKED").sum()),
+        )
+        result["open_rate"] = result["opened"] / result["sent"]
+        result["click_rate"] = result["clicked"] / result["sent"]
+        return result
+
+    return {
+        "total": (sent_total, opened_total, clicked_total),
+        "campaign": agg(df, "campaign_name"),
+        "daily": agg(df, "sent_date"),
+        "gender": agg(df.dropna(subset=["gender"]), "gender"),
+        "segment": agg(df.dropna(subset=["segment"]), "segment"),
+    }
+
+
+def _timed(func, *args, repeat: int = 1) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"Генерация {args.rows:,} строк...")
+    df = make_frame(args.rows)
+
+    # Результаты должны совпадать
+    legacy = legacy_metrics(df)
+    engine = compute_metrics(df)
+    for dim, key in [("gender", "gender"), ("segment", "segment"), ("daily", "sent_date")]:
+        new = getattr(engine, dim).set_index(key)[["sent", "opened", "clicked"]]
+        old = legacy[dim][["sent", "opened", "clicked"]]
+        assert new.sort_index().equals(old.sort_index().astype("int64")), dim
+    assert int(engine.total["sent"].iloc[0]) == legacy["total"][0]
+
+    legacy_time = _timed(legacy_metrics, df, repeat=args.repeat)
+    engine_time = _timed(compute_metrics, df, repeat=args.repeat)
+
+    print(f"{'вариант':<22} {'сек':>8} {'строк/сек':>14}")
+    print(f"{'groupby + lambda':<22} {legacy_time:>8.2f} {args.rows / legacy_time:>14,.0f}")
+    print(f"{'compute_metrics':<22} {engine_time:>8.2f} {args.rows / engine_time:>14,.0f}")
+    print(f"Ускорение: {legacy_time / engine_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
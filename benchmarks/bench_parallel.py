@@ -0,0 +1,146 @@
+"""
+Масштабирование параллельного расчёта метрик (parallel_analytics.py) по ядрам.
+
+Во временном каталоге строится синтетический Parquet-снимок отправок
+в формате snapshot.py, затем метрики по всему снимку считаются одним
+процессом (snapshot.get_campaign_metrics) и пулом из 1, 2, 4, ... процессов.
+Результат каждого прогона сверяется с однопроцессным; база не нужна:
+
+    python -m benchmarks.bench_parallel --rows 50000000
+    python -m benchmarks.bench_parallel --rows 50000000 --workers 1 8 16 32
+
+Время пула — без его запуска (в приложении пул создаётся один раз).
+Код выхода 1, если хоть один результат разошёлся с однопроцессным.
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import parallel_analytics
+import snapshot
+from analytics import COUNT_COLUMNS, DIMENSIONS, MetricsResult
+
+
+STATUSES = np.array(["CLICKED", "OPENED", "SENT", "BOUNCED"])
+
+
+def build_snapshot(directory: str, rows: int, campaigns: int, clients: int, seed: int) -> None:
+    """Снимок из файлов по snapshot.PART_TARGET_ROWS строк (как после уплотнения)."""
+    rng = np.random.default_rng(seed)
+    start = np.datetime64("2025-01-01T00:00:00", "us")
+    # отправки за год, дописываются по времени: sent_at растёт вместе с id
+    step_us = max(365 * 86_400_000_000 // rows, 1)
+    parts = []
+    written = 0
+    while written < rows:
+        n = min(snapshot.PART_TARGET_ROWS, rows - written)
+        ids = np.arange(written + 1, written + n + 1, dtype=np.int32)
+        offsets = written * step_us + np.sort(rng.integers(0, n * step_us, n))
+        status = STATUSES[np.searchsorted([0.2, 0.8, 0.95], rng.random(n), side="right")]
+        sent_at = pa.array(start + offsets.astype("m8[us]"), snapshot.TIMESTAMP)
+        table = pa.table({
+            "cc_id": ids,
+            "campaign_id": rng.integers(1, campaigns + 1, n, dtype=np.int32),
+            "client_id": rng.integers(1, clients + 1, n, dtype=np.int32),
+            "sent_at": sent_at,
+            "send_status": status,
+            "opened_at": pa.nulls(n, snapshot.TIMESTAMP),
+            "clicked_at": pa.nulls(n, snapshot.TIMESTAMP),
+            "updated_at": sent_at,
+        }, schema=snapshot.SENDS_SCHEMA)
+        name = f"sends-{len(parts):06d}.parquet"
+        pq.write_table(table, os.path.join(directory, name), row_group_size=snapshot.ROW_GROUP_ROWS)
+        parts.append({"file": name, "id_from": written, "id_to": written + n, "rows": n})
+        written += n
+
+    pq.write_table(pa.table({
+        "id": np.arange(1, campaigns + 1, dtype=np.int32),
+        "name": [f"Кампания {i}" for i in range(1, campaigns + 1)],
+    }, schema=snapshot.CAMPAIGNS_SCHEMA), os.path.join(directory, snapshot.CAMPAIGNS_FILE))
+    pq.write_table(pa.table({
+        "id": np.arange(1, clients + 1, dtype=np.int32),
+        "gender": rng.choice(["M", "F"], clients),
+        "segment": rng.choice(["new", "active", "churn_risk", "vip"], clients),
+    }, schema=snapshot.CLIENTS_SCHEMA), os.path.join(directory, snapshot.CLIENTS_FILE))
+
+    state = snapshot._empty_state()
+    state.update(last_id=written, parts=parts, next_part=len(parts))
+    with open(os.path.join(directory, snapshot.STATE_FILE), "w", encoding="utf-8") as f:
+        json.dump(state, f)
+
+
+def same_metrics(a: MetricsResult, b: MetricsResult) -> bool:
+    """Совпадение счётчиков и долей по всем разрезам (порядок строк не важен)."""
+    if not a.total[COUNT_COLUMNS].equals(b.total[COUNT_COLUMNS]):
+        return False
+    for dim, keys in DIMENSIONS.items():
+        left, right = (
+            getattr(r, dim).astype({k: str for k in keys}).sort_values(keys, ignore_index=True)
+            for r in (a, b)
+        )
+        if not left[COUNT_COLUMNS].equals(right[COUNT_COLUMNS]):
+            return False
+        if not np.allclose(left[["open_rate", "click_rate"]], right[["open_rate", "click_rate"]], rtol=0, atol=1e-12):
+            return False
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20_000_000)
+    parser.add_argument("--campaigns", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=1_000_000)
+    parser.add_argument("--workers", type=int, nargs="+", help="число процессов (по умолчанию 1, 2, 4, ... до числа ядер)")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    cores = os.cpu_count() or 1
+    workers = args.workers or sorted({1, *(2 ** i for i in range(1, cores.bit_length())), cores})
+
+    with tempfile.TemporaryDirectory(prefix="bench-parallel-") as directory:
+        print(f"Генерация снимка: {args.rows:,} строк...", flush=True)
+        build_snapshot(directory, args.rows, args.campaigns, args.clients, args.seed)
+        snapshot.SNAPSHOT_DIR = directory
+        print(f"Частей: {len(snapshot.partitions())}, ядер: {cores}")
+
+        def best(func) -> float:
+            timings = []
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                func()
+                timings.append(time.perf_counter() - started)
+            return min(timings)
+
+        reference = snapshot.get_campaign_metrics()
+        serial = best(snapshot.get_campaign_metrics)
+        print(f"{'процессов':>9} {'сек':>8} {'строк/сек':>14} {'ускорение':>10} {'эффективность':>14}")
+        print(f"{'без пула':>9} {serial:>8.2f} {args.rows / serial:>14,.0f}")
+
+        mismatches = 0
+        for n in workers:
+            result = parallel_analytics.get_campaign_metrics(workers=n)  # запуск пула и прогрев
+            matches = same_metrics(result, reference)
+            mismatches += not matches
+            seconds = best(lambda: parallel_analytics.get_campaign_metrics(workers=n))
+            speedup = serial / seconds
+            print(
+                f"{n:>9} {seconds:>8.2f} {args.rows / seconds:>14,.0f} {speedup:>9.1f}x {speedup / n:>13.0%}"
+                + ("" if matches else "  РАСХОЖДЕНИЕ"),
+                flush=True,
+            )
+        parallel_analytics.shutdown()
+
+    if mismatches:
+        raise SystemExit(f"Результат разошёлся с однопроцессным в {mismatches} прогонах")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Массовая загрузка строк в PostgreSQL через COPY FROM STDIN.
+
+Строки пишутся в CSV-буфер порциями по chunk_rows и отправляются
+отдельными COPY-командами в рамках текущей транзакции курсора,
+поэтому память не зависит от общего количества строк.
+Работает с курсором psycopg2 (нужен метод copy_expert).
+"""
+
+import csv
+import io
+from itertools import islice
+from typing import Iterable, Sequence
+
+import pandas as pd
+
+
+COPY_NULL = r"\N"
+
+
+def _format_value(value):
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _copy_sql(table: str, columns: Sequence[str]) -> str:
+    column_list = ", ".join(f'"{c}"' for c in columns)
+    return f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+
+
+def copy_rows(
+    cursor,
+    table: str,
+    columns: Sequence[str],
+    rows: Iterable[Sequence],
+    chunk_rows: int = 50_000,
+) -> int:
+    """
+    Загрузить rows (кортежи в порядке columns) в таблицу table.
+
+    Возвращает количество загруженных строк.
+    """
+    sql = _copy_sql(table, columns)
+
+    rows = iter(rows)
+    total = 0
+    while True:
+        chunk = list(islice(rows, chunk_rows))
+        if not chunk:
+            break
+
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator="\n")
+        writer.writerows([_format_value(v) for v in row] for row in chunk)
+        buf.seek(0)
+
+        cursor.copy_expert(sql, buf)
+        total += len(chunk)
+
+    return total
+
+
+def copy_frame(
+    cursor,
+    table: str,
+    frame: pd.DataFrame,
+    columns: Sequence[str] | None = None,
+    chunk_rows: int = 50_000,
+) -> int:
+    """
+    Загрузить колонки DataFrame в таблицу table без построчных Python-объектов.
+
+    Порции сериализуются через DataFrame.to_csv; NaN/NaT/None становятся NULL.
+    Возвращает количество загруженных строк.
+    """
+    columns = list(columns) if columns is not None else list(frame.columns)
+    sql = _copy_sql(table, columns)
+
+    total = 0
+    for start in range(0, len(frame), chunk_rows):
+        chunk = frame.iloc[start:start + chunk_rows]
+
+        buf = io.StringIO()
+        chunk.to_csv(buf, columns=columns, header=False, index=False, na_rep=COPY_NULL)
+        buf.seek(0)
+
+        cursor.copy_expert(sql, buf)
+        total += len(chunk)
+
+    return total
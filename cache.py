@@ -0,0 +1,171 @@
+"""
+Кэш чтений из БД, общий для всех сессий Streamlit в одном процессе.
+
+Каждая запись живёт не дольше CACHE_TTL_SECONDS, всего хранится
+не больше CACHE_MAX_ENTRIES записей (вытесняются давно не использованные).
+Записи привязаны к таблицам, из которых они прочитаны: функции записи
+вызывают invalidate("table"), версия таблицы увеличивается, и все
+зависящие от неё записи удаляются. Версии таблиц входят в ключ записи,
+поэтому чтение, начавшееся до записи и закончившееся после неё,
+не попадёт в кэш под актуальной версией.
+"""
+
+import dataclasses
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "300"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "256"))
+
+
+def _freeze(value):
+    """Привести аргумент к хешируемому виду (списки -> кортежи и т.п.)."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(v) for v in value))
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def _copy_result(value):
+    """Отдать вызывающему копию, чтобы правки DataFrame не портили кэш."""
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, dict):
+        return {k: _copy_result(v) for k, v in value.items()}
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.replace(
+            value,
+            **{f.name: _copy_result(getattr(value, f.name)) for f in dataclasses.fields(value)},
+        )
+    return value
+
+
+class QueryCache:
+    """Потокобезопасный TTL + LRU кэш с версиями таблиц."""
+
+    def __init__(self, ttl_seconds: float, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # key -> (expires_at, tables, value)
+        self._entries: OrderedDict = OrderedDict()
+        self._versions: dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _key(self, name: str, tables: tuple[str, ...], args, kwargs) -> tuple:
+        versions = tuple(self._versions.get(t, 0) for t in tables)
+        return (name, versions, _freeze(args), _freeze(kwargs))
+
+    def get_or_load(self, name: str, tables: tuple[str, ...], args, kwargs, loader):
+        now = time.monotonic()
+        with self._lock:
+            key = self._key(name, tables, args, kwargs)
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, _, value = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return _copy_result(value)
+                del self._entries[key]
+                self.expirations += 1
+            self.misses += 1
+
+        # Загружаем вне блокировки, чтобы не тормозить другие сессии
+        value = loader(*args, **kwargs)
+
+        with self._lock:
+            # Если за время загрузки таблицы изменились, ключ уже устарел:
+            # кладём под старой версией, такую запись никто не прочитает
+            # и она будет удалена по TTL или вытеснением.
+            if key == self._key(name, tables, args, kwargs):
+                self._entries[key] = (time.monotonic() + self.ttl_seconds, tables, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+
+        return _copy_result(value)
+
+    def invalidate(self, *tables: str) -> None:
+        """Увеличить версию таблиц и удалить все записи, которые от них зависят."""
+        changed = set(tables)
+        with self._lock:
+            for table in changed:
+                self._versions[table] = self._versions.get(table, 0) + 1
+            stale = [
+                key for key, (_, entry_tables, _) in self._entries.items()
+                if changed.intersection(entry_tables)
+            ]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "table_versions": dict(self._versions),
+            }
+
+
+_cache = QueryCache(CACHE_TTL_SECONDS, CACHE_MAX_ENTRIES)
+
+
+def cached(*tables: str):
+    """
+    Декоратор для функций чтения: кэширует результат по аргументам
+    и версиям перечисленных таблиц.
+    """
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return _cache.get_or_load(name, tables, args, kwargs, func)
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator
+
+
+def invalidate(*tables: str) -> None:
+    """Сбросить кэш для изменённых таблиц (вызывать после записи)."""
+    _cache.invalidate(*tables)
+
+
+def clear() -> None:
+    """Полностью очистить кэш."""
+    _cache.clear()
+
+
+def stats() -> dict:
+    """Счётчики попаданий/промахов и текущее состояние кэша."""
+    return _cache.stats()
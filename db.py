@@ -1,34 +1,250 @@
 import os
-import random
-from datetime import datetime, timezone, timedelta
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timezone, timedelta
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
+from pandas.api.types import union_categoricals
+from sqlalchemy import Engine, create_engine, event, make_url, text
+from sqlalchemy.exc import TimeoutError as SATimeoutError
+from sqlalchemy.pool import QueuePool
+
+import frequency_cap
+import rollups
+import sketches
+from analytics import COUNT_COLUMNS, DIMENSIONS, MetricsResult, sort_table, with_rates
+from audience import AUDIENCE_FROM_SQL, AudienceSpec, audience_filter, audience_source_sql
+from bulk import copy_frame
+from cache import cached, invalidate
+from migrations import ensure_month_partitions, remember_month_partitions
+from perf import timed
+from simulation import LIVE_SEND, simulate_sends, simulate_sends_sql
 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
-engine = create_engine(DATABASE_URL)
+# Необязательная реплика для тяжёлых чтений страницы «Аналитика»
+ANALYTICS_DATABASE_URL = os.getenv("ANALYTICS_DATABASE_URL")
+
+# Настройки пула соединений (на каждый engine)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+# Таймаут одного запроса, мс (0 — без ограничения)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+ANALYTICS_STATEMENT_TIMEOUT_MS = int(
+    os.getenv("ANALYTICS_STATEMENT_TIMEOUT_MS", str(DB_STATEMENT_TIMEOUT_MS))
+)
+# PgBouncer в режиме transaction (пулер Neon, хост *-pooler) не принимает
+# параметр options при подключении: таймаут тогда ставится SET LOCAL в каждой
+# транзакции. auto — определить по имени хоста.
+DB_PGBOUNCER = os.getenv("DB_PGBOUNCER", "auto")
+
+ENGINE_ROLES = ("primary", "analytics")
+
+_engines: dict[str, Engine] = {}
+_pool_stats: dict[str, dict] = {}
+_engines_lock = threading.Lock()
+
+
+def _new_pool_stats() -> dict:
+    return {
+        "checkouts": 0,
+        "overflow_checkouts": 0,
+        "timeouts": 0,
+        "wait_total": 0.0,
+        "wait_max": 0.0,
+    }
+
+
+def _timed_pool_class(stats: dict) -> type[QueuePool]:
+    """QueuePool, который считает ожидание свободного соединения и таймауты."""
+
+    class TimedQueuePool(QueuePool):
+        def _do_get(self):
+            started = time.perf_counter()
+            try:
+                connection = super()._do_get()
+            except SATimeoutError:
+                stats["timeouts"] += 1
+                raise
+            waited = time.perf_counter() - started
+            stats["checkouts"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            if self.overflow() > 0:
+                stats["overflow_checkouts"] += 1
+            return connection
+
+    return TimedQueuePool
+
+
+def _uses_pgbouncer(url) -> bool:
+    if DB_PGBOUNCER == "auto":
+        return "-pooler" in (url.host or "")
+    return DB_PGBOUNCER == "1"
+
+
+def _create_engine(role: str, url: str, statement_timeout_ms: int) -> Engine:
+    stats = _pool_stats.setdefault(role, _new_pool_stats())
+    url = make_url(url)
+    pgbouncer = _uses_pgbouncer(url)
+
+    connect_args = {}
+    if statement_timeout_ms and not pgbouncer:
+        connect_args["options"] = f"-c statement_timeout={statement_timeout_ms}"
 
-if not DATABASE_URL:
-    raise RuntimeError("DATABASE_URL is not set")
+    new_engine = create_engine(
+        url,
+        poolclass=_timed_pool_class(stats),
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args=connect_args,
+    )
 
-engine = create_engine(DATABASE_URL)
+    if statement_timeout_ms and pgbouncer:
+        @event.listens_for(new_engine, "begin")
+        def _set_statement_timeout(conn):
+            # через DB-API курсор: psycopg2 сам открывает транзакцию этим запросом
+            cursor = conn.connection.dbapi_connection.cursor()
+            try:
+                cursor.execute("SET LOCAL statement_timeout = %s", (statement_timeout_ms,))
+            finally:
+                cursor.close()
+
+    return new_engine
+
+
+def get_engine(role: str = "primary") -> Engine:
+    """
+    Вернуть engine для роли, создав его при первом обращении.
+
+    primary   — основная БД (запись и чтения, которым нужна свежесть);
+    analytics — тяжёлые чтения аналитики: ANALYTICS_DATABASE_URL (реплика),
+                а если она не задана — тот же engine, что и primary.
+    """
+    if role not in ENGINE_ROLES:
+        raise ValueError(f"Неизвестная роль подключения: {role}")
+    if role == "analytics" and not ANALYTICS_DATABASE_URL:
+        role = "primary"
+
+    existing = _engines.get(role)
+    if existing is not None:
+        return existing
+
+    with _engines_lock:
+        if role not in _engines:
+            if role == "analytics":
+                _engines[role] = _create_engine(
+                    role, ANALYTICS_DATABASE_URL, ANALYTICS_STATEMENT_TIMEOUT_MS
+                )
+            else:
+                if not DATABASE_URL:
+                    raise RuntimeError("DATABASE_URL is not set")
+                _engines[role] = _create_engine(role, DATABASE_URL, DB_STATEMENT_TIMEOUT_MS)
+        return _engines[role]
+
+
+def pool_stats() -> dict[str, dict]:
+    """Состояние пулов созданных engine'ов: занятые соединения, ожидание, overflow."""
+    result = {}
+    for role, current in list(_engines.items()):
+        pool = current.pool
+        stats = _pool_stats[role]
+        checkouts = stats["checkouts"]
+        result[role] = {
+            "size": pool.size(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            "idle": pool.checkedin(),
+            "checkouts": checkouts,
+            "overflow_checkouts": stats["overflow_checkouts"],
+            "timeouts": stats["timeouts"],
+            "wait_avg_ms": 1000 * stats["wait_total"] / checkouts if checkouts else 0.0,
+            "wait_max_ms": 1000 * stats["wait_max"],
+        }
+    return result
+
+
+def dispose_engines() -> None:
+    """Закрыть все пулы (например, в дочернем процессе после fork)."""
+    with _engines_lock:
+        for current in _engines.values():
+            current.dispose(close=False)
+        _engines.clear()
+        _pool_stats.clear()
+
+
+def updated_watermark(conn) -> datetime:
+    """
+    Граница для инкрементального чтения по updated_at: начало текущей
+    транзакции или, если раньше, начало самой старой из открытых сейчас.
+    Всё, что не видно в снимке текущей транзакции, получит updated_at
+    не меньше неё.
+    """
+    row = conn.execute(text("""
+        SELECT
+            LOCALTIMESTAMP AS snapshot_at,
+            (
+                SELECT MIN(xact_start)::timestamp
+                FROM pg_stat_activity
+                WHERE datname = current_database()
+                  AND pid <> pg_backend_pid()
+                  AND xact_start IS NOT NULL
+            ) AS oldest_xact
+    """)).one()
+    if row.oldest_xact is None:
+        return row.snapshot_at
+    return min(row.snapshot_at, row.oldest_xact)
+
+# Рассылки крупнее порога заливаются через COPY, а не executemany
+COPY_THRESHOLD = int(os.getenv("COPY_THRESHOLD", "5000"))
+COPY_CHUNK_ROWS = int(os.getenv("COPY_CHUNK_ROWS", "50000"))
+
+CAMPAIGN_CLIENTS_COLUMNS = (
+    "campaign_id", "client_id", "sent_at", "status", "opened_at", "clicked_at",
+)
+
+
+@timed
+@cached("templates")
 def get_templates() -> pd.DataFrame:
     """Вернуть все активные шаблоны писем."""
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql("SELECT * FROM templates WHERE is_active = TRUE ORDER BY id", conn)
     return df
 
 
+@timed
+@cached("clients")
 def get_clients() -> pd.DataFrame:
     """Вернуть всех клиентов."""
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql("SELECT * FROM clients ORDER BY id", conn)
     return df
 
 
-def create_campaign(name: str, template_id: int, description: str = "") -> int:
-    """Создать кампанию и вернуть её id."""
-    now = datetime.now(timezone.utc)
+@timed
+def create_campaign(
+    name: str,
+    template_id: int,
+    description: str = "",
+    status: str = "FINISHED",
+    planned_at: datetime | None = None,
+) -> int:
+    """
+    Создать кампанию и вернуть её id.
+
+    По умолчанию кампания сразу FINISHED (письма симулируются, см.
+    create_campaign_clients). planned_at — UTC без часового пояса,
+    по умолчанию сейчас.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
 
     sql = text("""
         INSERT INTO campaigns (name, template_id, description, status, created_at, planned_at)
@@ -36,93 +252,379 @@ def create_campaign(name: str, template_id: int, description: str = "") -> int:
         RETURNING id
     """)
 
-    with engine.begin() as conn:  # begin = автокоммит транзакции
+    with get_engine().begin() as conn:  # begin = автокоммит транзакции
         result = conn.execute(
             sql,
             {
                 "name": name,
                 "template_id": template_id,
                 "description": description,
-                "status": "FINISHED",  # для простоты считаем сразу завершённой
+                "status": status,
                 "created_at": now,
-                "planned_at": now,
+                "planned_at": planned_at or now,
             },
         )
         campaign_id = result.scalar_one()
 
+    invalidate("campaigns")
     return campaign_id
 
 
-def _simulate_status(sent_at: datetime):
+@timed
+def schedule_campaign(
+    name: str,
+    template_id: int,
+    spec: AudienceSpec,
+    planned_at: datetime | None = None,
+    description: str = "",
+) -> tuple[int, int]:
     """
-    Имитация статуса письма и времена opened/clicked.
+    Создать кампанию для реальной отправки в planned_at (UTC, по умолчанию сейчас).
 
-    Пропорции:
-      20% CLICKED
-      60% OPENED (без клика)
-      15% SENT
-      5% BOUNCED
+    Кампания создаётся как DRAFT, получают PLANNED-строки, и только потом
+    переводится в SCHEDULED — планировщик (scheduler.py) не увидит её
+    без получателей. Возвращает (id кампании, число получателей).
     """
-    r = random.random()
+    planned_at = planned_at or datetime.now(timezone.utc).replace(tzinfo=None)
+    campaign_id = create_campaign(name, template_id, description, "DRAFT", planned_at)
+    recipients = create_planned_campaign_clients(campaign_id, spec, planned_at)
 
-    if r < 0.2:
-        status = "CLICKED"
-        opened_at = sent_at + timedelta(minutes=random.randint(1, 60))
-        clicked_at = opened_at + timedelta(minutes=random.randint(1, 30))
-    elif r < 0.8:
-        status = "OPENED"
-        opened_at = sent_at + timedelta(minutes=random.randint(1, 90))
-        clicked_at = None
-    elif r < 0.95:
-        status = "SENT"
-        opened_at = None
-        clicked_at = None
-    else:
-        status = "BOUNCED"
-        opened_at = None
-        clicked_at = None
+    with get_engine().begin() as conn:
+        conn.execute(
+            text("UPDATE campaigns SET status = 'SCHEDULED' WHERE id = :campaign_id"),
+            {"campaign_id": campaign_id},
+        )
 
-    return status, opened_at, clicked_at
+    invalidate("campaigns")
+    return campaign_id, recipients
 
 
-def create_campaign_clients(campaign_id: int, client_ids: list[int]) -> int:
-    """Создать записи в campaign_clients для выбранных клиентов."""
-    now = datetime.now(timezone.utc)
+@timed
+@cached("campaigns", "campaign_runs")
+def get_campaign_runs(limit: int = 50) -> pd.DataFrame:
+    """Последние запуски отправки кампаний (scheduler.py) со скоростью."""
+    sql = text("""
+        SELECT
+            r.id, r.campaign_id, c.name AS campaign_name, c.status AS campaign_status,
+            r.worker, r.status, r.started_at, r.finished_at, r.batches,
+            r.recipients, r.sent, r.bounced, r.deferred, r.seconds, r.messages_per_sec
+        FROM campaign_runs r
+        JOIN campaigns c ON c.id = r.campaign_id
+        ORDER BY r.id DESC
+        LIMIT :limit
+    """)
+    with get_engine().connect() as conn:
+        df = pd.read_sql(sql, conn, params={"limit": limit})
+    return df
 
-    rows = []
-    for client_id in client_ids:
-        sent_at = now + timedelta(minutes=random.randint(-5, 5))
-        status, opened_at, clicked_at = _simulate_status(sent_at)
-        rows.append(
-            {
-                "campaign_id": campaign_id,
-                "client_id": client_id,
-                "sent_at": sent_at,
-                "status": status,
-                "opened_at": opened_at,
-                "clicked_at": clicked_at,
-            }
-        )
 
-    sql = text("""
-        INSERT INTO campaign_clients
+def _simulated_frame(campaign_id: int, client_ids: list[int]) -> pd.DataFrame:
+    """Сымитировать отправку и вернуть колонки campaign_clients одним DataFrame."""
+    frame = simulate_sends(len(client_ids), datetime.now(timezone.utc), LIVE_SEND)
+    frame.insert(0, "campaign_id", campaign_id)
+    frame.insert(1, "client_id", np.asarray(client_ids, dtype=np.int64))
+    return frame[list(CAMPAIGN_CLIENTS_COLUMNS)]
+
+
+def _insert_campaign_clients(conn, frame: pd.DataFrame) -> int:
+    """Вставить строки в staging-таблицу обычным executemany (для небольших рассылок)."""
+    if frame.empty:
+        return 0
+
+    params = frame.astype(object).where(frame.notna(), None).to_dict("records")
+
+    sql = text(f"""
+        INSERT INTO {rollups.STAGE_TABLE}
             (campaign_id, client_id, sent_at, status, opened_at, clicked_at)
         VALUES
             (:campaign_id, :client_id, :sent_at, :status, :opened_at, :clicked_at)
     """)
+    conn.execute(sql, params)
+    return len(params)
+
+
+def _copy_campaign_clients(conn, frame: pd.DataFrame) -> int:
+    """Залить строки в staging-таблицу через COPY FROM STDIN порциями по COPY_CHUNK_ROWS."""
+    with conn.connection.cursor() as cur:
+        return copy_frame(
+            cur,
+            rollups.STAGE_TABLE,
+            frame,
+            CAMPAIGN_CLIENTS_COLUMNS,
+            chunk_rows=COPY_CHUNK_ROWS,
+        )
+
+
+def _publish_stage(conn) -> int:
+    """
+    Перенести строки из staging-таблицы в campaign_clients одним INSERT ... SELECT
+    и добавить их агрегаты в rollup-таблицы. Получатели сверх лимита частоты
+    (frequency_cap.py) перед этим отсекаются. Возвращает число строк.
+    """
+    frequency_cap.suppress_stage(conn)
+
+    result = conn.execute(text(f"""
+        INSERT INTO campaign_clients
+            (campaign_id, client_id, sent_at, status, opened_at, clicked_at)
+        SELECT campaign_id, client_id, sent_at, status, opened_at, clicked_at
+        FROM {rollups.STAGE_TABLE}
+    """))
+    rollups.apply_stage(conn)
+
+    return result.rowcount
+
+
+def _write_campaign_clients(conn, frame: pd.DataFrame, method: str) -> int:
+    """
+    Записать строки campaign_clients в текущей транзакции.
+
+    Строки загружаются во временную staging-таблицу (INSERT или COPY),
+    затем публикуются через _publish_stage().
+    """
+    conn.execute(text(rollups.CREATE_STAGE_SQL))
+
+    if not frame.empty:
+        with conn.connection.cursor() as cur:
+            ensure_month_partitions(cur, frame["sent_at"].min(), frame["sent_at"].max())
+
+    if method == "copy":
+        _copy_campaign_clients(conn, frame)
+    else:
+        _insert_campaign_clients(conn, frame)
+
+    return _publish_stage(conn)
+
+
+@timed
+def create_campaign_clients(
+    campaign_id: int,
+    client_ids: list[int],
+    method: str = "auto",
+) -> int:
+    """
+    Создать записи в campaign_clients для выбранных клиентов
+    и обновить агрегаты campaign_daily_stats и client_activity.
+
+    method:
+      "auto"   — COPY, если получателей больше COPY_THRESHOLD, иначе INSERT;
+      "insert" — executemany из одиночных INSERT;
+      "copy"   — потоковая загрузка через COPY FROM STDIN.
+    """
+    if method == "auto":
+        method = "copy" if len(client_ids) > COPY_THRESHOLD else "insert"
+    if method not in ("insert", "copy"):
+        raise ValueError(f"Unknown insert method: {method!r}")
+
+    frame = _simulated_frame(campaign_id, client_ids)
+
+    with get_engine().begin() as conn:
+        count = _write_campaign_clients(conn, frame, method)
+    if not frame.empty:
+        remember_month_partitions(frame["sent_at"].min(), frame["sent_at"].max())
+
+    invalidate(
+        "campaign_clients", "campaign_daily_stats", "client_activity",
+        "campaign_daily_sketches", "campaign_suppressions",
+    )
+    return count
+
+
+@timed
+def create_campaign_clients_for_audience(campaign_id: int, spec: AudienceSpec) -> int:
+    """
+    Создать получателей кампании для всей аудитории одним INSERT ... SELECT.
+
+    Выборка клиентов и симуляция статусов выполняются в БД,
+    id клиентов в Python не загружаются. Возвращает число получателей.
+    """
+    source, params = audience_source_sql(spec)
+
+    with get_engine().begin() as conn:
+        conn.execute(text(rollups.CREATE_STAGE_SQL))
+
+        # sent_at считается от now (UTC) с разбросом в несколько минут,
+        # тот же момент передаётся в SQL как :sent_base
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        with conn.connection.cursor() as cur:
+            ensure_month_partitions(cur, now - timedelta(days=1), now + timedelta(days=1))
+
+        conn.execute(
+            text(f"""
+                INSERT INTO {rollups.STAGE_TABLE}
+                    (campaign_id, client_id, sent_at, status, opened_at, clicked_at)
+                SELECT :campaign_id, o.client_id, o.sent_at, o.status, o.opened_at, o.clicked_at
+                FROM ({simulate_sends_sql(source, LIVE_SEND)}) o
+            """),
+            {"campaign_id": campaign_id, "sent_base": now, **params},
+        )
+        count = _publish_stage(conn)
+    remember_month_partitions(now - timedelta(days=1), now + timedelta(days=1))
+
+    invalidate(
+        "campaign_clients", "campaign_daily_stats", "client_activity",
+        "campaign_daily_sketches", "campaign_suppressions",
+    )
+    return count
+
+
+@timed
+def create_planned_campaign_clients(
+    campaign_id: int,
+    spec: AudienceSpec,
+    planned_at: datetime | None = None,
+) -> int:
+    """
+    Создать получателей кампании в статусе PLANNED для реальной отправки (delivery.py).
+
+    sent_at — запланированное время (по умолчанию сейчас), delivery.py заменит
+    его фактическим временем отправки. В rollup-таблицы PLANNED-строки
+    не попадают. Клиенты сверх лимита частоты (frequency_cap.py) не создаются.
+    Возвращает число получателей.
+    """
+    source, params = audience_source_sql(spec)
+    planned_at = planned_at or datetime.now(timezone.utc).replace(tzinfo=None)
+
+    params = {"campaign_id": campaign_id, "planned_at": planned_at, **params}
+
+    with get_engine().begin() as conn:
+        with conn.connection.cursor() as cur:
+            ensure_month_partitions(cur, planned_at, planned_at)
+
+        # окно ограничения частоты — от planned_at, отсекаются строки capped этого же запроса
+        with_sql, not_suppressed = "", "TRUE"
+        if frequency_cap.enabled():
+            with_sql, cap_params = frequency_cap.suppression_ctes(
+                conn,
+                f"(SELECT :campaign_id AS campaign_id, src.client_id FROM ({source}) src) recipients",
+                planned_at,
+            )
+            params = {**params, **cap_params}
+            not_suppressed = "NOT EXISTS (SELECT 1 FROM capped x WHERE x.client_id = src.client_id)"
+
+        result = conn.execute(
+            text(f"""
+                {with_sql}
+                INSERT INTO campaign_clients (campaign_id, client_id, sent_at, status)
+                SELECT :campaign_id, src.client_id, :planned_at, 'PLANNED'
+                FROM ({source}) src
+                WHERE {not_suppressed}
+                ORDER BY src.client_id
+            """),
+            params,
+        )
+    remember_month_partitions(planned_at, planned_at)
+
+    invalidate("campaign_clients", "campaign_suppressions")
+    return result.rowcount
+
+
+@timed
+@cached("campaign_suppressions")
+def get_campaign_suppressions(campaign_id: int) -> pd.DataFrame:
+    """Клиенты, отсечённые ограничением частоты при создании получателей кампании."""
+    sql = text("""
+        SELECT client_id, reason, recent_sends, created_at
+        FROM campaign_suppressions
+        WHERE campaign_id = :campaign_id
+        ORDER BY client_id
+    """)
+    with get_engine().connect() as conn:
+        return pd.read_sql(sql, conn, params={"campaign_id": campaign_id})
 
-    with engine.begin() as conn:
-        conn.execute(sql, rows)
 
-    return len(rows)
+@timed
+@cached("clients", "client_activity")
+def count_audience(spec: AudienceSpec) -> int:
+    """Точное число клиентов в аудитории (считается в БД)."""
+    where, params = audience_filter(spec)
+    sql = text(f"SELECT COUNT(*) {AUDIENCE_FROM_SQL} {where}")
 
+    with get_engine().connect() as conn:
+        return conn.execute(sql, params).scalar_one()
 
+
+@timed
+@cached("clients", "client_activity")
+def preview_audience(spec: AudienceSpec, limit: int = 20) -> pd.DataFrame:
+    """Первые limit клиентов аудитории (по id) для предпросмотра."""
+    where, params = audience_filter(spec)
+    sql = text(f"""
+        SELECT cl.id, cl.full_name, cl.email, cl.gender, cl.segment,
+               a.last_sent_at, a.last_activity_at
+        {AUDIENCE_FROM_SQL}
+        {where}
+        ORDER BY cl.id
+        LIMIT :limit
+    """)
+
+    with get_engine().connect() as conn:
+        df = pd.read_sql(sql, conn, params={**params, "limit": limit})
+    return df
+
+
+@timed
+@cached("clients")
+def get_audience_options() -> dict[str, list[str]]:
+    """Возможные значения сегмента и пола для фильтров аудитории."""
+    sql = text("""
+        SELECT 'segment' AS field, segment AS value
+        FROM (SELECT DISTINCT segment FROM clients WHERE segment IS NOT NULL) s
+        UNION ALL
+        SELECT 'gender', gender
+        FROM (SELECT DISTINCT gender FROM clients WHERE gender IS NOT NULL) g
+        ORDER BY 1, 2
+    """)
+
+    with get_engine().connect() as conn:
+        rows = conn.execute(sql).all()
+
+    options = {"segment": [], "gender": []}
+    for field, value in rows:
+        options[field].append(value)
+    return options
+
+
+@timed
+@cached("campaign_clients", "clients")
+def get_campaign_recipients(
+    campaign_id: int,
+    limit: int = 100,
+    after: tuple[datetime, int] | None = None,
+) -> pd.DataFrame:
+    """
+    Страница получателей кампании в порядке (sent_at, id) после ключа after —
+    (sent_at, id) последней строки предыдущей страницы (keyset, без OFFSET).
+    """
+    after_sql = "AND (cc.sent_at, cc.id) > (:after_sent_at, :after_id)" if after else ""
+    sql = text(f"""
+        SELECT cl.id AS client_id, cl.full_name, cl.email, cl.segment, cc.status,
+               cc.sent_at, cc.id AS send_id
+        FROM campaign_clients cc
+        JOIN clients cl ON cl.id = cc.client_id
+        WHERE cc.campaign_id = :campaign_id
+          {after_sql}
+        ORDER BY cc.sent_at, cc.id
+        LIMIT :limit
+    """)
+    params = {"campaign_id": campaign_id, "limit": limit}
+    if after:
+        params["after_sent_at"], params["after_id"] = after
+
+    with get_engine().connect() as conn:
+        df = pd.read_sql(sql, conn, params=params)
+    return df
+
+
+@timed
+@cached("campaigns")
 def get_campaigns() -> pd.DataFrame:
     """Вернуть список кампаний (для аналитики)"""
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql("SELECT * FROM campaigns ORDER BY created_at DESC", conn)
     return df
 
+@timed
+@cached("campaign_clients", "campaigns", "clients")
 def get_campaign_clients_joined() -> pd.DataFrame:
     """
     Возвращает отправки писем с присоединёнными данными кампаний и клиентов.
@@ -147,60 +649,474 @@ def get_campaign_clients_joined() -> pd.DataFrame:
         JOIN campaigns c ON cc.campaign_id = c.id
         JOIN clients   cl ON cc.client_id   = cl.id
     """
-    with engine.connect() as conn:
+    with get_engine("analytics").connect() as conn:
         df = pd.read_sql(sql, conn)
     return df
 
+# Колонки отправки с присоединёнными данными кампании и клиента
+SEND_COLUMNS = {
+    "cc_id": "cc.id",
+    "campaign_id": "cc.campaign_id",
+    "client_id": "cc.client_id",
+    "sent_at": "cc.sent_at",
+    "send_status": "cc.status",
+    "opened_at": "cc.opened_at",
+    "clicked_at": "cc.clicked_at",
+    "campaign_name": "c.name",
+    "campaign_status": "c.status",
+    "gender": "cl.gender",
+    "segment": "cl.segment",
+    "full_name": "cl.full_name",
+    "email": "cl.email",
+}
+
+# Что нужно странице аналитики (analytics.compute_metrics)
+ANALYTICS_SEND_COLUMNS = (
+    "campaign_id", "client_id", "sent_at", "send_status",
+    "opened_at", "clicked_at", "campaign_name", "gender", "segment",
+)
+
+# Колонки с небольшим числом различных значений -> category
+CATEGORY_COLUMNS = ("send_status", "campaign_name", "campaign_status", "gender", "segment")
+ID_COLUMNS = ("cc_id", "campaign_id", "client_id")
+TIMESTAMP_COLUMNS = ("sent_at", "opened_at", "clicked_at")
+
+LOAD_CHUNK_ROWS = int(os.getenv("LOAD_CHUNK_ROWS", "100000"))
+
+
+@dataclass(frozen=True)
+class LoadReport:
+    """
+    Сводка по загрузке load_sends_frame().
+
+    raw_bytes     — сколько занимали бы те же строки в виде, как их отдаёт
+                    pd.read_sql (object-строки, int64), т.е. без компактных типов;
+    peak_bytes    — оценка пика: уже сжатые куски + текущий сырой кусок
+                    + итоговая склейка;
+    result_bytes  — размер итогового DataFrame.
+    """
+
+    rows: int
+    chunks: int
+    raw_bytes: int
+    peak_bytes: int
+    result_bytes: int
+    seconds: float
+
+    @property
+    def reduction(self) -> float:
+        """Во сколько раз итоговый кадр меньше несжатого."""
+        return self.raw_bytes / self.result_bytes if self.result_bytes else 0.0
+
+
+def _frame_bytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _compact_chunk(chunk: pd.DataFrame) -> pd.DataFrame:
+    """Привести кусок к компактным типам: category, int32, datetime64."""
+    for column in chunk.columns:
+        if column in CATEGORY_COLUMNS:
+            chunk[column] = chunk[column].astype("category")
+        elif column in ID_COLUMNS:
+            # id в БД — int (serial), значения помещаются в int32
+            chunk[column] = chunk[column].astype(np.int32)
+        elif column in TIMESTAMP_COLUMNS and chunk[column].dtype == object:
+            # пустые колонки приходят как object из None
+            chunk[column] = pd.to_datetime(chunk[column])
+    return chunk
+
+
+def _concat_compact(chunks: list[pd.DataFrame], columns: list[str]) -> pd.DataFrame:
+    """
+    Склеить куски, сохранив category: у кусков разные наборы категорий,
+    и обычный pd.concat превратил бы такие колонки обратно в object.
+    """
+    if not chunks:
+        return _compact_chunk(pd.DataFrame({c: pd.Series(dtype=object) for c in columns}))
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+
+    data = {}
+    for column in columns:
+        parts = [chunk[column] for chunk in chunks]
+        if isinstance(parts[0].dtype, pd.CategoricalDtype):
+            data[column] = pd.Series(
+                union_categoricals([p.array for p in parts]), name=column,
+            )
+        else:
+            data[column] = pd.concat(parts, ignore_index=True)
+        for chunk in chunks:
+            # освобождаем колонку кусков сразу, а не после склейки всего кадра
+            del chunk[column]
+    return pd.DataFrame(data)
+
+
+@timed
+def load_sends_frame(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    columns: tuple[str, ...] = ANALYTICS_SEND_COLUMNS,
+    chunksize: int = LOAD_CHUNK_ROWS,
+) -> tuple[pd.DataFrame, LoadReport]:
+    """
+    Загрузить отправки (как get_campaign_clients_joined) в компактном виде.
+
+    Строки читаются кусками через серверный курсор (stream_results), каждый
+    кусок сразу сжимается: статусы, названия кампаний, пол и сегмент — category,
+    id — int32, даты — datetime64. Лишние колонки (email, full_name и т.п.)
+    не запрашиваются, JOIN к campaigns / clients добавляется только если
+    нужны их колонки. Фильтры по кампаниям и дате отправки (включительно)
+    применяются в SQL.
+
+    Возвращает DataFrame и LoadReport с оценкой пикового объёма памяти.
+    """
+    unknown = set(columns) - set(SEND_COLUMNS)
+    if unknown:
+        raise ValueError(f"Неизвестные колонки: {sorted(unknown)}")
+
+    select = ",\n            ".join(f"{SEND_COLUMNS[c]} AS {c}" for c in columns)
+    tables = {SEND_COLUMNS[c].split(".")[0] for c in columns}
+    joins = ""
+    if "c" in tables:
+        joins += "\n        JOIN campaigns c ON cc.campaign_id = c.id"
+    if "cl" in tables:
+        joins += "\n        JOIN clients   cl ON cc.client_id   = cl.id"
+
+    conditions = []
+    params = {}
+    if campaign_ids:
+        conditions.append("cc.campaign_id = ANY(:campaign_ids)")
+        params["campaign_ids"] = [int(cid) for cid in campaign_ids]
+    if date_from is not None:
+        conditions.append("cc.sent_at >= :date_from")
+        params["date_from"] = date_from
+    if date_to is not None:
+        conditions.append("cc.sent_at < :date_to_excl")
+        params["date_to_excl"] = date_to + timedelta(days=1)
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+
+    sql = text(f"""
+        SELECT
+            {select}
+        FROM campaign_clients cc{joins}
+        {where}
+    """)
+
+    started = time.perf_counter()
+    chunks = []
+    raw_bytes = peak_bytes = kept_bytes = rows = 0
+
+    with get_engine("analytics").connect() as conn:
+        conn = conn.execution_options(stream_results=True, max_row_buffer=chunksize)
+        for chunk in pd.read_sql(sql, conn, params=params, chunksize=chunksize):
+            chunk_bytes = _frame_bytes(chunk)
+            raw_bytes += chunk_bytes
+            peak_bytes = max(peak_bytes, kept_bytes + chunk_bytes)
+
+            chunk = _compact_chunk(chunk)
+            kept_bytes += _frame_bytes(chunk)
+            rows += len(chunk)
+            chunks.append(chunk)
+
+    n_chunks = len(chunks)
+    df = _concat_compact(chunks, list(columns))
+    result_bytes = _frame_bytes(df)
+    # во время склейки живут и куски, и итоговый кадр
+    peak_bytes = max(peak_bytes, kept_bytes + result_bytes)
+
+    report = LoadReport(
+        rows=rows,
+        chunks=n_chunks,
+        raw_bytes=raw_bytes,
+        peak_bytes=peak_bytes,
+        result_bytes=result_bytes,
+        seconds=time.perf_counter() - started,
+    )
+    return df, report
+
+
+def _stats_filter(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> tuple[str, dict]:
+    """Собрать WHERE-условие по campaign_daily_stats (алиас s) и параметры к нему."""
+    conditions = []
+    params = {}
+
+    if campaign_ids:
+        conditions.append("s.campaign_id = ANY(:campaign_ids)")
+        params["campaign_ids"] = [int(cid) for cid in campaign_ids]
+    if date_from is not None:
+        conditions.append("s.sent_date >= :date_from")
+        params["date_from"] = date_from
+    if date_to is not None:
+        conditions.append("s.sent_date <= :date_to")
+        params["date_to"] = date_to
+
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return where, params
+
+
+@timed
+@cached("campaign_daily_stats")
+def get_sent_date_bounds(
+    campaign_ids: list[int] | None = None,
+) -> tuple[date | None, date | None]:
+    """
+    Вернуть первую и последнюю дату отправки (по выбранным кампаниям).
+
+    MIN / MAX берутся по индексам campaign_daily_stats: по каждой
+    выбранной кампании — по первичному ключу (campaign_id, sent_date, ...),
+    без фильтра — по индексу sent_date. Читается по строке на границу.
+    """
+    if campaign_ids:
+        sql = text("""
+            SELECT MIN(b.min_date) AS min_date, MAX(b.max_date) AS max_date
+            FROM unnest(CAST(:campaign_ids AS int[])) AS c(id)
+            CROSS JOIN LATERAL (
+                SELECT
+                    (SELECT MIN(s.sent_date) FROM campaign_daily_stats s
+                     WHERE s.campaign_id = c.id) AS min_date,
+                    (SELECT MAX(s.sent_date) FROM campaign_daily_stats s
+                     WHERE s.campaign_id = c.id) AS max_date
+            ) b
+        """)
+        params = {"campaign_ids": [int(cid) for cid in campaign_ids]}
+    else:
+        sql = text("""
+            SELECT
+                (SELECT MIN(sent_date) FROM campaign_daily_stats) AS min_date,
+                (SELECT MAX(sent_date) FROM campaign_daily_stats) AS max_date
+        """)
+        params = {}
+
+    with get_engine("analytics").connect() as conn:
+        row = conn.execute(sql, params).one()
+
+    return row.min_date, row.max_date
+
+
+def sends_filter(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> tuple[str, dict]:
+    """
+    WHERE-условие по campaign_clients (алиас cc): кампании и период отправки
+    (даты включительно) как предикаты на campaign_id и sent_at, чтобы
+    работали индексы и отсечение месячных секций.
+    """
+    conditions = []
+    params = {}
+
+    if campaign_ids and len(campaign_ids) == 1:
+        # равенство, а не ANY: так индекс (campaign_id, sent_at, id) отдаёт строки уже по порядку
+        conditions.append("cc.campaign_id = :campaign_id")
+        params["campaign_id"] = int(campaign_ids[0])
+    elif campaign_ids:
+        conditions.append("cc.campaign_id = ANY(:campaign_ids)")
+        params["campaign_ids"] = [int(cid) for cid in campaign_ids]
+    if date_from is not None:
+        conditions.append("cc.sent_at >= :date_from")
+        params["date_from"] = date_from
+    if date_to is not None:
+        conditions.append("cc.sent_at < :date_to_next")
+        params["date_to_next"] = date_to + timedelta(days=1)
+
+    return " AND ".join(conditions) or "TRUE", params
+
+
+@timed
+@cached("campaign_clients", "campaigns", "clients")
+def get_sends_page(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    after: tuple[datetime, int] | None = None,
+    limit: int = 100,
+) -> tuple[pd.DataFrame, tuple[datetime, int] | None]:
+    """
+    Страница отправок по фильтрам, от новых к старым.
+
+    Keyset-пагинация по (sent_at, id): after — ключ последней строки
+    предыдущей страницы, каждая страница читается по индексу
+    (campaign_id, sent_at, id) или (sent_at, id) и стоит одинаково
+    независимо от номера. Возвращает (страница, ключ для следующей
+    страницы или None, если это последняя).
+    """
+    where, params = sends_filter(campaign_ids, date_from, date_to)
+    if after is not None:
+        where += " AND (cc.sent_at, cc.id) < (:after_sent_at, :after_id)"
+        params["after_sent_at"], params["after_id"] = after
+    params["limit"] = limit
+
+    sql = text(f"""
+        SELECT
+            cc.id,
+            cc.sent_at,
+            c.name        AS campaign_name,
+            cl.email,
+            cl.gender,
+            cl.segment,
+            cc.status,
+            cc.opened_at,
+            cc.clicked_at
+        FROM campaign_clients cc
+        JOIN campaigns c ON c.id = cc.campaign_id
+        JOIN clients cl ON cl.id = cc.client_id
+        WHERE {where}
+        ORDER BY cc.sent_at DESC, cc.id DESC
+        LIMIT :limit
+    """)
+
+    with get_engine("analytics").connect() as conn:
+        df = pd.read_sql(sql, conn, params=params)
+
+    cursor = None
+    if len(df) == limit:
+        last = df.iloc[-1]
+        cursor = (last["sent_at"].to_pydatetime(), int(last["id"]))
+    return df, cursor
+
+
+@timed
+@cached("campaign_daily_stats", "campaigns")
+def get_campaign_metrics(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> MetricsResult:
+    """
+    Посчитать метрики отправок на стороне БД одним запросом с GROUPING SETS.
+
+    Читается дневная rollup-таблица campaign_daily_stats, поэтому объём
+    работы пропорционален числу дней × кампаний, а не числу отправок.
+    Фильтры (кампании и период отправки, даты включительно) применяются в SQL,
+    в pandas приходят только небольшие агрегаты (см. analytics.MetricsResult).
+    """
+    where, params = _stats_filter(campaign_ids, date_from, date_to)
+
+    sql = text(f"""
+        SELECT
+            CASE
+                WHEN GROUPING(g.campaign_id) = 0 THEN 'campaign'
+                WHEN GROUPING(g.sent_date) = 0 THEN 'daily'
+                WHEN GROUPING(g.gender) = 0 THEN 'gender'
+                WHEN GROUPING(g.segment) = 0 THEN 'segment'
+                ELSE 'total'
+            END AS dim,
+            g.campaign_id,
+            g.campaign_name,
+            g.sent_date,
+            g.gender,
+            g.segment,
+            SUM(g.sent)    AS sent,
+            SUM(g.opened)  AS opened,
+            SUM(g.clicked) AS clicked
+        FROM (
+            SELECT
+                s.campaign_id,
+                c.name                  AS campaign_name,
+                s.sent_date,
+                NULLIF(s.gender, '')    AS gender,
+                NULLIF(s.segment, '')   AS segment,
+                s.sent,
+                s.opened,
+                s.clicked
+            FROM campaign_daily_stats s
+            JOIN campaigns c ON s.campaign_id = c.id
+            {where}
+        ) g
+        GROUP BY GROUPING SETS (
+            (g.campaign_id, g.campaign_name),
+            (g.sent_date),
+            (g.gender),
+            (g.segment),
+            ()
+        )
+    """)
+
+    with get_engine("analytics").connect() as conn:
+        df = pd.read_sql(sql, conn, params=params)
+
+    def _part(dim: str) -> pd.DataFrame:
+        keys = DIMENSIONS[dim]
+        part = df.loc[df["dim"] == dim, keys + COUNT_COLUMNS].dropna(subset=keys)
+        if dim == "campaign":
+            part = part.astype({"campaign_id": "int64"})
+        return sort_table(dim, with_rates(part.reset_index(drop=True)))
+
+    total = with_rates(df.loc[df["dim"] == "total", COUNT_COLUMNS].reset_index(drop=True))
+    if total.empty:
+        total = with_rates(pd.DataFrame({c: [0] for c in COUNT_COLUMNS}))
+
+    return MetricsResult(total=total, **{dim: _part(dim) for dim in DIMENSIONS})
+
+
+@timed
+@cached("campaign_daily_sketches")
+def get_unique_reach(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> dict[str, int]:
+    """
+    Оценка числа уникальных клиентов по выбранным кампаниям и периоду:
+    {"reach": получили письмо, "openers": открыли}.
+
+    Скетчи кампаний-дней (campaign_daily_sketches) объединяются в памяти,
+    точность — sketches.error_bound() (±3.2% с вероятностью 95%).
+    """
+    where, params = _stats_filter(campaign_ids, date_from, date_to)
+    sql = text(f"""
+        SELECT s.kind, s.registers
+        FROM campaign_daily_sketches s
+        {where}
+    """)
+
+    with get_engine("analytics").connect() as conn:
+        rows = conn.execute(sql, params).all()
+
+    return {
+        kind: round(sketches.estimate(sketches.merge(r.registers for r in rows if r.kind == kind)))
+        for kind in sketches.SKETCH_KINDS
+    }
+
+
+@timed
+@cached("client_activity", "clients")
 def get_reactivation_candidates(inactive_days: int = 30) -> pd.DataFrame:
     """
     Вернуть клиентов, которые давно не проявляли активность
     (не открывали и не кликали письма inactive_days дней).
 
     inactive_days: сколько дней без активности считаем "уснувшим" клиентом.
+
+    Читается поддерживаемая таблица client_activity: клиент «уснул», если
+    последняя активность (а если её не было — последняя отправка) раньше
+    cutoff. Условие идёт по индексу client_activity_dormant_idx.
     """
     cutoff = datetime.now(timezone.utc) - timedelta(days=inactive_days)
 
     sql = text("""
-        WITH last_activity AS (
-            SELECT
-                c.id AS client_id,
-                MAX(cc.sent_at) AS last_sent_at,
-                MAX(
-                    COALESCE(cc.opened_at, cc.clicked_at)
-                ) AS last_activity_at
-            FROM clients c
-            LEFT JOIN campaign_clients cc ON cc.client_id = c.id
-            GROUP BY c.id
-        )
         SELECT
             c.id,
             c.full_name,
             c.email,
             c.gender,
             c.segment,
-            la.last_sent_at,
-            la.last_activity_at
-        FROM clients c
-        JOIN last_activity la ON la.client_id = c.id
-        WHERE
-            -- либо активности вообще не было, но что-то отправляли давно
-            (
-                la.last_activity_at IS NULL
-                AND la.last_sent_at IS NOT NULL
-                AND la.last_sent_at < :cutoff
-            )
-            OR
-            -- либо активность была, но давно
-            (
-                la.last_activity_at IS NOT NULL
-                AND la.last_activity_at < :cutoff
-            )
-        ORDER BY la.last_activity_at NULLS FIRST, la.last_sent_at
+            a.last_sent_at,
+            a.last_activity_at
+        FROM client_activity a
+        JOIN clients c ON c.id = a.client_id
+        WHERE COALESCE(a.last_activity_at, a.last_sent_at) < :cutoff
+        ORDER BY a.last_activity_at NULLS FIRST, a.last_sent_at
     """)
 
-    with engine.connect() as conn:
+    with get_engine().connect() as conn:
         df = pd.read_sql(sql, conn, params={"cutoff": cutoff})
 
     return df
-
-
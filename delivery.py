@@ -0,0 +1,587 @@
+"""
+Отправка писем кампании по SMTP на asyncio.
+
+Получатели кампании создаются в статусе PLANNED
+(db.create_planned_campaign_clients), delivery.deliver() отправляет им письма.
+deliver() (и "python delivery.py send") сначала захватывает кампанию так же,
+как планировщик (scheduler.claim_campaign: RUNNING, аренда, campaign_runs),
+и отказывается, если её уже отправляет другой процесс, — иначе получатели
+получили бы письмо дважды. deliver_async() — сам конвейер, без захвата,
+его вызывает планировщик для каждой пачки:
+
+  читатель     — страницы по DELIVERY_PAGE_ROWS получателей (keyset по id)
+                 в очередь на DELIVERY_QUEUE_SIZE писем; если отправка
+                 не успевает, чтение из БД ждёт (backpressure);
+  отправители  — SMTP_CONCURRENCY задач, у каждой своё SMTP-соединение;
+                 перед письмом берётся токен у ограничителя домена
+                 получателя (SMTP_DOMAIN_RATE писем в секунду на домен,
+                 отдельные лимиты — SMTP_DOMAIN_RATES="gmail.com=20,mail.ru=10");
+  писатель     — копит итоговые статусы и пишет их пачками по
+                 DELIVERY_BATCH_ROWS (или раз в DELIVERY_FLUSH_SECONDS) одним
+                 UPDATE; обновлённые строки в той же транзакции добавляются
+                 в rollup-таблицы. Очередь результатов тоже ограничена, так что
+                 медленная БД притормаживает отправителей.
+
+Отказ сервера с кодом 5xx — BOUNCED; так же помечаются адреса, которые
+нельзя записать в заголовок (не-ASCII до @, перевод строки, домен не
+переводится в IDNA). Домен с не-ASCII символами передаётся в punycode. Временные ошибки (4xx, разрыв
+соединения, таймаут) повторяются до SMTP_RETRIES раз, после чего письмо
+остаётся PLANNED и уйдёт при следующем запуске. sent_at получает фактическое
+время отправки.
+
+Без настоящего сервера — локальная заглушка на aiosmtpd (принимает всё,
+кроме доли адресов --bounce-rate, им отвечает 550):
+
+    python delivery.py stand-in --port 1025
+    SMTP_PORT=1025 python delivery.py send 42
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.header import Header
+from email.utils import formatdate, make_msgid
+from typing import NamedTuple
+
+import aiosmtplib
+from sqlalchemy import text
+
+import rollups
+from cache import invalidate
+from db import get_engine
+from migrations import ensure_month_partitions, remember_month_partitions
+from perf import timed
+from personalization import RECIPIENT_SELECT_SQL, CompiledTemplate, compiled_template
+
+
+SMTP_HOST = os.getenv("SMTP_HOST", "localhost")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "25"))
+SMTP_USERNAME = os.getenv("SMTP_USERNAME")
+SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
+# auto — STARTTLS, если сервер его предлагает
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "auto")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30"))
+SMTP_FROM = os.getenv("SMTP_FROM", "noreply@example.com")
+SMTP_CONCURRENCY = int(os.getenv("SMTP_CONCURRENCY", "20"))
+SMTP_RETRIES = int(os.getenv("SMTP_RETRIES", "3"))
+# писем в секунду на домен получателя; 0 — без ограничения
+SMTP_DOMAIN_RATE = float(os.getenv("SMTP_DOMAIN_RATE", "50"))
+SMTP_DOMAIN_RATES = os.getenv("SMTP_DOMAIN_RATES", "")
+
+DELIVERY_PAGE_ROWS = int(os.getenv("DELIVERY_PAGE_ROWS", "5000"))
+DELIVERY_QUEUE_SIZE = int(os.getenv("DELIVERY_QUEUE_SIZE", "2000"))
+DELIVERY_BATCH_ROWS = int(os.getenv("DELIVERY_BATCH_ROWS", "1000"))
+DELIVERY_FLUSH_SECONDS = float(os.getenv("DELIVERY_FLUSH_SECONDS", "1.0"))
+
+PLANNED, SENT, BOUNCED = "PLANNED", "SENT", "BOUNCED"
+
+# пауза перед повтором после временной ошибки (растёт с номером попытки)
+RETRY_BACKOFF_SECONDS = 0.5
+
+
+class Recipient(NamedTuple):
+    # первые колонки — personalization.RECIPIENT_COLUMNS
+    client_id: int
+    email: str
+    gender: str | None
+    name: str
+    segment: str
+    id: int
+    planned_at: datetime
+
+
+@dataclass(frozen=True)
+class DeliveryReport:
+    campaign_id: int
+    sent: int
+    bounced: int
+    # временные ошибки после всех повторов: остались PLANNED
+    deferred: int
+    seconds: float
+
+    @property
+    def messages_per_sec(self) -> float:
+        done = self.sent + self.bounced
+        return done / self.seconds if self.seconds > 0 else 0.0
+
+
+def parse_domain_rates(value: str) -> dict[str, float]:
+    """"gmail.com=20,mail.ru=10" -> {"gmail.com": 20.0, "mail.ru": 10.0}."""
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        domain, _, rate = item.partition("=")
+        rates[domain.strip().lower()] = float(rate)
+    return rates
+
+
+class DomainRateLimiter:
+    """
+    Token bucket на каждый домен получателя: rate писем в секунду,
+    всплеск — до burst писем. Работает в одном event loop, без блокировок.
+    """
+
+    def __init__(self, rate: float, overrides: dict[str, float] | None = None, burst: float = 1.0):
+        self.rate = rate
+        self.overrides = overrides or {}
+        self.burst = burst
+        # домен -> [токены, время последнего пополнения]
+        self._buckets: dict[str, list[float]] = {}
+
+    async def acquire(self, domain: str) -> None:
+        rate = self.overrides.get(domain, self.rate)
+        if rate <= 0:
+            return
+
+        loop = asyncio.get_running_loop()
+        bucket = self._buckets.setdefault(domain, [self.burst, loop.time()])
+        while True:
+            now = loop.time()
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+            await asyncio.sleep((1 - bucket[0]) / rate)
+
+
+def new_limiter() -> DomainRateLimiter:
+    """Ограничитель по доменам с лимитами из SMTP_DOMAIN_RATE / SMTP_DOMAIN_RATES."""
+    return DomainRateLimiter(SMTP_DOMAIN_RATE, parse_domain_rates(SMTP_DOMAIN_RATES))
+
+
+def smtp_address(email: str) -> str:
+    """
+    Адрес для заголовка To и конверта SMTP в ASCII: домен — в IDNA (punycode).
+    ValueError, если адрес так не записать (без SMTPUTF8 локальная часть
+    должна быть ASCII).
+    """
+    local, at, domain = email.strip().rpartition("@")
+    if not at or not local or not domain or any(c in email for c in "\r\n<>"):
+        raise ValueError(f"bad email address: {email!r}")
+    if not local.isascii():
+        raise ValueError(f"non-ASCII local part: {email!r}")
+    if not domain.isascii():
+        domain = domain.encode("idna").decode("ascii")
+    return f"{local}@{domain}"
+
+
+_FROM_DOMAIN = SMTP_FROM.rpartition("@")[2] or "localhost"
+
+
+def _subject_header(subject: str) -> bytes:
+    return f"Subject: {Header(subject, 'utf-8').encode()}\r\n".encode("ascii")
+
+
+def _header_block(template: CompiledTemplate) -> bytes:
+    """Общие для всех писем кампании заголовки (кодируются один раз)."""
+    headers = (
+        f"From: {SMTP_FROM}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        "Content-Transfer-Encoding: base64\r\n"
+    ).encode("ascii")
+    if template.static_subject is not None:
+        headers += _subject_header(template.static_subject)
+    return headers
+
+
+def render_message(
+    template: CompiledTemplate,
+    recipient: Recipient,
+    headers: bytes | None = None,
+    address: str | None = None,
+) -> bytes:
+    """
+    Письмо получателю в виде готовых байтов (тема и тело — personalization).
+    EmailMessage на каждое письмо не собирается: разбор заголовков
+    в нём дороже самой отправки. address — адрес из smtp_address()
+    (если не передан, вычисляется здесь; ValueError для неверного адреса).
+    """
+    subject, body = template.render(recipient)
+    address = address or smtp_address(recipient.email)
+    return b"".join((
+        headers or _header_block(template),
+        b"" if template.static_subject is not None else _subject_header(subject),
+        (
+            f"Date: {formatdate(usegmt=True)}\r\n"
+            f"Message-ID: {make_msgid(str(recipient.id), _FROM_DOMAIN)}\r\n"
+            f"To: {address}\r\n\r\n"
+        ).encode("ascii"),
+        base64.encodebytes(body.encode("utf-8")).replace(b"\n", b"\r\n"),
+    ))
+
+
+# ---------- БД (вызывается из потоков через asyncio.to_thread) ----------
+
+def _fetch_template(campaign_id: int) -> CompiledTemplate:
+    with get_engine().connect() as conn:
+        row = conn.execute(
+            text("""
+                SELECT t.id, t.version, t.subject, t.body_male, t.body_female
+                FROM campaigns c
+                JOIN templates t ON t.id = c.template_id
+                WHERE c.id = :campaign_id
+            """),
+            {"campaign_id": campaign_id},
+        ).one_or_none()
+    if row is None:
+        raise ValueError(f"Campaign {campaign_id} not found")
+    return compiled_template(*row)
+
+
+def _fetch_planned(
+    campaign_id: int, after_id: int, limit: int, until_id: int | None = None
+) -> list[Recipient]:
+    """Следующая страница PLANNED-получателей кампании (keyset по id, id <= until_id)."""
+    with get_engine().connect() as conn:
+        rows = conn.execute(
+            text(f"""
+                SELECT {RECIPIENT_SELECT_SQL}, cc.id, cc.sent_at
+                FROM campaign_clients cc
+                JOIN clients cl ON cl.id = cc.client_id
+                WHERE cc.campaign_id = :campaign_id
+                  AND cc.status = 'PLANNED'
+                  AND cc.id > :after_id
+                  AND (CAST(:until_id AS int) IS NULL OR cc.id <= :until_id)
+                ORDER BY cc.id
+                LIMIT :limit
+            """),
+            {"campaign_id": campaign_id, "after_id": after_id, "limit": limit, "until_id": until_id},
+        ).all()
+    return [Recipient(*row) for row in rows]
+
+
+def write_statuses(results: list[tuple[Recipient, str, datetime]]) -> int:
+    """
+    Записать итоговые статусы одной транзакцией и добавить строки в rollup-таблицы.
+
+    Обновляются только строки, которые всё ещё PLANNED, поэтому повторная
+    запись той же пачки ничего не задвоит. Возвращает число обновлённых строк.
+    """
+    if not results:
+        return 0
+    sent_times = [sent_at for _, _, sent_at in results]
+
+    with get_engine().begin() as conn:
+        conn.execute(text(rollups.CREATE_STAGE_SQL))
+        with conn.connection.cursor() as cur:
+            ensure_month_partitions(cur, min(sent_times), max(sent_times))
+
+        # sent_at — ключ секционирования: условие по старому значению
+        # отсекает секции, строка при необходимости переезжает в новую
+        result = conn.execute(
+            text(f"""
+                WITH batch AS (
+                    SELECT *
+                    FROM unnest(
+                        CAST(:ids AS int[]),
+                        CAST(:planned AS timestamp[]),
+                        CAST(:statuses AS varchar[]),
+                        CAST(:sent AS timestamp[])
+                    ) AS b(id, planned_at, status, sent_at)
+                ),
+                delivered AS (
+                    UPDATE campaign_clients cc
+                    SET status = b.status, sent_at = b.sent_at
+                    FROM batch b
+                    WHERE cc.id = b.id
+                      AND cc.sent_at = b.planned_at
+                      AND cc.status = 'PLANNED'
+                    RETURNING cc.campaign_id, cc.client_id, cc.sent_at, cc.status,
+                              cc.opened_at, cc.clicked_at
+                )
+                INSERT INTO {rollups.STAGE_TABLE}
+                    (campaign_id, client_id, sent_at, status, opened_at, clicked_at)
+                SELECT campaign_id, client_id, sent_at, status, opened_at, clicked_at
+                FROM delivered
+            """),
+            {
+                "ids": [r.id for r, _, _ in results],
+                "planned": [r.planned_at for r, _, _ in results],
+                "statuses": [status for _, status, _ in results],
+                "sent": sent_times,
+            },
+        )
+        rollups.apply_stage(conn)
+    remember_month_partitions(min(sent_times), max(sent_times))
+
+    invalidate("campaign_clients", "campaign_daily_stats", "client_activity", "campaign_daily_sketches")
+    return result.rowcount
+
+
+# ---------- конвейер ----------
+
+async def _connect() -> aiosmtplib.SMTP:
+    start_tls = None if SMTP_STARTTLS == "auto" else SMTP_STARTTLS == "1"
+    smtp = aiosmtplib.SMTP(
+        hostname=SMTP_HOST, port=SMTP_PORT, timeout=SMTP_TIMEOUT, start_tls=start_tls
+    )
+    await smtp.connect()
+    if SMTP_USERNAME:
+        await smtp.login(SMTP_USERNAME, SMTP_PASSWORD or "")
+    return smtp
+
+
+async def _reader(
+    campaign_id: int, queue: asyncio.Queue, senders: int, id_range: tuple[int, int] | None
+) -> None:
+    after_id, until_id = (id_range[0] - 1, id_range[1]) if id_range else (0, None)
+    while True:
+        page = await asyncio.to_thread(
+            _fetch_planned, campaign_id, after_id, DELIVERY_PAGE_ROWS, until_id
+        )
+        for recipient in page:
+            await queue.put(recipient)
+        if len(page) < DELIVERY_PAGE_ROWS:
+            break
+        after_id = page[-1].id
+    for _ in range(senders):
+        await queue.put(None)
+
+
+async def _sender(
+    template: CompiledTemplate,
+    queue: asyncio.Queue,
+    results: asyncio.Queue,
+    limiter: DomainRateLimiter,
+    counts: dict[str, int],
+) -> None:
+    headers = _header_block(template)
+    smtp = None
+    try:
+        while (recipient := await queue.get()) is not None:
+            try:
+                address = smtp_address(recipient.email)
+            except ValueError:
+                # такой адрес не отправить: помечаем письмо, а не роняем запуск
+                counts[BOUNCED] += 1
+                await results.put((recipient, BOUNCED, datetime.now(timezone.utc).replace(tzinfo=None)))
+                continue
+            message = render_message(template, recipient, headers, address)
+            await limiter.acquire(address.rpartition("@")[2].lower())
+
+            status = None
+            for attempt in range(SMTP_RETRIES + 1):
+                if attempt:
+                    await asyncio.sleep(RETRY_BACKOFF_SECONDS * attempt)
+                try:
+                    if smtp is None or not smtp.is_connected:
+                        smtp = await _connect()
+                    await smtp.sendmail(SMTP_FROM, [address], message)
+                    status = SENT
+                except aiosmtplib.SMTPRecipientsRefused as exc:
+                    if all(r.code >= 500 for r in exc.recipients):
+                        status = BOUNCED
+                except aiosmtplib.SMTPResponseException as exc:
+                    if exc.code >= 500:
+                        status = BOUNCED
+                    elif exc.code == 421:
+                        # сервер закрывает соединение
+                        smtp.close()
+                except (aiosmtplib.SMTPException, OSError):
+                    if smtp is not None:
+                        smtp.close()
+                    smtp = None
+                if status is not None:
+                    break
+
+            if status is None:
+                counts["deferred"] += 1
+                continue
+            counts[status] += 1
+            sent_at = datetime.now(timezone.utc).replace(tzinfo=None)
+            await results.put((recipient, status, sent_at))
+    finally:
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+
+
+async def _writer(results: asyncio.Queue) -> None:
+    """Писать статусы пачками; None в очереди — сбросить остаток и выйти."""
+    loop = asyncio.get_running_loop()
+    batch = []
+    deadline = loop.time() + DELIVERY_FLUSH_SECONDS
+    done = False
+    try:
+        while not done:
+            try:
+                item = await asyncio.wait_for(results.get(), max(0.0, deadline - loop.time()))
+            except TimeoutError:
+                item = ()
+            if item is None:
+                done = True
+            elif item:
+                batch.append(item)
+
+            if batch and (done or len(batch) >= DELIVERY_BATCH_ROWS or loop.time() >= deadline):
+                pending, batch = batch, []
+                await asyncio.to_thread(write_statuses, pending)
+            if loop.time() >= deadline:
+                deadline = loop.time() + DELIVERY_FLUSH_SECONDS
+    except asyncio.CancelledError:
+        # конвейер остановлен ошибкой: отправленное всё равно записываем,
+        # иначе эти письма уйдут повторно при следующем запуске
+        while not results.empty():
+            item = results.get_nowait()
+            if item:
+                batch.append(item)
+        write_statuses(batch)
+        raise
+
+
+async def _close_results(senders: list[asyncio.Task], results: asyncio.Queue) -> None:
+    await asyncio.gather(*senders)
+    await results.put(None)
+
+
+async def deliver_async(
+    campaign_id: int,
+    concurrency: int = SMTP_CONCURRENCY,
+    id_range: tuple[int, int] | None = None,
+    limiter: DomainRateLimiter | None = None,
+) -> DeliveryReport:
+    """
+    Отправить письма PLANNED-получателям кампании.
+
+    id_range=(first_id, last_id) — только получатели с campaign_clients.id
+    в этом диапазоне (пачка планировщика). Общий limiter нужен, когда
+    несколько вызовов идут параллельно в одном event loop: лимиты по доменам
+    тогда соблюдаются для всех пачек вместе.
+    """
+    started = time.perf_counter()
+    template = await asyncio.to_thread(_fetch_template, campaign_id)
+    if limiter is None:
+        limiter = new_limiter()
+    queue = asyncio.Queue(maxsize=DELIVERY_QUEUE_SIZE)
+    results = asyncio.Queue(maxsize=2 * DELIVERY_BATCH_ROWS)
+    counts = {SENT: 0, BOUNCED: 0, "deferred": 0}
+
+    async with asyncio.TaskGroup() as group:
+        group.create_task(_writer(results))
+        group.create_task(_reader(campaign_id, queue, concurrency, id_range))
+        senders = [
+            group.create_task(_sender(template, queue, results, limiter, counts))
+            for _ in range(concurrency)
+        ]
+        group.create_task(_close_results(senders, results))
+
+    return DeliveryReport(
+        campaign_id=campaign_id,
+        sent=counts[SENT],
+        bounced=counts[BOUNCED],
+        deferred=counts["deferred"],
+        seconds=time.perf_counter() - started,
+    )
+
+
+class CampaignBusy(Exception):
+    """Кампанию уже отправляет другой процесс (планировщик или delivery.py send)."""
+
+
+@timed
+def deliver(campaign_id: int, concurrency: int = SMTP_CONCURRENCY) -> DeliveryReport:
+    """
+    Отправить PLANNED-получателям кампании из CLI и приложения: кампания
+    захватывается как в планировщике и отправляется одним воркером.
+    CampaignBusy, если её держит другой запуск.
+    """
+    # scheduler импортирует delivery, поэтому импорт здесь
+    import scheduler
+
+    claim = scheduler.claim_campaign(campaign_id)
+    if claim is None:
+        raise CampaignBusy(f"Кампания {campaign_id} уже отправляется или не найдена")
+    report = asyncio.run(scheduler.run_campaign(claim, workers=1, concurrency=concurrency))
+    if report.error:
+        raise RuntimeError(f"Кампания {campaign_id}: {report.error}")
+    return DeliveryReport(
+        campaign_id=campaign_id,
+        sent=report.sent,
+        bounced=report.bounced,
+        deferred=report.deferred,
+        seconds=report.seconds,
+    )
+
+
+# ---------- локальная заглушка SMTP ----------
+
+class StandInHandler:
+    """Обработчик aiosmtpd: принимает письма, доле адресов отвечает 550."""
+
+    def __init__(self, bounce_rate: float = 0.0):
+        self.bounce_rate = bounce_rate
+        self.received = 0
+        self.refused = 0
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        # доля отказов детерминирована по адресу: повторный запуск даёт тот же результат
+        if zlib.crc32(address.encode()) % 10_000 < self.bounce_rate * 10_000:
+            self.refused += 1
+            return "550 5.1.1 Mailbox unavailable"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):
+        self.received += 1
+        return "250 Message accepted for delivery"
+
+
+def start_stand_in(host: str = "localhost", port: int = 1025, bounce_rate: float = 0.0):
+    """Запустить заглушку в отдельном потоке; возвращает aiosmtpd Controller (stop() — остановить)."""
+    from aiosmtpd.controller import Controller
+
+    controller = Controller(StandInHandler(bounce_rate), hostname=host, port=port)
+    controller.start()
+    return controller
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Отправка писем кампаний по SMTP")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send_parser = commands.add_parser("send", help="отправить PLANNED-получателям кампании")
+    send_parser.add_argument("campaign_id", type=int)
+    send_parser.add_argument("--concurrency", type=int, default=SMTP_CONCURRENCY)
+
+    stand_in_parser = commands.add_parser("stand-in", help="локальная заглушка SMTP (aiosmtpd)")
+    stand_in_parser.add_argument("--host", default="localhost")
+    stand_in_parser.add_argument("--port", type=int, default=1025)
+    stand_in_parser.add_argument("--bounce-rate", type=float, default=0.0)
+
+    args = parser.parse_args()
+
+    if args.command == "send":
+        try:
+            report = deliver(args.campaign_id, args.concurrency)
+        except CampaignBusy as exc:
+            raise SystemExit(str(exc))
+        print(
+            f"Кампания {report.campaign_id}: отправлено {report.sent}, "
+            f"отказов {report.bounced}, отложено {report.deferred} "
+            f"за {report.seconds:.1f} с ({report.messages_per_sec:,.0f} писем/с)"
+        )
+        return
+
+    controller = start_stand_in(args.host, args.port, args.bounce_rate)
+    print(f"Заглушка SMTP слушает {args.host}:{args.port}, Ctrl+C — остановить")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        controller.stop()
+        handler = controller.handler
+        print(f"Принято писем: {handler.received}, отказов: {handler.refused}")
+
+
+if __name__ == "__main__":
+    main()
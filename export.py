@@ -0,0 +1,284 @@
+"""
+Потоковая выгрузка отправок выбранных кампаний и периода в CSV или Parquet.
+
+В отличие от get_campaign_clients_joined(), строки не собираются
+в DataFrame целиком:
+
+  * CSV — COPY (SELECT ...) TO STDOUT WITH CSV HEADER: сервер сам формирует
+    CSV, строки пишутся в файл по мере прихода;
+  * Parquet — серверный курсор (stream_results), порции по EXPORT_CHUNK_ROWS
+    строк, каждая порция пишется отдельным row group'ом.
+
+В памяти одновременно находится не больше одной порции, при любом числе
+строк. Файл пишется во временный *.tmp с уникальным именем рядом с целевым
+и переименовывается в конце, поэтому недописанная выгрузка не оставляет
+битого файла, а две выгрузки в один путь не пишут в общий временный файл. Ход выгрузки передаётся
+в progress(строк, всего): «всего» — COUNT(*) по тому же фильтру
+(по индексам (campaign_id, sent_at, id) / (sent_at, id)).
+
+    python export.py --campaign 12 --from 2025-01-01 --to 2025-01-31 -o sends.parquet
+    python export.py --format csv -o all-sends.csv
+"""
+
+import argparse
+import os
+import re
+import sys
+import tempfile
+import time
+import uuid
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import date, datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+import db
+from perf import timed
+
+
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "100000"))
+# Куда приложение складывает выгрузки перед скачиванием
+EXPORT_DIR = os.getenv("EXPORT_DIR", tempfile.gettempdir())
+# Предел строк выгрузки из приложения: st.download_button держит файл в памяти,
+# большие выгрузки делаются из консоли (python export.py)
+EXPORT_APP_MAX_ROWS = int(os.getenv("EXPORT_APP_MAX_ROWS", "500000"))
+# Сколько секунд хранить выгрузки приложения (старые удаляются при следующей)
+EXPORT_KEEP_SECONDS = int(os.getenv("EXPORT_KEEP_SECONDS", "3600"))
+# Как часто вызывать progress при выгрузке CSV (строк)
+PROGRESS_EVERY_ROWS = 50_000
+
+FORMATS = ("csv", "parquet")
+
+# Имена выгрузок приложения (app_export_path); другие файлы EXPORT_DIR не трогаются
+_APP_EXPORT_NAME = re.compile(r"sends-\d{8}-\d{6}-[0-9a-f]{8}\.(csv|parquet)")
+
+# Колонки выгрузки: имена как в db.SEND_COLUMNS
+EXPORT_COLUMNS = (
+    "cc_id", "campaign_id", "campaign_name", "client_id", "email", "full_name",
+    "gender", "segment", "sent_at", "send_status", "opened_at", "clicked_at",
+)
+
+TIMESTAMP = pa.timestamp("us")
+EXPORT_SCHEMA = pa.schema([
+    ("cc_id", pa.int32()),
+    ("campaign_id", pa.int32()),
+    ("campaign_name", pa.string()),
+    ("client_id", pa.int32()),
+    ("email", pa.string()),
+    ("full_name", pa.string()),
+    ("gender", pa.string()),
+    ("segment", pa.string()),
+    ("sent_at", TIMESTAMP),
+    ("send_status", pa.string()),
+    ("opened_at", TIMESTAMP),
+    ("clicked_at", TIMESTAMP),
+])
+
+Progress = Callable[[int, int], None]
+
+
+@dataclass(frozen=True)
+class ExportReport:
+    """Итог выгрузки."""
+
+    path: str
+    format: str
+    rows: int
+    bytes: int
+    seconds: float
+
+
+def _export_sql(campaign_ids: list[int] | None, date_from: date | None, date_to: date | None) -> tuple[str, dict]:
+    select = ",\n            ".join(f"{db.SEND_COLUMNS[c]} AS {c}" for c in EXPORT_COLUMNS)
+    where, params = db.sends_filter(campaign_ids, date_from, date_to)
+    return f"""
+        SELECT
+            {select}
+        FROM campaign_clients cc
+        JOIN campaigns c ON cc.campaign_id = c.id
+        JOIN clients   cl ON cc.client_id   = cl.id
+        WHERE {where}
+    """, params
+
+
+def count_rows(campaign_ids: list[int] | None = None, date_from: date | None = None, date_to: date | None = None) -> int:
+    """Число строк выгрузки (для прогресса)."""
+    where, params = db.sends_filter(campaign_ids, date_from, date_to)
+    with db.get_engine("analytics").connect() as conn:
+        return conn.execute(text(f"SELECT COUNT(*) FROM campaign_clients cc WHERE {where}"), params).scalar_one()
+
+
+class ExportTooLarge(ValueError):
+    """Строк больше, чем разрешено выгружать (max_rows в export_sends)."""
+
+    def __init__(self, rows: int, max_rows: int):
+        super().__init__(f"{rows:,} строк при пределе {max_rows:,}".replace(",", " "))
+        self.rows = rows
+        self.max_rows = max_rows
+
+
+class _CountingWriter:
+    """Файл для COPY TO: считает строки и байты и сообщает о ходе выгрузки."""
+
+    def __init__(self, f, total: int, progress: Progress | None):
+        self._f = f
+        self._total = total
+        self._progress = progress
+        self._next_report = PROGRESS_EVERY_ROWS
+        self.rows = -1  # первая строка — заголовок
+        self.bytes = 0
+
+    def write(self, data: bytes) -> int:
+        self.rows += data.count(b"\n")
+        self.bytes += len(data)
+        if self._progress is not None and self.rows >= self._next_report:
+            self._progress(self.rows, self._total)
+            self._next_report = self.rows + PROGRESS_EVERY_ROWS
+        return self._f.write(data)
+
+
+def _export_csv(conn, sql: str, params: dict, tmp_path: str, total: int, progress: Progress | None) -> int:
+    # COPY не принимает параметры: запрос компилирует SQLAlchemy (как при
+    # conn.execute(text(...)), с экранированием %), значения подставляет драйвер
+    compiled = text(sql).bindparams(**params).compile(dialect=conn.dialect)
+    with conn.connection.cursor() as cur:
+        query = cur.mogrify(compiled.string, compiled.params).decode()
+        with open(tmp_path, "wb") as f:
+            writer = _CountingWriter(f, total, progress)
+            cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)", writer)
+    return writer.rows
+
+
+def _to_arrow(chunk: pd.DataFrame) -> pa.Table:
+    for field in EXPORT_SCHEMA:
+        # колонки из одних NULL приходят как object
+        if pa.types.is_timestamp(field.type) and chunk[field.name].dtype == object:
+            chunk[field.name] = pd.to_datetime(chunk[field.name])
+    return pa.Table.from_pandas(chunk, schema=EXPORT_SCHEMA, preserve_index=False)
+
+
+def _export_parquet(conn, sql: str, params: dict, tmp_path: str, total: int, progress: Progress | None) -> int:
+    conn = conn.execution_options(stream_results=True, max_row_buffer=EXPORT_CHUNK_ROWS)
+    rows = 0
+    with pq.ParquetWriter(tmp_path, EXPORT_SCHEMA) as writer:
+        for chunk in pd.read_sql(text(sql), conn, params=params, chunksize=EXPORT_CHUNK_ROWS):
+            writer.write_table(_to_arrow(chunk), row_group_size=EXPORT_CHUNK_ROWS)
+            rows += len(chunk)
+            if progress is not None:
+                progress(rows, total)
+    return rows
+
+
+@timed
+def export_sends(
+    path: str,
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    fmt: str | None = None,
+    progress: Progress | None = None,
+    max_rows: int | None = None,
+) -> ExportReport:
+    """
+    Выгрузить отправки кампаний campaign_ids за период [date_from, date_to]
+    (пустые фильтры — все) в файл path. Формат — fmt или по расширению файла.
+    Если строк больше max_rows — ExportTooLarge до начала выгрузки.
+    """
+    fmt = fmt or ("parquet" if path.endswith(".parquet") else "csv")
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt!r}")
+
+    started = time.perf_counter()
+    total = count_rows(campaign_ids, date_from, date_to)
+    if max_rows is not None and total > max_rows:
+        raise ExportTooLarge(total, max_rows)
+    if progress is not None:
+        progress(0, total)
+
+    sql, params = _export_sql(campaign_ids, date_from, date_to)
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+        delete=False,
+    ) as tmp:
+        tmp_path = tmp.name
+    try:
+        with db.get_engine("analytics").connect() as conn:
+            export = _export_csv if fmt == "csv" else _export_parquet
+            rows = export(conn, sql, params, tmp_path, total, progress)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    if progress is not None:
+        progress(rows, total)
+    return ExportReport(
+        path=path,
+        format=fmt,
+        rows=rows,
+        bytes=os.path.getsize(path),
+        seconds=time.perf_counter() - started,
+    )
+
+
+def remove_old_exports(max_age: float = EXPORT_KEEP_SECONDS) -> int:
+    """Удалить выгрузки приложения старше max_age секунд. Возвращает число удалённых."""
+    removed = 0
+    deadline = time.time() - max_age
+    with os.scandir(EXPORT_DIR) as entries:
+        for entry in entries:
+            if not _APP_EXPORT_NAME.fullmatch(entry.name):
+                continue
+            try:
+                if entry.stat().st_mtime < deadline:
+                    os.remove(entry.path)
+                    removed += 1
+            except FileNotFoundError:
+                # уже удалила другая сессия
+                pass
+    return removed
+
+
+def app_export_path(fmt: str) -> str:
+    """
+    Уникальный путь новой выгрузки приложения в EXPORT_DIR: сессии
+    не перезаписывают файлы друг друга. Заодно удаляет устаревшие выгрузки.
+    """
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    remove_old_exports()
+    return os.path.join(
+        EXPORT_DIR, f"sends-{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.{fmt}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Выгрузка отправок в CSV или Parquet")
+    parser.add_argument("-o", "--output", required=True, help="файл выгрузки (*.csv или *.parquet)")
+    parser.add_argument("--campaign", type=int, action="append", help="id кампании (можно несколько раз)")
+    parser.add_argument("--from", dest="date_from", type=date.fromisoformat, help="дата отправки с (YYYY-MM-DD)")
+    parser.add_argument("--to", dest="date_to", type=date.fromisoformat, help="дата отправки по, включительно")
+    parser.add_argument("--format", choices=FORMATS, help="по умолчанию — по расширению файла")
+    args = parser.parse_args()
+
+    def report_progress(rows: int, total: int) -> None:
+        share = f" ({rows / total:.0%})" if total else ""
+        print(f"\rВыгружено строк: {rows:,} из {total:,}{share}", end="", file=sys.stderr, flush=True)
+
+    report = export_sends(
+        args.output, args.campaign, args.date_from, args.date_to, args.format, report_progress,
+    )
+    print(file=sys.stderr)
+    print(
+        f"{report.path}: {report.rows:,} строк, {report.bytes / 2**20:.1f} МБ "
+        f"({report.format}) за {report.seconds:.1f} с"
+    )
+
+
+if __name__ == "__main__":
+    main()
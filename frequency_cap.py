@@ -0,0 +1,143 @@
+"""
+Ограничение частоты писем (frequency capping) при создании получателей.
+
+Правило: клиенту не больше FREQUENCY_CAP_SENDS писем за FREQUENCY_CAP_DAYS
+дней. Окно строится от времени создаваемой отправки (сейчас или planned_at
+запланированной кампании): учитываются строки campaign_clients с sent_at
+не дальше FREQUENCY_CAP_DAYS дней от него в обе стороны, в том числе
+BOUNCED и уже запланированные (PLANNED). 0 — ограничение выключено.
+
+Проверка выполняется для всего набора получателей сразу, одним запросом
+в той же транзакции, что и запись: получатели (DISTINCT campaign_id,
+client_id) соединяются с campaign_clients по индексу (client_id, sent_at)
+(миграция 003), sent_at отсекает старые месячные секции. Для небольшой
+рассылки это по одной короткой пробе индекса на получателя, для большой
+планировщик выбирает hash join по отправкам окна — стоимость ограничена
+объёмом окна, а не размером аудитории. Перед проверкой staging-таблица
+анализируется (ANALYZE), чтобы планировщик знал её размер.
+
+Отсечённые клиенты записываются в campaign_suppressions (кампания, клиент,
+причина, число писем в окне) и в campaign_clients не попадают; отчёт —
+db.get_campaign_suppressions(). Одновременные создания получателей
+при включённом ограничении выполняются по очереди (advisory lock до конца
+транзакции), иначе обе проверки не увидели бы письма друг друга.
+"""
+
+import os
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from rollups import STAGE_TABLE
+
+
+FREQUENCY_CAP_SENDS = int(os.getenv("FREQUENCY_CAP_SENDS", "0"))
+FREQUENCY_CAP_DAYS = int(os.getenv("FREQUENCY_CAP_DAYS", "7"))
+
+# Произвольный ключ pg_advisory_xact_lock (у миграций — 72_010_001)
+FREQUENCY_CAP_LOCK_ID = 72_010_002
+
+SUPPRESSION_REASON = "frequency_cap"
+
+CAMPAIGN_SUPPRESSIONS_DDL = """
+CREATE TABLE IF NOT EXISTS "campaign_suppressions" (
+  "campaign_id" int NOT NULL,
+  "client_id" int NOT NULL,
+  "reason" varchar NOT NULL,
+  "recent_sends" int NOT NULL,
+  "created_at" timestamp NOT NULL DEFAULT (now()),
+  PRIMARY KEY ("campaign_id", "client_id")
+);
+"""
+
+
+def enabled() -> bool:
+    """Ограничение включено, если FREQUENCY_CAP_SENDS больше 0."""
+    return FREQUENCY_CAP_SENDS > 0
+
+
+def _params(sent_at: datetime | None = None) -> dict:
+    sent_at = sent_at or datetime.now(timezone.utc).replace(tzinfo=None)
+    window = timedelta(days=FREQUENCY_CAP_DAYS)
+    return {
+        "cap_since": sent_at - window,
+        "cap_until": sent_at + window,
+        "cap_max_sends": FREQUENCY_CAP_SENDS,
+        "cap_reason": SUPPRESSION_REASON,
+    }
+
+
+def capped_sql(recipients: str) -> str:
+    """
+    Получатели из recipients (таблица или подзапрос с алиасом, колонки
+    campaign_id и client_id), у которых в окне уже не меньше
+    FREQUENCY_CAP_SENDS писем, с их числом.
+    """
+    return f"""
+        SELECT r.campaign_id, r.client_id, COUNT(*) AS recent_sends
+        FROM (SELECT DISTINCT campaign_id, client_id FROM {recipients}) r
+        JOIN campaign_clients cc
+          ON cc.client_id = r.client_id
+         AND cc.sent_at >= :cap_since
+         AND cc.sent_at < :cap_until
+        GROUP BY r.campaign_id, r.client_id
+        HAVING COUNT(*) >= :cap_max_sends
+    """
+
+
+def _lock(conn) -> None:
+    conn.execute(text("SELECT pg_advisory_xact_lock(:lock_id)"), {"lock_id": FREQUENCY_CAP_LOCK_ID})
+
+
+def _record_sql(capped: str) -> str:
+    return f"""
+        INSERT INTO campaign_suppressions
+            (campaign_id, client_id, reason, recent_sends)
+        SELECT campaign_id, client_id, :cap_reason, recent_sends
+        FROM {capped}
+        ON CONFLICT (campaign_id, client_id) DO UPDATE SET
+            reason       = EXCLUDED.reason,
+            recent_sends = EXCLUDED.recent_sends,
+            created_at   = now()
+    """
+
+
+def suppress_stage(conn) -> int:
+    """
+    Убрать из staging-таблицы (rollups.STAGE_TABLE) получателей сверх лимита
+    и записать их в campaign_suppressions. Возвращает число отсечённых.
+    """
+    if not enabled():
+        return 0
+
+    _lock(conn)
+    conn.execute(text(f"ANALYZE {STAGE_TABLE}"))
+    result = conn.execute(
+        text(f"""
+            WITH capped AS ({capped_sql(STAGE_TABLE)}),
+            removed AS (
+                DELETE FROM {STAGE_TABLE} st
+                USING capped c
+                WHERE st.campaign_id = c.campaign_id
+                  AND st.client_id = c.client_id
+            )
+            {_record_sql("capped")}
+        """),
+        _params(),
+    )
+    return result.rowcount
+
+
+def suppression_ctes(conn, recipients: str, sent_at: datetime) -> tuple[str, dict]:
+    """
+    WITH-часть для вставки получателей, которые отправляются в sent_at:
+    capped — получатели из recipients (см. capped_sql) сверх лимита,
+    suppressed — их запись в campaign_suppressions. Вызывающий дописывает
+    свой INSERT и исключает из него capped (отсечённые этим же запросом,
+    а не прошлыми попытками). Берёт блокировку; возвращает SQL и параметры.
+    """
+    _lock(conn)
+    return f"""
+        WITH capped AS ({capped_sql(recipients)}),
+        suppressed AS ({_record_sql("capped")})
+    """, _params(sent_at)
@@ -1,12 +1,30 @@
+import argparse
+import os
 import random
+import time
 from datetime import datetime, timedelta, timezone
 
 
+import pandas as pd
 import psycopg2
 from faker import Faker
 
+import datagen
+from bulk import copy_frame
+from migrations import ensure_month_partitions, migrate
+from rollups import CLIENT_ACTIVITY_BACKFILL_SQL, DAILY_STATS_BACKFILL_SQL, SKETCHES_BACKFILL_SQL
+from simulation import SEED_HISTORY, simulate_sends
+
 
 DDL_SQL = """
+DROP TABLE IF EXISTS "schema_migrations";
+DROP TABLE IF EXISTS "campaign_status_log";
+DROP TABLE IF EXISTS "campaign_runs";
+DROP TABLE IF EXISTS "campaign_suppressions";
+DROP TABLE IF EXISTS "campaign_daily_stats";
+DROP TABLE IF EXISTS "campaign_daily_sketches";
+DROP TABLE IF EXISTS "client_activity";
+DROP TABLE IF EXISTS "campaign_clients_legacy";
 DROP TABLE IF EXISTS "campaign_clients";
 DROP TABLE IF EXISTS "campaigns";
 DROP TABLE IF EXISTS "clients";
@@ -62,6 +80,44 @@ ALTER TABLE "campaign_clients" ADD FOREIGN KEY ("client_id") REFERENCES "clients
 ALTER TABLE "campaigns" ADD FOREIGN KEY ("template_id") REFERENCES "templates" ("id");
 """
 
+TEMPLATES_DATA = [
+    (
+        "WELCOME",
+        "Приветственное письмо",
+        "Добро пожаловать в наш сервис",
+        "Здравствуйте, {name}! Рады видеть вас среди наших клиентов.",
+        "Здравствуйте, {name}! Рады видеть вас среди наших клиенток.",
+    ),
+    (
+        "DISCOUNT",
+        "Персональная скидка 10%",
+        "Ваша персональная скидка 10%",
+        "{name}, для вас действует скидка 10% на следующий заказ.",
+        "{name}, для вас действует скидка 10% на следующий заказ.",
+    ),
+    (
+        "WINBACK",
+        "Мы по вам скучаем",
+        "Давно не заходили — вот бонус",
+        "{name}, мы давно вас не видели. Возвращайтесь и получите бонус.",
+        "{name}, мы давно вас не видели. Возвращайтесь и получите бонус.",
+    ),
+    (
+        "BIRTHDAY",
+        "Поздравление с днём рождения",
+        "С днём рождения!",
+        "{name}, поздравляем с днём рождения и дарим вам подарок.",
+        "{name}, поздравляем с днём рождения и дарим вам подарок.",
+    ),
+    (
+        "INFO",
+        "Обновления сервиса",
+        "Что нового в сервисе",
+        "{name}, рассказываем о новых возможностях нашего сервиса.",
+        "{name}, рассказываем о новых возможностях нашего сервиса.",
+    ),
+]
+
 
 def init_db():
     # ⚠️ Подставь свои параметры подключения
@@ -85,53 +141,21 @@ def init_db():
                 cur.execute(DDL_SQL)
                 print("Схема БД пересоздана.")
 
-                # ---------- TEMPLATES ----------
-                templates_data = [
-                    (
-                        "WELCOME",
-                        "Приветственное письмо",
-                        "Добро пожаловать в наш сервис",
-                        "Здравствуйте, {name}! Рады видеть вас среди наших клиентов.",
-                        "Здравствуйте, {name}! Рады видеть вас среди наших клиенток.",
-                    ),
-                    (
-                        "DISCOUNT",
-                        "Персональная скидка 10%",
-                        "Ваша персональная скидка 10%",
-                        "{name}, для вас действует скидка 10% на следующий заказ.",
-                        "{name}, для вас действует скидка 10% на следующий заказ.",
-                    ),
-                    (
-                        "WINBACK",
-                        "Мы по вам скучаем",
-                        "Давно не заходили — вот бонус",
-                        "{name}, мы давно вас не видели. Возвращайтесь и получите бонус.",
-                        "{name}, мы давно вас не видели. Возвращайтесь и получите бонус.",
-                    ),
-                    (
-                        "BIRTHDAY",
-                        "Поздравление с днём рождения",
-                        "С днём рождения!",
-                        "{name}, поздравляем с днём рождения и дарим вам подарок.",
-                        "{name}, поздравляем с днём рождения и дарим вам подарок.",
-                    ),
-                    (
-                        "INFO",
-                        "Обновления сервиса",
-                        "Что нового в сервисе",
-                        "{name}, рассказываем о новых возможностях нашего сервиса.",
-                        "{name}, рассказываем о новых возможностях нашего сервиса.",
-                    ),
-                ]
+        # Индексы, секционирование и агрегатные таблицы
+        migrate(conn)
+
+        with conn:
+            with conn.cursor() as cur:
 
+                # ---------- TEMPLATES ----------
                 cur.executemany(
                     """
                     INSERT INTO templates (type, name, subject, body_male, body_female)
                     VALUES (%s, %s, %s, %s, %s)
                     """,
-                    templates_data,
+                    TEMPLATES_DATA,
                 )
-                print("Добавлено шаблонов:", len(templates_data))
+                print("Добавлено шаблонов:", len(TEMPLATES_DATA))
 
                 # Получаем id шаблонов
                 cur.execute('SELECT id, type FROM templates ORDER BY id')
@@ -212,75 +236,107 @@ def init_db():
                 campaigns = cur.fetchall()
 
                 # CAMPAIGN_CLIENTS
-                campaign_clients_rows = []
+                recipient_campaign_ids = []
+                recipient_client_ids = []
+                recipient_base_times = []
 
                 for campaign_id, planned_at in campaigns:
                     # Кол-во получателей в кампании
                     num_recipients = random.randint(15, 30)
                     recipients = random.sample(client_ids, num_recipients)
 
-                    base_time = planned_at or now
-
-                    for client_id in recipients:
-                        sent_at = base_time + timedelta(
-                            minutes=random.randint(-60, 0)
-                        )
-
-                        r = random.random()
-                        # 0.0–0.2 → CLICKED (20%)
-                        # 0.2–0.8 → OPENED (60%)
-                        # 0.8–0.95 → SENT (15%)
-                        # 0.95–1.0 → BOUNCED (5%)
-                        if r < 0.2:
-                            status = "CLICKED"
-                            opened_at = sent_at + timedelta(
-                                minutes=random.randint(1, 30)
-                            )
-                            clicked_at = opened_at + timedelta(
-                                minutes=random.randint(1, 15)
-                            )
-                        elif r < 0.8:
-                            status = "OPENED"
-                            opened_at = sent_at + timedelta(
-                                minutes=random.randint(1, 60)
-                            )
-                            clicked_at = None
-                        elif r < 0.95:
-                            status = "SENT"
-                            opened_at = None
-                            clicked_at = None
-                        else:
-                            status = "BOUNCED"
-                            opened_at = None
-                            clicked_at = None
-
-                        campaign_clients_rows.append(
-                            (
-                                campaign_id,
-                                client_id,
-                                sent_at,
-                                status,
-                                opened_at,
-                                clicked_at,
-                            )
-                        )
+                    base_time = planned_at or now.replace(tzinfo=None)
 
-                cur.executemany(
-                    """
-                    INSERT INTO campaign_clients
-                        (campaign_id, client_id, sent_at, status, opened_at, clicked_at)
-                    VALUES (%s, %s, %s, %s, %s, %s)
-                    """,
-                    campaign_clients_rows,
+                    recipient_campaign_ids += [campaign_id] * num_recipients
+                    recipient_client_ids += recipients
+                    recipient_base_times += [base_time] * num_recipients
+
+                # Статусы и времена opened/clicked — векторная симуляция
+                # (20% CLICKED, 60% OPENED, 15% SENT, 5% BOUNCED)
+                campaign_clients_df = simulate_sends(
+                    len(recipient_client_ids),
+                    pd.DatetimeIndex(recipient_base_times),
+                    SEED_HISTORY,
+                    seed=42,
+                )
+                campaign_clients_df.insert(0, "campaign_id", recipient_campaign_ids)
+                campaign_clients_df.insert(1, "client_id", recipient_client_ids)
+
+                ensure_month_partitions(
+                    cur,
+                    campaign_clients_df["sent_at"].min(),
+                    campaign_clients_df["sent_at"].max(),
+                )
+                inserted = copy_frame(
+                    cur,
+                    "campaign_clients",
+                    campaign_clients_df,
+                    ["campaign_id", "client_id", "sent_at", "status", "opened_at", "clicked_at"],
+                )
+                print("Добавлено отправок (campaign_clients):", inserted)
+
+                # Агрегаты для аналитики и реактивации
+                cur.execute(DAILY_STATS_BACKFILL_SQL)
+                cur.execute(CLIENT_ACTIVITY_BACKFILL_SQL)
+                cur.execute(SKETCHES_BACKFILL_SQL)
+                print(
+                    "Пересчитаны таблицы campaign_daily_stats, client_activity "
+                    "и campaign_daily_sketches."
                 )
-                print("Добавлено отправок (campaign_clients):", len(campaign_clients_rows))
 
         print("Инициализация и заполнение БД завершены успешно.")
     finally:
         conn.close()
 
 
+def main() -> None:
+    """
+    Без аргументов — демо-наполнение init_db(). С размерами — массовое
+    наполнение для стендов и нагрузочных тестов (datagen.seed: пул процессов,
+    COPY, индексы строятся после заливки), подключение из DATABASE_URL:
+
+        python init_db.py --clients 1000000 --sends 10000000 --campaigns 500 --seed 7
+    """
+    parser = argparse.ArgumentParser(description="Создание схемы и наполнение БД")
+    parser.add_argument("--clients", type=int, help="число клиентов")
+    parser.add_argument("--sends", type=int, help="число строк campaign_clients")
+    parser.add_argument("--campaigns", type=int, help="число кампаний")
+    parser.add_argument("--days", type=int, default=365, help="глубина истории отправок")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-rows", type=int, default=datagen.CHUNK_ROWS)
+    args = parser.parse_args()
+
+    if args.clients is None and args.sends is None and args.campaigns is None:
+        init_db()
+        return
+
+    database_url = os.getenv("DATABASE_URL")
+    if not database_url:
+        raise SystemExit("DATABASE_URL is not set")
+    dsn = datagen.libpq_dsn(database_url)
+
+    clients, sends, campaigns = datagen.PRESETS["small"]
+    spec = datagen.DatasetSpec(
+        clients=args.clients or clients,
+        sends=args.sends if args.sends is not None else sends,
+        campaigns=args.campaigns or campaigns,
+        days=args.days,
+        seed=args.seed,
+    )
+
+    started = time.perf_counter()
+    conn = psycopg2.connect(dsn)
+    try:
+        datagen.reset_schema(conn)
+    finally:
+        conn.close()
+    print("Схема БД пересоздана.")
+    result = datagen.seed(dsn, spec, workers=args.workers, chunk_rows=args.chunk_rows)
+    print(f"Наполнение завершено за {time.perf_counter() - started:.1f} с:", result)
+
+
 if __name__ == "__main__":
-    init_db()
+    main()
 
 
@@ -0,0 +1,745 @@
+"""
+Версионированные миграции схемы БД.
+
+В отличие от init_db.py (который пересоздаёт схему с нуля), миграции
+не удаляют данные: каждый шаг идемпотентен, выполняется в отдельной
+транзакции под advisory-блокировкой и записывается в schema_migrations.
+
+    python migrations.py migrate              # применить недостающие шаги
+    python migrations.py status               # какие шаги применены
+    python migrations.py ensure-partitions    # создать месячные секции заранее
+    python migrations.py check-plans          # EXPLAIN основных запросов
+
+Функции принимают DB-API соединение / курсор psycopg2, поэтому работают
+и из init_db.py, и через db.get_engine().raw_connection().
+"""
+
+import argparse
+import json
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable
+
+from frequency_cap import CAMPAIGN_SUPPRESSIONS_DDL
+from rollups import (
+    CAMPAIGN_DAILY_STATS_DDL,
+    CLIENT_ACTIVITY_BACKFILL_SQL,
+    CLIENT_ACTIVITY_DDL,
+    DAILY_STATS_BACKFILL_SQL,
+    SKETCHES_BACKFILL_SQL,
+)
+from sketches import CAMPAIGN_DAILY_SKETCHES_DDL
+
+
+# Произвольный ключ pg_advisory_xact_lock для миграций
+MIGRATION_LOCK_ID = 72_010_001
+# Ключ для создания месячных секций (у frequency_cap — 72_010_002)
+PARTITION_LOCK_ID = 72_010_003
+
+# На сколько месяцев вперёд создавать секции campaign_clients
+PARTITION_MONTHS_AHEAD = 3
+
+SCHEMA_MIGRATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS "schema_migrations" (
+  "version" int PRIMARY KEY,
+  "name" varchar NOT NULL,
+  "applied_at" timestamp NOT NULL DEFAULT (now())
+);
+"""
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable
+
+
+# ---------- секционирование campaign_clients ----------
+
+DEFAULT_PARTITION = "campaign_clients_default"
+
+# Процесс запоминает уже существующие секции, чтобы не ходить в каталог
+# при каждой записи. Имена добавляет remember_month_partitions() только
+# после COMMIT: секция, созданная в откатившейся транзакции, в кэш не попадёт.
+_known_partitions: set[str] = set()
+
+
+def _month_start(value: datetime | date) -> date:
+    return date(value.year, value.month, 1)
+
+
+def _next_month(value: date) -> date:
+    return date(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"campaign_clients_y{month.year:04d}m{month.month:02d}"
+
+
+def is_partitioned(cur) -> bool:
+    cur.execute("""
+        SELECT c.relkind = 'p'
+        FROM pg_class c
+        WHERE c.oid = to_regclass('campaign_clients')
+    """)
+    row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def _create_month_partition(cur, month: date) -> None:
+    name = partition_name(month)
+    bounds = (month, _next_month(month))
+
+    # Строки этого месяца могли попасть в DEFAULT-секцию, тогда CREATE ... PARTITION OF
+    # упадёт; в этом случае переносим их в новую таблицу и подключаем её через ATTACH.
+    cur.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} "
+        "WHERE sent_at >= %s AND sent_at < %s)",
+        bounds,
+    )
+    if not cur.fetchone()[0]:
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF campaign_clients "
+            "FOR VALUES FROM (%s) TO (%s)",
+            bounds,
+        )
+        return
+
+    cur.execute(f"CREATE TABLE {name} (LIKE campaign_clients INCLUDING DEFAULTS)")
+    cur.execute(
+        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+        "WHERE sent_at >= %s AND sent_at < %s RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved",
+        bounds,
+    )
+    cur.execute(
+        f"ALTER TABLE campaign_clients ATTACH PARTITION {name} "
+        "FOR VALUES FROM (%s) TO (%s)",
+        bounds,
+    )
+
+
+def ensure_month_partitions(cur, start: datetime | date, end: datetime | date) -> list[str]:
+    """
+    Создать месячные секции campaign_clients, покрывающие [start, end].
+
+    Ничего не делает, если таблица ещё не секционирована.
+    Недостающие секции создаются под advisory-блокировкой до конца транзакции
+    с повторной проверкой каталога: две транзакции не создают одну секцию
+    (иначе вторая упала бы на CREATE TABLE или ATTACH PARTITION).
+    Возвращает имена созданных секций. Секции создаются в транзакции
+    вызывающего и в кэш процесса не попадают: после COMMIT вызовите
+    remember_month_partitions(start, end).
+    """
+    months = []
+    month = _month_start(start)
+    while month <= _month_start(end):
+        if partition_name(month) not in _known_partitions:
+            months.append(month)
+        month = _next_month(month)
+
+    if not months or not is_partitioned(cur):
+        return []
+
+    def missing() -> list[date]:
+        cur.execute(
+            "SELECT relname FROM pg_class WHERE relname = ANY(%s)",
+            ([partition_name(m) for m in months],),
+        )
+        existing = {row[0] for row in cur.fetchall()}
+        return [m for m in months if partition_name(m) not in existing]
+
+    if not missing():
+        return []
+
+    # Под блокировкой каталог читается заново: секцию могла создать
+    # транзакция, которая держала блокировку до нас
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (PARTITION_LOCK_ID,))
+    created = []
+    for month in missing():
+        _create_month_partition(cur, month)
+        created.append(partition_name(month))
+
+    return created
+
+
+def remember_month_partitions(start: datetime | date, end: datetime | date) -> None:
+    """
+    Запомнить, что секции [start, end] существуют. Вызывать только после
+    COMMIT транзакции, в которой выполнялся ensure_month_partitions(start, end).
+    """
+    month = _month_start(start)
+    while month <= _month_start(end):
+        _known_partitions.add(partition_name(month))
+        month = _next_month(month)
+
+
+# ---------- шаги миграций ----------
+
+def _m001_campaign_daily_stats(cur) -> None:
+    cur.execute("SELECT to_regclass('campaign_daily_stats') IS NULL")
+    created = cur.fetchone()[0]
+    cur.execute(CAMPAIGN_DAILY_STATS_DDL)
+    if created:
+        cur.execute(DAILY_STATS_BACKFILL_SQL)
+
+
+def _m002_partition_campaign_clients(cur) -> None:
+    if is_partitioned(cur):
+        return
+
+    cur.execute("LOCK TABLE campaign_clients IN ACCESS EXCLUSIVE MODE")
+    cur.execute("ALTER TABLE campaign_clients RENAME TO campaign_clients_legacy")
+    cur.execute("""
+        CREATE TABLE "campaign_clients" (
+          "id" INT GENERATED BY DEFAULT AS IDENTITY,
+          "campaign_id" int REFERENCES "campaigns" ("id"),
+          "client_id" int REFERENCES "clients" ("id"),
+          "sent_at" timestamp NOT NULL,
+          "status" varchar,
+          "opened_at" timestamp,
+          "clicked_at" timestamp,
+          PRIMARY KEY ("id", "sent_at")
+        ) PARTITION BY RANGE ("sent_at")
+    """)
+    cur.execute(
+        "COMMENT ON COLUMN campaign_clients.status IS "
+        "'PLANNED, SENT, OPENED, CLICKED, BOUNCED'"
+    )
+    cur.execute(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF campaign_clients DEFAULT")
+
+    cur.execute("SELECT MIN(sent_at), MAX(sent_at), MAX(id) FROM campaign_clients_legacy")
+    min_sent, max_sent, max_id = cur.fetchone()
+
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    start = min(min_sent or now, now - timedelta(days=31))
+    end = max(max_sent or now, now + timedelta(days=31 * PARTITION_MONTHS_AHEAD))
+    _known_partitions.clear()
+    ensure_month_partitions(cur, start, end)
+
+    cur.execute("""
+        INSERT INTO campaign_clients
+            (id, campaign_id, client_id, sent_at, status, opened_at, clicked_at)
+        SELECT id, campaign_id, client_id, sent_at, status, opened_at, clicked_at
+        FROM campaign_clients_legacy
+        WHERE sent_at IS NOT NULL
+    """)
+    cur.execute(
+        "SELECT setval(pg_get_serial_sequence('campaign_clients', 'id'), %s, %s)",
+        (max_id or 1, max_id is not None),
+    )
+
+    # Пустую старую таблицу удаляем, иначе оставляем как резервную копию
+    cur.execute("SELECT COUNT(*) FROM campaign_clients_legacy")
+    legacy_rows = cur.fetchone()[0]
+    if legacy_rows == 0:
+        cur.execute("DROP TABLE campaign_clients_legacy")
+    else:
+        print(
+            f"campaign_clients_legacy сохранена ({legacy_rows} строк); "
+            "удалите её вручную после проверки."
+        )
+
+
+def _m003_campaign_clients_indexes(cur) -> None:
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_clients_campaign_sent_idx
+            ON campaign_clients (campaign_id, sent_at)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_clients_client_sent_idx
+            ON campaign_clients (client_id, sent_at)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_clients_sent_idx
+            ON campaign_clients (sent_at)
+    """)
+    cur.execute("ANALYZE campaign_clients")
+
+
+def _m004_client_activity(cur) -> None:
+    cur.execute("SELECT to_regclass('client_activity') IS NULL")
+    created = cur.fetchone()[0]
+    cur.execute(CLIENT_ACTIVITY_DDL)
+    if created:
+        cur.execute(CLIENT_ACTIVITY_BACKFILL_SQL)
+    cur.execute("ANALYZE client_activity")
+
+
+def _m005_clients_audience_indexes(cur) -> None:
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS clients_segment_gender_idx
+            ON clients (segment, gender)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS clients_created_at_idx
+            ON clients (created_at)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS client_activity_last_activity_idx
+            ON client_activity (last_activity_at)
+    """)
+    cur.execute("ANALYZE clients")
+
+
+def _m006_campaign_clients_updated_at(cur) -> None:
+    # Нужен для инкрементальной синхронизации локального снимка (snapshot.py):
+    # по id находятся новые строки, по updated_at — изменённые задним числом.
+    # now() — STABLE, поэтому ADD COLUMN с таким DEFAULT не переписывает таблицу.
+    cur.execute("""
+        ALTER TABLE campaign_clients
+            ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT (now())
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION campaign_clients_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS campaign_clients_touch_updated_at ON campaign_clients")
+    cur.execute("""
+        CREATE TRIGGER campaign_clients_touch_updated_at
+            BEFORE UPDATE ON campaign_clients
+            FOR EACH ROW
+            WHEN (OLD.* IS DISTINCT FROM NEW.*)
+            EXECUTE FUNCTION campaign_clients_touch_updated_at()
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_clients_updated_idx
+            ON campaign_clients (updated_at)
+    """)
+
+
+
+def _m007_templates_version(cur) -> None:
+    # Версия шаблона — ключ кэша скомпилированных шаблонов (personalization.py):
+    # любое изменение строки увеличивает её, старая скомпилированная версия
+    # просто перестаёт запрашиваться.
+    cur.execute("""
+        ALTER TABLE templates
+            ADD COLUMN IF NOT EXISTS version int NOT NULL DEFAULT 1
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION templates_bump_version() RETURNS trigger AS $$
+        BEGIN
+            NEW.version := OLD.version + 1;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS templates_bump_version ON templates")
+    cur.execute("""
+        CREATE TRIGGER templates_bump_version
+            BEFORE UPDATE ON templates
+            FOR EACH ROW
+            WHEN (OLD.* IS DISTINCT FROM NEW.*)
+            EXECUTE FUNCTION templates_bump_version()
+    """)
+
+
+def _m008_campaign_scheduler(cur) -> None:
+    # Планировщик (scheduler.py) захватывает кампанию на время lease_until и
+    # продлевает его, пока идёт отправка; просроченная аренда значит, что
+    # процесс упал, и кампанию может забрать другой экземпляр.
+    cur.execute("""
+        ALTER TABLE campaigns
+            ADD COLUMN IF NOT EXISTS lease_until timestamp,
+            ADD COLUMN IF NOT EXISTS run_id int
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaigns_status_planned_idx
+            ON campaigns (status, planned_at)
+    """)
+    # Каждый запуск отправки кампании: кто, когда, сколько писем и с какой скоростью
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS campaign_runs (
+            id int GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            campaign_id int NOT NULL REFERENCES campaigns (id),
+            worker varchar NOT NULL,
+            status varchar NOT NULL DEFAULT 'RUNNING',
+            started_at timestamp NOT NULL,
+            heartbeat_at timestamp NOT NULL,
+            finished_at timestamp,
+            batches int,
+            recipients bigint,
+            sent bigint,
+            bounced bigint,
+            deferred bigint,
+            seconds double precision,
+            messages_per_sec double precision,
+            error text
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_runs_campaign_idx
+            ON campaign_runs (campaign_id, started_at)
+    """)
+    # Журнал переходов статуса пишется триггером, поэтому в него попадают
+    # и изменения из приложения, и из планировщика
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS campaign_status_log (
+            id bigint GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            campaign_id int NOT NULL REFERENCES campaigns (id),
+            old_status varchar,
+            new_status varchar,
+            run_id int,
+            changed_at timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'UTC')
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_status_log_campaign_idx
+            ON campaign_status_log (campaign_id, changed_at)
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION campaigns_log_status() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO campaign_status_log (campaign_id, old_status, new_status, run_id)
+            VALUES (
+                NEW.id,
+                CASE WHEN TG_OP = 'UPDATE' THEN OLD.status END,
+                NEW.status,
+                NEW.run_id
+            );
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS campaigns_log_status_insert ON campaigns")
+    cur.execute("DROP TRIGGER IF EXISTS campaigns_log_status_update ON campaigns")
+    cur.execute("""
+        CREATE TRIGGER campaigns_log_status_insert
+            AFTER INSERT ON campaigns
+            FOR EACH ROW
+            EXECUTE FUNCTION campaigns_log_status()
+    """)
+    cur.execute("""
+        CREATE TRIGGER campaigns_log_status_update
+            AFTER UPDATE OF status ON campaigns
+            FOR EACH ROW
+            WHEN (OLD.status IS DISTINCT FROM NEW.status)
+            EXECUTE FUNCTION campaigns_log_status()
+    """)
+
+
+def _m009_campaign_daily_sketches(cur) -> None:
+    cur.execute("SELECT to_regclass('campaign_daily_sketches') IS NULL")
+    created = cur.fetchone()[0]
+    cur.execute(CAMPAIGN_DAILY_SKETCHES_DDL)
+    if created:
+        cur.execute(SKETCHES_BACKFILL_SQL)
+
+
+def _m010_keyset_indexes(cur) -> None:
+    # Постраничный вывод отправок идёт по ключу (sent_at, id): id в индексе
+    # нужен, чтобы строки с одинаковым sent_at (например, PLANNED) тоже
+    # читались по индексу, без сортировки всей кампании. Новые индексы
+    # покрывают и запросы старых, поэтому старые удаляются.
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_clients_campaign_sent_id_idx
+            ON campaign_clients (campaign_id, sent_at, id)
+    """)
+    cur.execute("DROP INDEX IF EXISTS campaign_clients_campaign_sent_idx")
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_clients_sent_id_idx
+            ON campaign_clients (sent_at, id)
+    """)
+    cur.execute("DROP INDEX IF EXISTS campaign_clients_sent_idx")
+    # MIN / MAX(sent_date) без фильтра по кампаниям — границы периода в сайдбаре
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS campaign_daily_stats_sent_date_idx
+            ON campaign_daily_stats (sent_date)
+    """)
+    cur.execute("ANALYZE campaign_clients")
+
+
+def _m011_clients_updated_at(cur) -> None:
+    # Индекс аудиторий в памяти (audience_index.py) досинхронизируется
+    # по updated_at клиентов и client_activity (её updated_at ставит upsert).
+    cur.execute("""
+        ALTER TABLE clients
+            ADD COLUMN IF NOT EXISTS updated_at timestamp NOT NULL DEFAULT (now())
+    """)
+    cur.execute("""
+        CREATE OR REPLACE FUNCTION clients_touch_updated_at() RETURNS trigger AS $$
+        BEGIN
+            NEW.updated_at := now();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cur.execute("DROP TRIGGER IF EXISTS clients_touch_updated_at ON clients")
+    cur.execute("""
+        CREATE TRIGGER clients_touch_updated_at
+            BEFORE UPDATE ON clients
+            FOR EACH ROW
+            WHEN (OLD.* IS DISTINCT FROM NEW.*)
+            EXECUTE FUNCTION clients_touch_updated_at()
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS clients_updated_idx
+            ON clients (updated_at)
+    """)
+    cur.execute("""
+        CREATE INDEX IF NOT EXISTS client_activity_updated_idx
+            ON client_activity (updated_at)
+    """)
+
+
+def _m012_campaign_suppressions(cur) -> None:
+    # Клиенты, отсечённые ограничением частоты писем (frequency_cap.py)
+    cur.execute(CAMPAIGN_SUPPRESSIONS_DDL)
+
+
+MIGRATIONS = [
+    Migration(1, "campaign_daily_stats", _m001_campaign_daily_stats),
+    Migration(2, "partition_campaign_clients_by_month", _m002_partition_campaign_clients),
+    Migration(3, "campaign_clients_indexes", _m003_campaign_clients_indexes),
+    Migration(4, "client_activity", _m004_client_activity),
+    Migration(5, "clients_audience_indexes", _m005_clients_audience_indexes),
+    Migration(6, "campaign_clients_updated_at", _m006_campaign_clients_updated_at),
+    Migration(7, "templates_version", _m007_templates_version),
+    Migration(8, "campaign_scheduler", _m008_campaign_scheduler),
+    Migration(9, "campaign_daily_sketches", _m009_campaign_daily_sketches),
+    Migration(10, "keyset_indexes", _m010_keyset_indexes),
+    Migration(11, "clients_updated_at", _m011_clients_updated_at),
+    Migration(12, "campaign_suppressions", _m012_campaign_suppressions),
+]
+
+
+def applied_versions(conn) -> set[int]:
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_MIGRATIONS_DDL)
+        cur.execute("SELECT version FROM schema_migrations")
+        versions = {row[0] for row in cur.fetchall()}
+    conn.commit()
+    return versions
+
+
+def migrate(conn, verbose: bool = True) -> list[Migration]:
+    """Применить недостающие миграции по порядку. Возвращает применённые шаги."""
+    done = applied_versions(conn)
+    applied = []
+
+    for migration in MIGRATIONS:
+        if migration.version in done:
+            continue
+        try:
+            with conn.cursor() as cur:
+                # миграции не ограничиваем таймаутом запросов приложения
+                cur.execute("SET LOCAL statement_timeout = 0")
+                cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATION_LOCK_ID,))
+                # Параллельный процесс мог применить шаг, пока мы ждали блокировку
+                cur.execute(
+                    "SELECT 1 FROM schema_migrations WHERE version = %s",
+                    (migration.version,),
+                )
+                if cur.fetchone() is None:
+                    migration.apply(cur)
+                    cur.execute(
+                        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s)",
+                        (migration.version, migration.name),
+                    )
+                    applied.append(migration)
+                    if verbose:
+                        print(f"Применена миграция {migration.version:03d} {migration.name}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            _known_partitions.clear()
+            raise
+
+    return applied
+
+
+# ---------- проверка планов ----------
+
+INDEX_NODE_TYPES = {"Index Scan", "Index Only Scan", "Bitmap Heap Scan"}
+
+
+def _plan_nodes(plan: dict):
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _plan_nodes(child)
+
+
+def _explain(cur, sql: str, params: dict) -> dict:
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = cur.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]["Plan"]
+
+
+def check_plans(conn) -> list[dict]:
+    """
+    Выполнить EXPLAIN для основных запросов к campaign_clients и проверить,
+    что они идут по индексам и затрагивают только нужные месячные секции.
+
+    На маленькой базе планировщик честно выбирает Seq Scan, поэтому проверка
+    идёт с enable_seqscan = off: так видно, есть ли подходящий индекс вообще.
+    Возвращает список результатов {"query", "ok", "details"}.
+    """
+    results = []
+    with conn.cursor() as cur:
+        cur.execute("SET LOCAL enable_seqscan = off")
+
+        cur.execute("""
+            SELECT campaign_id, client_id, sent_at
+            FROM campaign_clients
+            ORDER BY id DESC
+            LIMIT 1
+        """)
+        sample = cur.fetchone()
+        if sample is None:
+            conn.rollback()
+            raise RuntimeError("campaign_clients пуста: проверять нечего")
+        campaign_id, client_id, sent_at = sample
+
+        period_from = _month_start(sent_at)
+        period_to = _next_month(period_from)
+        partitioned = is_partitioned(cur)
+
+        probes = [
+            (
+                "sends_by_campaign_and_period",
+                """
+                    SELECT cc.id, cc.status
+                    FROM campaign_clients cc
+                    WHERE cc.campaign_id = %(campaign_id)s
+                      AND cc.sent_at >= %(period_from)s
+                      AND cc.sent_at < %(period_to)s
+                """,
+                {"campaign_id": campaign_id, "period_from": period_from, "period_to": period_to},
+                (period_from, period_to),
+            ),
+            (
+                "sends_page_keyset",
+                """
+                    SELECT cc.id, cc.sent_at, cc.status
+                    FROM campaign_clients cc
+                    WHERE cc.campaign_id = %(campaign_id)s
+                      AND cc.sent_at >= %(period_from)s
+                      AND cc.sent_at < %(period_to)s
+                      AND (cc.sent_at, cc.id) < (%(period_to)s, 0)
+                    ORDER BY cc.sent_at DESC, cc.id DESC
+                    LIMIT 100
+                """,
+                {"campaign_id": campaign_id, "period_from": period_from, "period_to": period_to},
+                (period_from, period_to),
+            ),
+            (
+                "client_last_send",
+                """
+                    SELECT MAX(cc.sent_at)
+                    FROM campaign_clients cc
+                    WHERE cc.client_id = %(client_id)s
+                """,
+                {"client_id": client_id},
+                None,
+            ),
+            (
+                # проба ограничения частоты (frequency_cap.py) на одного получателя
+                "client_recent_sends",
+                """
+                    SELECT COUNT(*)
+                    FROM campaign_clients cc
+                    WHERE cc.client_id = %(client_id)s
+                      AND cc.sent_at >= %(period_from)s
+                """,
+                {"client_id": client_id, "period_from": period_from},
+                None,
+            ),
+            (
+                "joined_sends_for_campaign",
+                """
+                    SELECT cc.id, c.name, cl.gender, cl.segment
+                    FROM campaign_clients cc
+                    JOIN campaigns c ON cc.campaign_id = c.id
+                    JOIN clients   cl ON cc.client_id   = cl.id
+                    WHERE cc.campaign_id = %(campaign_id)s
+                      AND cc.sent_at >= %(period_from)s
+                      AND cc.sent_at < %(period_to)s
+                """,
+                {"campaign_id": campaign_id, "period_from": period_from, "period_to": period_to},
+                (period_from, period_to),
+            ),
+        ]
+
+        for name, sql, params, period in probes:
+            nodes = list(_plan_nodes(_explain(cur, sql, params)))
+            cc_nodes = [
+                n for n in nodes
+                if n.get("Relation Name", "").startswith("campaign_clients")
+            ]
+            scanned = sorted({n["Relation Name"] for n in cc_nodes})
+            uses_index = bool(cc_nodes) and all(
+                n["Node Type"] in INDEX_NODE_TYPES for n in cc_nodes
+            )
+
+            ok = uses_index
+            details = {"scanned": scanned, "uses_index": uses_index}
+
+            if partitioned and period is not None:
+                allowed = {DEFAULT_PARTITION}
+                month = period[0]
+                while month < period[1]:
+                    allowed.add(partition_name(month))
+                    month = _next_month(month)
+                pruned = set(scanned) <= allowed
+                details["pruned"] = pruned
+                ok = ok and pruned
+
+            results.append({"query": name, "ok": ok, "details": details})
+
+    conn.rollback()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Миграции схемы БД")
+    parser.add_argument(
+        "command", choices=["migrate", "status", "ensure-partitions", "check-plans"]
+    )
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    args = parser.parse_args()
+
+    from db import get_engine
+
+    conn = get_engine().raw_connection()
+    try:
+        if args.command == "migrate":
+            applied = migrate(conn)
+            if not applied:
+                print("Все миграции уже применены.")
+
+        elif args.command == "status":
+            done = applied_versions(conn)
+            for migration in MIGRATIONS:
+                mark = "x" if migration.version in done else " "
+                print(f"[{mark}] {migration.version:03d} {migration.name}")
+
+        elif args.command == "ensure-partitions":
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            with conn.cursor() as cur:
+                created = ensure_month_partitions(
+                    cur, now, now + timedelta(days=31 * args.months_ahead)
+                )
+            conn.commit()
+            print("Созданы секции:", ", ".join(created) if created else "нет")
+
+        elif args.command == "check-plans":
+            results = check_plans(conn)
+            for result in results:
+                mark = "OK  " if result["ok"] else "FAIL"
+                print(f"{mark} {result['query']}: {json.dumps(result['details'])}")
+            if not all(r["ok"] for r in results):
+                raise SystemExit(1)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+"""
+Параллельный расчёт метрик аналитики в пуле процессов.
+
+compute_metrics() векторный, но выполняется на одном ядре. Здесь история
+отправок делится на непересекающиеся части, каждая считается
+compute_metrics() в отдельном процессе, а частичные результаты
+складываются analytics.merge_metrics() — точно, потому что складываются
+целые счётчики, а доли пересчитываются по суммам.
+
+Источники частей:
+
+  * "snapshot" — локальный Parquet-снимок (snapshot.py), части по
+    ~PARTITION_ROWS строк из snapshot.partitions(). Процесс сам читает свою
+    часть через memory-mapping Arrow, между процессами передаются только
+    имя файла и номера row group'ов туда и маленькие таблицы метрик обратно;
+  * "db" — campaign_clients по месяцам sent_at (месячные секции, миграция 002):
+    процесс читает свой месяц db.load_sends_frame() через своё соединение.
+
+Пул создаётся один раз на процесс и переиспользуется. Рабочие процессы
+запускаются через forkserver (или spawn), а не fork: Streamlit многопоточный,
+и fork унаследовал бы чужие блокировки и соединения из пула БД.
+Число процессов — ANALYTICS_WORKERS (читается при каждом вызове, пул
+пересоздаётся при изменении); при 1 части считаются по очереди
+в текущем процессе.
+
+    python -m benchmarks.bench_parallel --rows 50000000
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import db
+import snapshot
+from analytics import METRICS_COLUMNS, MetricsResult, compute_metrics, merge_metrics
+from perf import timed
+
+
+_executor: ProcessPoolExecutor | None = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def analytics_workers() -> int:
+    """Текущее значение ANALYTICS_WORKERS (1 — без пула процессов)."""
+    return int(os.getenv("ANALYTICS_WORKERS", "1"))
+
+
+def enabled() -> bool:
+    """Параллельный режим включён, если ANALYTICS_WORKERS больше 1."""
+    return analytics_workers() > 1
+
+
+def _merge_futures(futures: list) -> MetricsResult:
+    """Сложить результаты; если часть упала, остальные ещё не начатые отменить."""
+    try:
+        return merge_metrics([future.result() for future in futures])
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+
+
+def _init_worker(snapshot_dir: str) -> None:
+    snapshot.SNAPSHOT_DIR = snapshot_dir
+
+
+def _get_executor(workers: int) -> ProcessPoolExecutor:
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(cancel_futures=True)
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(method),
+                initializer=_init_worker,
+                initargs=(snapshot.SNAPSHOT_DIR,),
+            )
+            _executor_workers = workers
+        return _executor
+
+
+def shutdown() -> None:
+    """Остановить пул процессов (он создастся заново при следующем расчёте)."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+
+def _snapshot_part_metrics(
+    partition: snapshot.Partition,
+    campaign_ids: list[int] | None,
+    date_from: date | None,
+    date_to: date | None,
+) -> MetricsResult:
+    df = snapshot.read_sends(METRICS_COLUMNS, campaign_ids, date_from, date_to, partition=partition)
+    return compute_metrics(df)
+
+
+def _db_month_metrics(
+    campaign_ids: list[int] | None,
+    date_from: date,
+    date_to: date,
+) -> MetricsResult:
+    df, _ = db.load_sends_frame(campaign_ids, date_from, date_to, columns=METRICS_COLUMNS)
+    return compute_metrics(df)
+
+
+def month_ranges(date_from: date, date_to: date) -> list[tuple[date, date]]:
+    """Периоды [начало, конец] по календарным месяцам внутри [date_from, date_to]."""
+    ranges = []
+    start = date_from
+    while start <= date_to:
+        next_month = (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+        end = min(next_month - timedelta(days=1), date_to)
+        ranges.append((start, end))
+        start = next_month
+    return ranges
+
+
+def _tasks(
+    source: str,
+    campaign_ids: list[int] | None,
+    date_from: date | None,
+    date_to: date | None,
+) -> list[tuple]:
+    if source == "snapshot":
+        return [
+            (_snapshot_part_metrics, partition, campaign_ids, date_from, date_to)
+            for partition in snapshot.partitions(campaign_ids, date_from, date_to)
+        ]
+    if source == "db":
+        if date_from is None or date_to is None:
+            first, last = db.get_sent_date_bounds.uncached(campaign_ids)
+            if first is None:
+                return []
+            date_from = max(date_from or first, first)
+            date_to = min(date_to or last, last)
+        return [
+            (_db_month_metrics, campaign_ids, start, end)
+            for start, end in month_ranges(date_from, date_to)
+        ]
+    raise ValueError(f"Unknown source: {source!r}")
+
+
+@timed
+def get_campaign_metrics(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    source: str = "snapshot",
+    workers: int | None = None,
+) -> MetricsResult:
+    """
+    То же, что snapshot.get_campaign_metrics() (source="snapshot") или расчёт
+    по сырым отправкам из БД (source="db"), но части считаются в workers
+    процессах (по умолчанию — текущее значение ANALYTICS_WORKERS).
+    """
+    if workers is None:
+        workers = analytics_workers()
+    tasks = _tasks(source, campaign_ids, date_from, date_to)
+    if workers <= 1 or len(tasks) <= 1:
+        return merge_metrics(func(*args) for func, *args in tasks)
+
+    executor = _get_executor(workers)
+    futures = [executor.submit(func, *args) for func, *args in tasks]
+    return _merge_futures(futures)
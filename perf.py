@@ -0,0 +1,246 @@
+"""
+Замеры времени запросов к БД и шагов обработки, общие для процесса.
+
+При включении (PERF_ENABLED=1 или perf.enable()) на все SQLAlchemy Engine
+вешаются обработчики before/after_cursor_execute: для каждого запроса
+сохраняются отпечаток текста (литералы заменены на ?), длительность,
+число строк и span, внутри которого выполнялся запрос. Span'ы — именованные
+участки кода: функции db.py (декоратор @timed) и шаги страницы аналитики
+(with perf.span("...")).
+
+Записи лежат в кольцевом буфере на PERF_BUFFER_SIZE элементов; summary()
+считает по ним p50 / p95 / p99, export_json() выгружает всё в JSON.
+
+В выключенном состоянии обработчики событий сняты, span() возвращает
+общий пустой контекстный менеджер, а @timed сразу вызывает функцию.
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+
+import pandas as pd
+from sqlalchemy import Engine, event
+
+
+PERF_ENABLED = os.getenv("PERF_ENABLED", "0") == "1"
+PERF_BUFFER_SIZE = int(os.getenv("PERF_BUFFER_SIZE", "5000"))
+
+# Отпечаток запроса обрезается, чтобы длинные SQL не раздували буфер
+FINGERPRINT_MAX_LEN = 300
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+_WHITESPACE = re.compile(r"\s+")
+
+_NULL_SPAN = contextlib.nullcontext()
+
+
+@dataclass(frozen=True)
+class Record:
+    """Один замер: запрос к БД (kind="query") или участок кода (kind="span")."""
+
+    at: float
+    kind: str
+    name: str
+    duration_ms: float
+    rows: int | None
+    span: str | None
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(statement: str) -> str:
+    """Текст запроса без литералов и лишних пробелов (одинаков для разных параметров)."""
+    text = _STRING_LITERAL.sub("?", statement)
+    text = _PLACEHOLDER.sub("?", text)
+    text = _NUMBER_LITERAL.sub("?", text)
+    text = _WHITESPACE.sub(" ", text).strip()
+    return text[:FINGERPRINT_MAX_LEN]
+
+
+class PerfRecorder:
+    """Кольцевой буфер замеров и SQLAlchemy-обработчики."""
+
+    def __init__(self, buffer_size: int):
+        self.buffer_size = buffer_size
+        self._records: deque[Record] = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._current_span: contextvars.ContextVar[str | None] = contextvars.ContextVar(
+            "perf_span", default=None
+        )
+        self.enabled = False
+
+    # ---------- обработчики SQLAlchemy ----------
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("perf_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.get("perf_started")
+        if not started:
+            # обработчики повесили посреди запроса
+            return
+        duration = time.perf_counter() - started.pop()
+        # для серверного курсора (stream_results) rowcount неизвестен: -1
+        rows = cursor.rowcount if cursor.rowcount is not None and cursor.rowcount >= 0 else None
+        self.add("query", fingerprint(statement), duration, rows)
+
+    def _handle_error(self, context):
+        # упавший запрос не доходит до after_cursor_execute: снимаем его
+        # время со стека, иначе следующий запрос соединения получит чужое
+        conn = context.connection
+        if conn is None or context.execution_context is None:
+            return
+        started = conn.info.get("perf_started")
+        if started:
+            started.pop()
+
+    def enable(self) -> None:
+        with self._lock:
+            if self.enabled:
+                return
+            event.listen(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", self._after_cursor_execute)
+            event.listen(Engine, "handle_error", self._handle_error)
+            self.enabled = True
+
+    def disable(self) -> None:
+        with self._lock:
+            if not self.enabled:
+                return
+            event.remove(Engine, "before_cursor_execute", self._before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", self._after_cursor_execute)
+            event.remove(Engine, "handle_error", self._handle_error)
+            self.enabled = False
+
+    # ---------- запись ----------
+
+    def add(self, kind: str, name: str, duration: float, rows: int | None = None) -> None:
+        # deque.append потокобезопасен, старые записи вытесняются сами
+        self._records.append(Record(
+            at=time.time(),
+            kind=kind,
+            name=name,
+            duration_ms=duration * 1000,
+            rows=rows,
+            span=self._current_span.get(),
+        ))
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        token = self._current_span.set(name)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self._current_span.reset(token)
+            self.add("span", name, duration)
+
+    # ---------- чтение ----------
+
+    def records(self) -> list[Record]:
+        return list(self._records)
+
+    def clear(self) -> None:
+        self._records.clear()
+
+    def summary(self) -> pd.DataFrame:
+        columns = [
+            "kind", "name", "count", "total_ms", "p50_ms", "p95_ms", "p99_ms",
+            "max_ms", "rows_avg",
+        ]
+        records = self.records()
+        if not records:
+            return pd.DataFrame(columns=columns)
+
+        df = pd.DataFrame([asdict(r) for r in records])
+        grouped = df.groupby(["kind", "name"], sort=False)
+        duration = grouped["duration_ms"]
+        table = pd.DataFrame({
+            "count": duration.size(),
+            "total_ms": duration.sum(),
+            "p50_ms": duration.quantile(0.50),
+            "p95_ms": duration.quantile(0.95),
+            "p99_ms": duration.quantile(0.99),
+            "max_ms": duration.max(),
+            "rows_avg": grouped["rows"].mean(),
+        }).reset_index()
+        return table.sort_values("total_ms", ascending=False, ignore_index=True)[columns]
+
+
+_recorder = PerfRecorder(PERF_BUFFER_SIZE)
+if PERF_ENABLED:
+    _recorder.enable()
+
+
+def enabled() -> bool:
+    return _recorder.enabled
+
+
+def enable() -> None:
+    """Начать замеры (вешает обработчики на все Engine процесса)."""
+    _recorder.enable()
+
+
+def disable() -> None:
+    """Остановить замеры; накопленные записи остаются в буфере."""
+    _recorder.disable()
+
+
+def span(name: str):
+    """Контекстный менеджер: замерить участок кода под именем name."""
+    if not _recorder.enabled:
+        return _NULL_SPAN
+    return _recorder.span(name)
+
+
+def timed(func):
+    """Декоратор: замерять вызовы функции как span с её полным именем."""
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _recorder.enabled:
+            return func(*args, **kwargs)
+        with _recorder.span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def records() -> list[Record]:
+    """Все записи буфера, от старых к новым."""
+    return _recorder.records()
+
+
+def clear() -> None:
+    _recorder.clear()
+
+
+def summary() -> pd.DataFrame:
+    """Сводка по (kind, name): число вызовов, суммарное время, p50 / p95 / p99, max."""
+    return _recorder.summary()
+
+
+def export_json() -> str:
+    """Сводка и все записи буфера в JSON."""
+    return json.dumps(
+        {
+            "enabled": _recorder.enabled,
+            "buffer_size": _recorder.buffer_size,
+            "exported_at": time.time(),
+            "summary": json.loads(summary().to_json(orient="records")),
+            "records": [asdict(r) for r in records()],
+        },
+        ensure_ascii=False,
+        indent=2,
+    )
@@ -0,0 +1,308 @@
+"""
+Агрегатные таблицы (rollup), которые поддерживаются при записи отправок.
+
+campaign_daily_stats — счётчики sent / opened / clicked / bounced по
+(campaign_id, sent_date, gender, segment). Пустые gender / segment
+хранятся как '' (они входят в первичный ключ), при чтении превращаются в NULL.
+
+client_activity — последняя активность и счётчики по каждому клиенту
+(last_sent_at / last_open_at / last_click_at / last_activity_at и lifetime-счётчики).
+По индексу на COALESCE(last_activity_at, last_sent_at) ищутся «уснувшие» клиенты.
+
+campaign_daily_sketches — HyperLogLog-скетчи уникальных получателей и
+открывших по (campaign_id, sent_date), см. sketches.py.
+
+db.create_campaign_clients() сначала складывает новые строки во временную
+таблицу campaign_clients_stage, а затем переносит их в campaign_clients
+и прибавляет их агрегаты к rollup-таблицам (apply_stage).
+
+Открытия и клики, пришедшие позже отправки (tracking.py), пишутся
+в campaign_clients_engagement со старыми и новыми значениями строк,
+apply_engagement() прибавляет к агрегатам только разницу.
+
+Строки в статусе PLANNED (ещё не отправленные письма) в агрегаты не входят:
+их учитывает delivery.py, когда записывает итоговый статус SENT / BOUNCED.
+
+Пересчитать rollup-таблицы по уже накопленным данным:
+
+    python rollups.py backfill
+    python rollups.py backfill --table client_activity
+"""
+
+import argparse
+
+from sqlalchemy import text
+
+from sketches import CAMPAIGN_DAILY_SKETCHES_DDL, sketches_upsert_sql
+
+
+STAGE_TABLE = "campaign_clients_stage"
+
+# Временная таблица живёт в рамках соединения, строки чистятся при COMMIT
+CREATE_STAGE_SQL = f"""
+    CREATE TEMP TABLE IF NOT EXISTS {STAGE_TABLE} (
+        campaign_id int,
+        client_id   int,
+        sent_at     timestamp,
+        status      varchar,
+        opened_at   timestamp,
+        clicked_at  timestamp
+    ) ON COMMIT DELETE ROWS
+"""
+
+CAMPAIGN_DAILY_STATS_DDL = """
+CREATE TABLE IF NOT EXISTS "campaign_daily_stats" (
+  "campaign_id" int NOT NULL,
+  "sent_date" date NOT NULL,
+  "gender" varchar NOT NULL DEFAULT '',
+  "segment" varchar NOT NULL DEFAULT '',
+  "sent" bigint NOT NULL DEFAULT 0,
+  "opened" bigint NOT NULL DEFAULT 0,
+  "clicked" bigint NOT NULL DEFAULT 0,
+  "bounced" bigint NOT NULL DEFAULT 0,
+  PRIMARY KEY ("campaign_id", "sent_date", "gender", "segment")
+);
+"""
+
+
+def _daily_stats_upsert_sql(source: str) -> str:
+    """Прибавить агрегаты строк из source (колонки как у campaign_clients)."""
+    return f"""
+        INSERT INTO campaign_daily_stats AS s
+            (campaign_id, sent_date, gender, segment, sent, opened, clicked, bounced)
+        SELECT
+            src.campaign_id,
+            src.sent_at::date,
+            COALESCE(cl.gender, ''),
+            COALESCE(cl.segment, ''),
+            COUNT(*),
+            COUNT(*) FILTER (WHERE UPPER(src.status) IN ('OPENED', 'CLICKED')),
+            COUNT(*) FILTER (WHERE UPPER(src.status) = 'CLICKED'),
+            COUNT(*) FILTER (WHERE UPPER(src.status) = 'BOUNCED')
+        FROM {source} src
+        JOIN clients cl ON cl.id = src.client_id
+        WHERE src.sent_at IS NOT NULL
+          AND UPPER(src.status) IS DISTINCT FROM 'PLANNED'
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (campaign_id, sent_date, gender, segment) DO UPDATE SET
+            sent    = s.sent    + EXCLUDED.sent,
+            opened  = s.opened  + EXCLUDED.opened,
+            clicked = s.clicked + EXCLUDED.clicked,
+            bounced = s.bounced + EXCLUDED.bounced
+    """
+
+
+CLIENT_ACTIVITY_DDL = """
+CREATE TABLE IF NOT EXISTS "client_activity" (
+  "client_id" int PRIMARY KEY REFERENCES "clients" ("id"),
+  "last_sent_at" timestamp,
+  "last_open_at" timestamp,
+  "last_click_at" timestamp,
+  "last_activity_at" timestamp,
+  "sends_total" bigint NOT NULL DEFAULT 0,
+  "opens_total" bigint NOT NULL DEFAULT 0,
+  "clicks_total" bigint NOT NULL DEFAULT 0,
+  "bounces_total" bigint NOT NULL DEFAULT 0,
+  "updated_at" timestamp NOT NULL DEFAULT (now())
+);
+
+CREATE INDEX IF NOT EXISTS client_activity_dormant_idx
+    ON client_activity ((COALESCE(last_activity_at, last_sent_at)));
+"""
+
+
+def _client_activity_upsert_sql(source: str) -> str:
+    """
+    Обновить client_activity по строкам из source (колонки как у campaign_clients).
+
+    last_activity_at считается как MAX(COALESCE(opened_at, clicked_at)).
+    Строки упорядочены по client_id, чтобы параллельные рассылки
+    блокировали клиентов в одном порядке и не ловили deadlock.
+    """
+    return f"""
+        INSERT INTO client_activity AS a
+            (client_id, last_sent_at, last_open_at, last_click_at, last_activity_at,
+             sends_total, opens_total, clicks_total, bounces_total, updated_at)
+        SELECT
+            src.client_id,
+            MAX(src.sent_at),
+            MAX(src.opened_at),
+            MAX(src.clicked_at),
+            MAX(COALESCE(src.opened_at, src.clicked_at)),
+            COUNT(*),
+            COUNT(src.opened_at),
+            COUNT(src.clicked_at),
+            COUNT(*) FILTER (WHERE UPPER(src.status) = 'BOUNCED'),
+            now()
+        FROM {source} src
+        WHERE src.sent_at IS NOT NULL
+          AND UPPER(src.status) IS DISTINCT FROM 'PLANNED'
+        GROUP BY src.client_id
+        ORDER BY src.client_id
+        ON CONFLICT (client_id) DO UPDATE SET
+            last_sent_at     = GREATEST(a.last_sent_at, EXCLUDED.last_sent_at),
+            last_open_at     = GREATEST(a.last_open_at, EXCLUDED.last_open_at),
+            last_click_at    = GREATEST(a.last_click_at, EXCLUDED.last_click_at),
+            last_activity_at = GREATEST(a.last_activity_at, EXCLUDED.last_activity_at),
+            sends_total      = a.sends_total   + EXCLUDED.sends_total,
+            opens_total      = a.opens_total   + EXCLUDED.opens_total,
+            clicks_total     = a.clicks_total  + EXCLUDED.clicks_total,
+            bounces_total    = a.bounces_total + EXCLUDED.bounces_total,
+            updated_at       = EXCLUDED.updated_at
+    """
+
+
+APPLY_STAGE_SQL = (
+    _daily_stats_upsert_sql(STAGE_TABLE)
+    + ";\n"
+    + _client_activity_upsert_sql(STAGE_TABLE)
+    + ";\n"
+    + sketches_upsert_sql(STAGE_TABLE)
+)
+
+# Изменения статусов уже отправленных писем (открытия и клики из tracking.py):
+# старые и новые значения каждой затронутой строки campaign_clients.
+# changed = false — строка найдена, но события ничего в ней не поменяли.
+ENGAGEMENT_TABLE = "campaign_clients_engagement"
+
+CREATE_ENGAGEMENT_SQL = f"""
+    CREATE TEMP TABLE IF NOT EXISTS {ENGAGEMENT_TABLE} (
+        id             int,
+        campaign_id    int,
+        client_id      int,
+        sent_at        timestamp,
+        changed        boolean,
+        old_status     varchar,
+        new_status     varchar,
+        old_opened_at  timestamp,
+        new_opened_at  timestamp,
+        old_clicked_at timestamp,
+        new_clicked_at timestamp
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Открывшие для скетчей: получатели уже в reach, добавляются только в openers
+_ENGAGEMENT_OPENS_SOURCE = f"""(
+        SELECT campaign_id, client_id, sent_at, new_status AS status
+        FROM {ENGAGEMENT_TABLE}
+        WHERE changed AND UPPER(new_status) IN ('OPENED', 'CLICKED')
+    )"""
+
+# sent не меняется: строки уже учтены при отправке, прибавляются только
+# разницы флагов opened / clicked
+APPLY_ENGAGEMENT_SQL = f"""
+    INSERT INTO campaign_daily_stats AS s
+        (campaign_id, sent_date, gender, segment, sent, opened, clicked, bounced)
+    SELECT
+        e.campaign_id,
+        e.sent_at::date,
+        COALESCE(cl.gender, ''),
+        COALESCE(cl.segment, ''),
+        0,
+        COUNT(*) FILTER (WHERE UPPER(e.new_status) IN ('OPENED', 'CLICKED'))
+            - COUNT(*) FILTER (WHERE UPPER(e.old_status) IN ('OPENED', 'CLICKED')),
+        COUNT(*) FILTER (WHERE UPPER(e.new_status) = 'CLICKED')
+            - COUNT(*) FILTER (WHERE UPPER(e.old_status) = 'CLICKED'),
+        0
+    FROM {ENGAGEMENT_TABLE} e
+    JOIN clients cl ON cl.id = e.client_id
+    WHERE e.changed
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (campaign_id, sent_date, gender, segment) DO UPDATE SET
+        opened  = s.opened  + EXCLUDED.opened,
+        clicked = s.clicked + EXCLUDED.clicked;
+
+    INSERT INTO client_activity AS a
+        (client_id, last_open_at, last_click_at, last_activity_at,
+         opens_total, clicks_total, updated_at)
+    SELECT
+        e.client_id,
+        MAX(e.new_opened_at),
+        MAX(e.new_clicked_at),
+        MAX(COALESCE(e.new_opened_at, e.new_clicked_at)),
+        COUNT(*) FILTER (WHERE e.old_opened_at IS NULL AND e.new_opened_at IS NOT NULL),
+        COUNT(*) FILTER (WHERE e.old_clicked_at IS NULL AND e.new_clicked_at IS NOT NULL),
+        now()
+    FROM {ENGAGEMENT_TABLE} e
+    WHERE e.changed
+    GROUP BY e.client_id
+    ORDER BY e.client_id
+    ON CONFLICT (client_id) DO UPDATE SET
+        last_open_at     = GREATEST(a.last_open_at, EXCLUDED.last_open_at),
+        last_click_at    = GREATEST(a.last_click_at, EXCLUDED.last_click_at),
+        last_activity_at = GREATEST(a.last_activity_at, EXCLUDED.last_activity_at),
+        opens_total      = a.opens_total  + EXCLUDED.opens_total,
+        clicks_total     = a.clicks_total + EXCLUDED.clicks_total,
+        updated_at       = EXCLUDED.updated_at;
+
+    {sketches_upsert_sql(_ENGAGEMENT_OPENS_SOURCE, ("openers",))}
+"""
+
+# SHARE-блокировка не даёт писать в campaign_clients, пока идёт пересчёт,
+# поэтому инкрементальные обновления не потеряются и не задвоятся.
+DAILY_STATS_BACKFILL_SQL = f"""
+    LOCK TABLE campaign_clients IN SHARE MODE;
+    DELETE FROM campaign_daily_stats;
+    {_daily_stats_upsert_sql("campaign_clients")};
+"""
+
+CLIENT_ACTIVITY_BACKFILL_SQL = f"""
+    LOCK TABLE campaign_clients IN SHARE MODE;
+    DELETE FROM client_activity;
+    {_client_activity_upsert_sql("campaign_clients")};
+"""
+
+SKETCHES_BACKFILL_SQL = f"""
+    LOCK TABLE campaign_clients IN SHARE MODE;
+    DELETE FROM campaign_daily_sketches;
+    {sketches_upsert_sql("campaign_clients")};
+"""
+
+ROLLUP_TABLES = {
+    "campaign_daily_stats": (CAMPAIGN_DAILY_STATS_DDL, DAILY_STATS_BACKFILL_SQL),
+    "client_activity": (CLIENT_ACTIVITY_DDL, CLIENT_ACTIVITY_BACKFILL_SQL),
+    "campaign_daily_sketches": (CAMPAIGN_DAILY_SKETCHES_DDL, SKETCHES_BACKFILL_SQL),
+}
+
+
+def apply_stage(conn) -> None:
+    """Добавить в rollup-таблицы строки из campaign_clients_stage (в текущей транзакции)."""
+    conn.execute(text(APPLY_STAGE_SQL))
+
+
+def apply_engagement(conn) -> None:
+    """Добавить в rollup-таблицы изменения из campaign_clients_engagement (в текущей транзакции)."""
+    conn.execute(text(APPLY_ENGAGEMENT_SQL))
+
+
+def backfill(conn, tables: list[str] | None = None) -> None:
+    """Полностью пересчитать rollup-таблицы (по умолчанию все) по campaign_clients."""
+    # пересчёт идёт дольше обычного запроса: DB_STATEMENT_TIMEOUT_MS к нему не применяем
+    conn.execute(text("SET LOCAL statement_timeout = 0"))
+    for table in tables or list(ROLLUP_TABLES):
+        ddl, backfill_sql = ROLLUP_TABLES[table]
+        conn.execute(text(ddl))
+        conn.execute(text(backfill_sql))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Обслуживание агрегатных таблиц")
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument(
+        "--table", action="append", choices=list(ROLLUP_TABLES),
+        help="какую таблицу пересчитать (по умолчанию все)",
+    )
+    args = parser.parse_args()
+
+    from db import get_engine
+
+    tables = args.table or list(ROLLUP_TABLES)
+    with get_engine().begin() as conn:
+        backfill(conn, tables)
+        for table in tables:
+            rows = conn.execute(text(f"SELECT COUNT(*) FROM {table}")).scalar_one()
+            print(f"{table} пересчитана, строк:", rows)
+
+
+if __name__ == "__main__":
+    main()
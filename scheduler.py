@@ -0,0 +1,500 @@
+"""
+Планировщик кампаний: отправка SCHEDULED-кампаний, когда наступил planned_at.
+
+Кампании с получателями в статусе PLANNED создаёт db.schedule_campaign().
+Каждый экземпляр планировщика раз в SCHEDULER_POLL_SECONDS одной транзакцией
+захватывает до SCHEDULER_CLAIM_LIMIT созревших кампаний
+(SELECT ... FOR UPDATE SKIP LOCKED), создаёт запись в campaign_runs и
+переводит кампанию в RUNNING с арендой на SCHEDULER_LEASE_SECONDS. Кампанию,
+которую держит другой экземпляр, SKIP LOCKED просто пропускает, поэтому
+планировщиков можно запускать сколько угодно параллельно.
+
+Получатели кампании делятся на пачки по SCHEDULER_BATCH_ROWS (диапазоны
+campaign_clients.id), пачки разбирают SCHEDULER_WORKERS воркеров: каждый
+отправляет свою пачку через delivery.deliver_async(), SMTP-соединения
+(SCHEDULER_CONCURRENCY) делятся между воркерами, ограничитель по доменам
+общий на кампанию. Пока идёт отправка, аренда продлевается; если процесс
+упал, по истечении аренды кампанию заберёт другой экземпляр и дошлёт
+оставшиеся PLANNED-письма.
+
+По окончании запуска в campaign_runs пишутся число пачек, писем, время и
+скорость, а кампания становится FINISHED (PLANNED-получателей не осталось),
+снова SCHEDULED через SCHEDULER_RETRY_SECONDS (остались письма с временными
+ошибками) или CANCELLED после SCHEDULER_MAX_RUNS запусков. Все переходы
+статуса кампании пишет в campaign_status_log триггер (миграция 8).
+
+    python scheduler.py run             # работать постоянно
+    python scheduler.py run --once      # один проход по созревшим кампаниям
+    python scheduler.py runs            # последние запуски
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import text
+
+import delivery
+from cache import invalidate
+from db import get_engine
+
+
+SCHEDULER_POLL_SECONDS = float(os.getenv("SCHEDULER_POLL_SECONDS", "5"))
+SCHEDULER_CLAIM_LIMIT = int(os.getenv("SCHEDULER_CLAIM_LIMIT", "1"))
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", "4"))
+SCHEDULER_BATCH_ROWS = int(os.getenv("SCHEDULER_BATCH_ROWS", "20000"))
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", str(delivery.SMTP_CONCURRENCY)))
+SCHEDULER_LEASE_SECONDS = float(os.getenv("SCHEDULER_LEASE_SECONDS", "60"))
+SCHEDULER_HEARTBEAT_SECONDS = float(os.getenv("SCHEDULER_HEARTBEAT_SECONDS", "15"))
+SCHEDULER_RETRY_SECONDS = float(os.getenv("SCHEDULER_RETRY_SECONDS", "300"))
+SCHEDULER_MAX_RUNS = int(os.getenv("SCHEDULER_MAX_RUNS", "5"))
+
+# Имя экземпляра в campaign_runs.worker
+WORKER_NAME = os.getenv("SCHEDULER_NAME") or f"{socket.gethostname()}:{os.getpid()}"
+
+NOW_SQL = "(now() AT TIME ZONE 'UTC')"
+
+# Захват кампаний из due_sql (SELECT id, status ... FOR UPDATE SKIP LOCKED):
+# запись в campaign_runs и перевод в RUNNING с арендой. Незавершённые
+# запуски упавшего процесса помечаются ABANDONED.
+def _claim_sql(due_sql: str) -> str:
+    return f"""
+    WITH due AS ({due_sql}),
+    abandoned AS (
+        UPDATE campaign_runs r
+        SET status = 'ABANDONED', finished_at = {NOW_SQL}
+        FROM due
+        WHERE r.campaign_id = due.id AND r.finished_at IS NULL
+    ),
+    runs AS (
+        INSERT INTO campaign_runs (campaign_id, worker, started_at, heartbeat_at)
+        SELECT id, :worker, {NOW_SQL}, {NOW_SQL}
+        FROM due
+        RETURNING id, campaign_id
+    )
+    UPDATE campaigns c
+    SET status = 'RUNNING',
+        run_id = runs.id,
+        lease_until = {NOW_SQL} + make_interval(secs => :lease_seconds)
+    FROM runs
+    JOIN due ON due.id = runs.campaign_id
+    WHERE c.id = runs.campaign_id
+    RETURNING c.id, runs.id, due.status
+"""
+
+
+# Созревшие SCHEDULED-кампании и RUNNING с истёкшей арендой (процесс упал)
+CLAIM_SQL = _claim_sql(f"""
+        SELECT id, status
+        FROM campaigns
+        WHERE (status = 'SCHEDULED' AND planned_at <= {NOW_SQL})
+           OR (status = 'RUNNING' AND lease_until < {NOW_SQL})
+        ORDER BY planned_at, id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+""")
+
+# Одна кампания для ручной отправки (delivery.py send), независимо от planned_at,
+# если её не держит живая аренда другого запуска
+CLAIM_ONE_SQL = _claim_sql(f"""
+        SELECT id, status
+        FROM campaigns
+        WHERE id = :campaign_id
+          AND NOT (status = 'RUNNING' AND lease_until >= {NOW_SQL})
+        FOR UPDATE SKIP LOCKED
+""")
+
+# Пачки PLANNED-получателей: диапазоны id примерно по batch_rows строк
+BATCHES_SQL = """
+    SELECT MIN(id), MAX(id), COUNT(*)
+    FROM (
+        SELECT id, (row_number() OVER (ORDER BY id) - 1) / :batch_rows AS batch
+        FROM campaign_clients
+        WHERE campaign_id = :campaign_id
+          AND status = 'PLANNED'
+    ) planned
+    GROUP BY batch
+    ORDER BY batch
+"""
+
+
+class LeaseLost(Exception):
+    """Аренду кампании забрал другой экземпляр планировщика."""
+
+
+@dataclass(frozen=True)
+class Claim:
+    campaign_id: int
+    run_id: int
+    # статус до захвата: SCHEDULED или RUNNING (перехват у упавшего процесса)
+    previous_status: str
+
+
+@dataclass(frozen=True)
+class RunReport:
+    campaign_id: int
+    run_id: int
+    # итоговый статус кампании: FINISHED / SCHEDULED / CANCELLED
+    campaign_status: str
+    batches: int
+    recipients: int
+    sent: int
+    bounced: int
+    deferred: int
+    seconds: float
+    error: str | None = None
+
+    @property
+    def messages_per_sec(self) -> float:
+        done = self.sent + self.bounced
+        return done / self.seconds if self.seconds > 0 else 0.0
+
+
+def claim_campaigns(worker: str = WORKER_NAME, limit: int = SCHEDULER_CLAIM_LIMIT) -> list[Claim]:
+    """Захватить созревшие кампании (RUNNING + запись в campaign_runs)."""
+    with get_engine().begin() as conn:
+        rows = conn.execute(
+            text(CLAIM_SQL),
+            {"limit": limit, "worker": worker, "lease_seconds": SCHEDULER_LEASE_SECONDS},
+        ).all()
+    if rows:
+        invalidate("campaigns", "campaign_runs")
+    return [Claim(*row) for row in rows]
+
+
+def claim_campaign(campaign_id: int, worker: str = WORKER_NAME) -> Claim | None:
+    """
+    Захватить одну кампанию для отправки вне очереди (delivery.deliver()).
+    None — кампанию сейчас отправляет другой процесс (или её нет).
+    """
+    with get_engine().begin() as conn:
+        row = conn.execute(
+            text(CLAIM_ONE_SQL),
+            {"campaign_id": campaign_id, "worker": worker, "lease_seconds": SCHEDULER_LEASE_SECONDS},
+        ).one_or_none()
+    if row is None:
+        return None
+    invalidate("campaigns", "campaign_runs")
+    return Claim(*row)
+
+
+def recipient_batches(campaign_id: int, batch_rows: int = SCHEDULER_BATCH_ROWS) -> list[tuple[int, int, int]]:
+    """Пачки PLANNED-получателей кампании: (первый id, последний id, строк)."""
+    with get_engine().connect() as conn:
+        return [
+            tuple(row)
+            for row in conn.execute(
+                text(BATCHES_SQL), {"campaign_id": campaign_id, "batch_rows": batch_rows}
+            )
+        ]
+
+
+def heartbeat(claim: Claim) -> bool:
+    """Продлить аренду. False — кампанию уже забрал другой экземпляр."""
+    with get_engine().begin() as conn:
+        result = conn.execute(
+            text(f"""
+                UPDATE campaigns
+                SET lease_until = {NOW_SQL} + make_interval(secs => :lease_seconds)
+                WHERE id = :campaign_id AND run_id = :run_id AND status = 'RUNNING'
+            """),
+            {
+                "campaign_id": claim.campaign_id,
+                "run_id": claim.run_id,
+                "lease_seconds": SCHEDULER_LEASE_SECONDS,
+            },
+        )
+        conn.execute(
+            text(f"UPDATE campaign_runs SET heartbeat_at = {NOW_SQL} WHERE id = :run_id"),
+            {"run_id": claim.run_id},
+        )
+    return result.rowcount == 1
+
+
+def finish_run(
+    claim: Claim,
+    batches: int,
+    recipients: int,
+    report: delivery.DeliveryReport,
+    error: str | None = None,
+) -> str:
+    """
+    Записать итоги запуска и перевести кампанию в следующий статус.
+
+    Возвращает новый статус кампании (или RUNNING, если аренду уже забрали).
+    """
+    done = report.sent + report.bounced
+    with get_engine().begin() as conn:
+        conn.execute(
+            text(f"""
+                UPDATE campaign_runs
+                SET status = :status,
+                    finished_at = {NOW_SQL},
+                    heartbeat_at = {NOW_SQL},
+                    batches = :batches,
+                    recipients = :recipients,
+                    sent = :sent,
+                    bounced = :bounced,
+                    deferred = :deferred,
+                    seconds = :seconds,
+                    messages_per_sec = :messages_per_sec,
+                    error = :error
+                WHERE id = :run_id AND finished_at IS NULL
+            """),
+            {
+                "run_id": claim.run_id,
+                "status": "FAILED" if error else "FINISHED",
+                "batches": batches,
+                "recipients": recipients,
+                "sent": report.sent,
+                "bounced": report.bounced,
+                "deferred": report.deferred,
+                "seconds": report.seconds,
+                "messages_per_sec": done / report.seconds if report.seconds > 0 else 0.0,
+                "error": error,
+            },
+        )
+
+        pending, runs = conn.execute(
+            text("""
+                SELECT
+                    EXISTS (
+                        SELECT 1 FROM campaign_clients
+                        WHERE campaign_id = :campaign_id AND status = 'PLANNED'
+                    ),
+                    (SELECT COUNT(*) FROM campaign_runs WHERE campaign_id = :campaign_id)
+            """),
+            {"campaign_id": claim.campaign_id},
+        ).one()
+        if not pending:
+            status = "FINISHED"
+        elif runs >= SCHEDULER_MAX_RUNS:
+            status = "CANCELLED"
+        else:
+            status = "SCHEDULED"
+
+        result = conn.execute(
+            text(f"""
+                UPDATE campaigns
+                SET status = :status,
+                    lease_until = NULL,
+                    planned_at = CASE
+                        WHEN :status = 'SCHEDULED'
+                            THEN {NOW_SQL} + make_interval(secs => :retry_seconds)
+                        ELSE planned_at
+                    END
+                WHERE id = :campaign_id AND run_id = :run_id AND status = 'RUNNING'
+            """),
+            {
+                "status": status,
+                "retry_seconds": SCHEDULER_RETRY_SECONDS,
+                "campaign_id": claim.campaign_id,
+                "run_id": claim.run_id,
+            },
+        )
+
+    invalidate("campaigns", "campaign_runs")
+    return status if result.rowcount == 1 else "RUNNING"
+
+
+def release(claim: Claim, error: str) -> None:
+    """Вернуть кампанию в SCHEDULED без задержки (остановка планировщика)."""
+    with get_engine().begin() as conn:
+        conn.execute(
+            text(f"""
+                UPDATE campaign_runs
+                SET status = 'FAILED', finished_at = {NOW_SQL}, error = :error
+                WHERE id = :run_id AND finished_at IS NULL
+            """),
+            {"run_id": claim.run_id, "error": error},
+        )
+        conn.execute(
+            text("""
+                UPDATE campaigns
+                SET status = 'SCHEDULED', lease_until = NULL
+                WHERE id = :campaign_id AND run_id = :run_id AND status = 'RUNNING'
+            """),
+            {"campaign_id": claim.campaign_id, "run_id": claim.run_id},
+        )
+    invalidate("campaigns", "campaign_runs")
+
+
+async def _keep_lease(claim: Claim) -> None:
+    while True:
+        await asyncio.sleep(SCHEDULER_HEARTBEAT_SECONDS)
+        if not await asyncio.to_thread(heartbeat, claim):
+            raise LeaseLost(f"Кампания {claim.campaign_id}: аренду забрал другой планировщик")
+
+
+async def _worker(
+    campaign_id: int,
+    batches: asyncio.Queue,
+    concurrency: int,
+    limiter: delivery.DomainRateLimiter,
+    reports: list[delivery.DeliveryReport],
+) -> None:
+    while True:
+        try:
+            first_id, last_id = batches.get_nowait()
+        except asyncio.QueueEmpty:
+            return
+        reports.append(await delivery.deliver_async(
+            campaign_id, concurrency, id_range=(first_id, last_id), limiter=limiter
+        ))
+
+
+async def _deliver_batches(
+    claim: Claim,
+    batches: list[tuple[int, int, int]],
+    workers: int,
+    concurrency: int,
+) -> list[delivery.DeliveryReport]:
+    queue = asyncio.Queue()
+    for first_id, last_id, _ in batches:
+        queue.put_nowait((first_id, last_id))
+    workers = max(1, min(workers, len(batches)))
+    limiter = delivery.new_limiter()
+    reports: list[delivery.DeliveryReport] = []
+
+    async with asyncio.TaskGroup() as group:
+        lease = group.create_task(_keep_lease(claim))
+        tasks = [
+            group.create_task(_worker(
+                claim.campaign_id, queue, max(1, concurrency // workers), limiter, reports
+            ))
+            for _ in range(workers)
+        ]
+        await asyncio.gather(*tasks)
+        lease.cancel()
+    return reports
+
+
+async def run_campaign(
+    claim: Claim,
+    workers: int = SCHEDULER_WORKERS,
+    concurrency: int = SCHEDULER_CONCURRENCY,
+    batch_rows: int = SCHEDULER_BATCH_ROWS,
+) -> RunReport:
+    """Отправить захваченную кампанию пачками и записать итоги запуска."""
+    started = time.perf_counter()
+    batches: list[tuple[int, int, int]] = []
+    reports: list[delivery.DeliveryReport] = []
+    error = None
+    try:
+        batches = await asyncio.to_thread(recipient_batches, claim.campaign_id, batch_rows)
+        if batches:
+            reports = await _deliver_batches(claim, batches, workers, concurrency)
+    except asyncio.CancelledError:
+        await asyncio.shield(asyncio.to_thread(release, claim, "планировщик остановлен"))
+        raise
+    except Exception as exc:
+        # в TaskGroup ошибки приходят группой: в журнал пишем первую
+        while isinstance(exc, BaseExceptionGroup) and exc.exceptions:
+            exc = exc.exceptions[0]
+        error = f"{type(exc).__name__}: {exc}"
+
+    total = delivery.DeliveryReport(
+        campaign_id=claim.campaign_id,
+        sent=sum(r.sent for r in reports),
+        bounced=sum(r.bounced for r in reports),
+        deferred=sum(r.deferred for r in reports),
+        seconds=time.perf_counter() - started,
+    )
+    recipients = sum(count for _, _, count in batches)
+    status = await asyncio.to_thread(finish_run, claim, len(batches), recipients, total, error)
+    return RunReport(
+        campaign_id=claim.campaign_id,
+        run_id=claim.run_id,
+        campaign_status=status,
+        batches=len(batches),
+        recipients=recipients,
+        sent=total.sent,
+        bounced=total.bounced,
+        deferred=total.deferred,
+        seconds=total.seconds,
+        error=error,
+    )
+
+
+async def run_due(
+    worker: str = WORKER_NAME,
+    limit: int = SCHEDULER_CLAIM_LIMIT,
+    workers: int = SCHEDULER_WORKERS,
+    concurrency: int = SCHEDULER_CONCURRENCY,
+) -> list[RunReport]:
+    """Один проход: захватить созревшие кампании и отправить их параллельно."""
+    claims = await asyncio.to_thread(claim_campaigns, worker, limit)
+    return list(await asyncio.gather(*(
+        run_campaign(claim, workers, concurrency) for claim in claims
+    )))
+
+
+def _print_report(report: RunReport) -> None:
+    line = (
+        f"Кампания {report.campaign_id} (запуск {report.run_id}) -> {report.campaign_status}: "
+        f"пачек {report.batches}, получателей {report.recipients}, "
+        f"отправлено {report.sent}, отказов {report.bounced}, отложено {report.deferred} "
+        f"за {report.seconds:.1f} с ({report.messages_per_sec:,.0f} писем/с)"
+    )
+    if report.error:
+        line += f", ошибка: {report.error}"
+    print(line, flush=True)
+
+
+async def serve(
+    worker: str = WORKER_NAME,
+    limit: int = SCHEDULER_CLAIM_LIMIT,
+    workers: int = SCHEDULER_WORKERS,
+    concurrency: int = SCHEDULER_CONCURRENCY,
+    once: bool = False,
+) -> None:
+    """Опрашивать БД и отправлять созревшие кампании (once — до первого пустого прохода)."""
+    while True:
+        try:
+            reports = await run_due(worker, limit, workers, concurrency)
+        except Exception as exc:
+            if once:
+                raise
+            print("Проход планировщика не удался:", exc, flush=True)
+            reports = []
+        for report in reports:
+            _print_report(report)
+        if not reports:
+            if once:
+                return
+            await asyncio.sleep(SCHEDULER_POLL_SECONDS)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Планировщик отправки кампаний")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="отправлять созревшие SCHEDULED-кампании")
+    run_parser.add_argument("--once", action="store_true", help="выйти, когда созревших кампаний не останется")
+    run_parser.add_argument("--workers", type=int, default=SCHEDULER_WORKERS)
+    run_parser.add_argument("--concurrency", type=int, default=SCHEDULER_CONCURRENCY)
+    run_parser.add_argument("--claim-limit", type=int, default=SCHEDULER_CLAIM_LIMIT)
+
+    runs_parser = commands.add_parser("runs", help="последние запуски кампаний")
+    runs_parser.add_argument("--limit", type=int, default=20)
+
+    args = parser.parse_args()
+
+    if args.command == "runs":
+        from db import get_campaign_runs
+
+        print(get_campaign_runs(args.limit).to_string(index=False))
+        return
+
+    print(f"Планировщик {WORKER_NAME}: воркеров {args.workers}, SMTP-соединений {args.concurrency}")
+    try:
+        asyncio.run(serve(WORKER_NAME, args.claim_limit, args.workers, args.concurrency, args.once))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
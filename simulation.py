@@ -0,0 +1,215 @@
+"""
+Векторизованная симуляция исходов отправки писем.
+
+Одним проходом NumPy генерирует для N получателей колонки
+status / sent_at / opened_at / clicked_at. Используется и в
+db.create_campaign_clients(), и в init_db.py (с разными настройками задержек).
+
+Для рассылок по аудитории, где получатели выбираются прямо в БД,
+те же распределения доступны в виде SQL (simulate_sends_sql).
+"""
+
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# Порядок важен: коды статусов — индексы в этом кортеже
+STATUSES = ("CLICKED", "OPENED", "SENT", "BOUNCED")
+
+
+@dataclass(frozen=True)
+class Delay:
+    """
+    Распределение задержки в минутах.
+
+    distribution:
+      "uniform"     — целое число минут равномерно из [low, high];
+      "exponential" — экспоненциальное со средним mean, обрезанное до [low, high].
+    """
+
+    low: int
+    high: int
+    distribution: str = "uniform"
+    mean: float | None = None
+
+    def sample(self, rng: np.random.Generator, size: int) -> np.ndarray:
+        if self.distribution == "uniform":
+            return rng.integers(self.low, self.high + 1, size=size)
+        if self.distribution == "exponential":
+            mean = self.mean if self.mean is not None else (self.high - self.low) / 3
+            values = self.low + rng.exponential(mean, size=size)
+            return np.clip(np.rint(values), self.low, self.high).astype(np.int64)
+        raise ValueError(f"Unknown delay distribution: {self.distribution!r}")
+
+    def sql(self) -> str:
+        """То же распределение как SQL-выражение (целые минуты, random() на строку)."""
+        if self.distribution == "uniform":
+            return f"(floor(random() * {self.high - self.low + 1})::int + {self.low})"
+        if self.distribution == "exponential":
+            mean = self.mean if self.mean is not None else (self.high - self.low) / 3
+            return (
+                f"LEAST({self.high}, GREATEST({self.low}, "
+                f"round({self.low} - {float(mean)!r} * ln(1 - random()))::int))"
+            )
+        raise ValueError(f"Unknown delay distribution: {self.distribution!r}")
+
+
+@dataclass(frozen=True)
+class SimulationConfig:
+    """
+    Вероятности статусов и задержки событий.
+
+    Доля BOUNCED — остаток: 1 - clicked - opened - sent.
+    """
+
+    clicked_share: float = 0.20
+    opened_share: float = 0.60
+    sent_share: float = 0.15
+    # сдвиг sent_at относительно базового времени
+    send_jitter: Delay = field(default_factory=lambda: Delay(-5, 5))
+    # opened_at для CLICKED и задержка клика после открытия
+    click_open_delay: Delay = field(default_factory=lambda: Delay(1, 60))
+    click_delay: Delay = field(default_factory=lambda: Delay(1, 30))
+    # opened_at для OPENED (без клика)
+    open_delay: Delay = field(default_factory=lambda: Delay(1, 90))
+
+    def __post_init__(self):
+        shares = (self.clicked_share, self.opened_share, self.sent_share)
+        if min(shares) < 0 or sum(shares) > 1:
+            raise ValueError("Status shares must be non-negative and sum to at most 1")
+
+    @property
+    def thresholds(self) -> np.ndarray:
+        return np.cumsum([self.clicked_share, self.opened_share, self.sent_share])
+
+
+# Отправка из интерфейса (db.create_campaign_clients)
+LIVE_SEND = SimulationConfig()
+
+# Исторические данные при наполнении БД (init_db.py)
+SEED_HISTORY = SimulationConfig(
+    send_jitter=Delay(-60, 0),
+    click_open_delay=Delay(1, 30),
+    click_delay=Delay(1, 15),
+    open_delay=Delay(1, 60),
+)
+
+
+def simulate_sends(
+    n: int,
+    base_time: datetime | pd.Timestamp | np.ndarray | pd.Series,
+    config: SimulationConfig = LIVE_SEND,
+    seed: int | np.random.Generator | None = None,
+) -> pd.DataFrame:
+    """
+    Сымитировать исходы отправки для n получателей.
+
+    base_time — одно время для всех или массив длины n (например, planned_at
+    кампании каждого получателя). Часовой пояс результата совпадает с base_time.
+
+    Возвращает DataFrame с колонками:
+      status     — категориальная (CLICKED / OPENED / SENT / BOUNCED);
+      sent_at    — datetime64;
+      opened_at  — datetime64, NaT если письмо не открыто;
+      clicked_at — datetime64, NaT если клика не было.
+    """
+    rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+
+    codes = np.searchsorted(config.thresholds, rng.random(n), side="right").astype(np.int8)
+    clicked = codes == 0
+    opened_only = codes == 1
+
+    if isinstance(base_time, (datetime, pd.Timestamp)):
+        base = pd.DatetimeIndex([base_time]).as_unit("us")
+        base_us = np.full(n, base.asi8[0], dtype=np.int64)
+    else:
+        base = pd.DatetimeIndex(base_time).as_unit("us")
+        if len(base) != n:
+            raise ValueError("base_time must be a scalar or have length n")
+        base_us = base.asi8
+
+    # Считаем в целых микросекундах (UTC), NaT — минимальное int64
+    minute_us = 60_000_000
+    nat = np.iinfo(np.int64).min
+    sent_us = base_us + config.send_jitter.sample(rng, n) * minute_us
+
+    opened_us = np.full(n, nat, dtype=np.int64)
+    opened_us[clicked] = (
+        sent_us[clicked]
+        + config.click_open_delay.sample(rng, int(clicked.sum())) * minute_us
+    )
+    opened_us[opened_only] = (
+        sent_us[opened_only]
+        + config.open_delay.sample(rng, int(opened_only.sum())) * minute_us
+    )
+
+    clicked_us = np.full(n, nat, dtype=np.int64)
+    clicked_us[clicked] = (
+        opened_us[clicked] + config.click_delay.sample(rng, int(clicked.sum())) * minute_us
+    )
+
+    def _as_datetime(values: np.ndarray) -> pd.DatetimeIndex:
+        index = pd.DatetimeIndex(values.view("M8[us]"))
+        if base.tz is not None:
+            index = index.tz_localize("UTC").tz_convert(base.tz)
+        return index
+
+    return pd.DataFrame(
+        {
+            "status": pd.Categorical.from_codes(codes, categories=STATUSES),
+            "sent_at": _as_datetime(sent_us),
+            "opened_at": _as_datetime(opened_us),
+            "clicked_at": _as_datetime(clicked_us),
+        }
+    )
+
+
+def simulate_sends_sql(source: str, config: SimulationConfig = LIVE_SEND) -> str:
+    """
+    SQL-версия simulate_sends для INSERT ... SELECT на стороне БД.
+
+    source — подзапрос с колонкой client_id. Базовое время — параметр
+    :sent_base (наивное UTC, как все timestamp в схеме), чтобы вызывающий
+    создал месячные секции для того же момента.
+    Возвращает SELECT с колонками client_id, sent_at, status, opened_at, clicked_at.
+    Подзапросы с random() в списке выборки PostgreSQL не разворачивает,
+    поэтому каждое случайное значение вычисляется ровно один раз на строку.
+    """
+    t_clicked, t_opened, t_sent = (float(t) for t in config.thresholds)
+    minute = "interval '1 minute'"
+
+    return f"""
+        SELECT
+            o.client_id,
+            o.sent_at,
+            o.status,
+            o.opened_at,
+            CASE WHEN o.status = 'CLICKED'
+                THEN o.opened_at + {config.click_delay.sql()} * {minute}
+            END AS clicked_at
+        FROM (
+            SELECT
+                s.client_id,
+                s.sent_at,
+                s.status,
+                CASE s.status
+                    WHEN 'CLICKED' THEN s.sent_at + {config.click_open_delay.sql()} * {minute}
+                    WHEN 'OPENED' THEN s.sent_at + {config.open_delay.sql()} * {minute}
+                END AS opened_at
+            FROM (
+                SELECT
+                    r.client_id,
+                    CAST(:sent_base AS timestamp) + {config.send_jitter.sql()} * {minute} AS sent_at,
+                    CASE
+                        WHEN r.u < {t_clicked!r} THEN 'CLICKED'
+                        WHEN r.u < {t_opened!r} THEN 'OPENED'
+                        WHEN r.u < {t_sent!r} THEN 'SENT'
+                        ELSE 'BOUNCED'
+                    END AS status
+                FROM (SELECT src.client_id, random() AS u FROM ({source}) src) r
+            ) s
+        ) o
+    """
@@ -0,0 +1,690 @@
+"""
+Локальный колоночный снимок истории отправок (Parquet).
+
+Снимок хранит campaign_clients и нужные аналитике измерения (название
+кампании, пол и сегмент клиента) в каталоге SNAPSHOT_DIR и синхронизируется
+инкрементально:
+
+  * новые строки — по водяному знаку cc.id (id > last_id), дописываются
+    новым файлом sends-NNNNNN.parquet;
+  * изменённые задним числом строки (смена статуса, открытие, клик) —
+    по campaign_clients.updated_at (миграция 006), попадают в delta-файл
+    sends-delta-NNNNNN.parquet, версии из delta перекрывают строки основных
+    файлов при чтении.
+
+Водяной знак updated_at — момент начала синхронизации или, если раньше,
+начало самой старой открытой в этот момент транзакции: updated_at = now()
+транзакции-писателя, поэтому всё, что не попало в снимок БД при синхронизации,
+имеет updated_at не меньше него. Так не теряются транзакции, которые начались
+раньше синхронизации, а закоммитились позже (в том числе вставки с меньшим id).
+Если роль приложения не видит чужие сессии в pg_stat_activity, можно задать
+дополнительный запас SNAPSHOT_OVERLAP_SECONDS; повторно прочитанные строки
+просто перезаписываются в delta.
+
+Когда delta разрастается или файлов становится много, снимок уплотняется:
+файлы переписываются по одному с применённой delta.
+
+Синхронизация и уплотнение выполняются по одной: блокировка потока
+(сессии Streamlit — потоки одного процесса) и flock на SNAPSHOT_DIR/.sync.lock
+(несколько процессов). Файлы не переписываются на месте: каждый delta-файл
+и каждый файл после уплотнения — новое имя, state.json указывает на текущие.
+Заменённые файлы удаляются не сразу, а при синхронизации не раньше чем
+через SNAPSHOT_RETIRE_SECONDS: читатель (в том числе процессы
+parallel_analytics), прочитавший старый state.json, успевает дочитать их.
+
+Чтение — pyarrow с memory-mapping, проекцией колонок и фильтрами по кампаниям
+и дате отправки (row group'ы отсекаются по статистике Parquet).
+Результат совпадает по форме с db.load_sends_frame().
+
+    python snapshot.py sync      # синхронизировать снимок
+    python snapshot.py status    # что лежит в снимке
+"""
+
+import argparse
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+import db
+from analytics import METRICS_COLUMNS, MetricsResult, compute_metrics
+from perf import timed
+
+try:
+    import fcntl
+except ImportError:  # Windows: только блокировка внутри процесса
+    fcntl = None
+
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "")
+# Как часто приложение досинхронизирует снимок перед показом аналитики
+SNAPSHOT_SYNC_SECONDS = int(os.getenv("SNAPSHOT_SYNC_SECONDS", "300"))
+SNAPSHOT_OVERLAP_SECONDS = int(os.getenv("SNAPSHOT_OVERLAP_SECONDS", "0"))
+# Сколько хранить файлы, заменённые уплотнением или новой delta
+SNAPSHOT_RETIRE_SECONDS = int(os.getenv("SNAPSHOT_RETIRE_SECONDS", "600"))
+
+# Уплотнять, если delta больше этой доли строк или файлов больше MAX_PARTS
+DELTA_COMPACT_RATIO = 0.1
+MAX_PARTS = 32
+# Размер файла после уплотнения и row group'ы внутри файла
+PART_TARGET_ROWS = 2_000_000
+ROW_GROUP_ROWS = 128_000
+# Примерный размер части для параллельного расчёта (parallel_analytics.py)
+PARTITION_ROWS = ROW_GROUP_ROWS * 8
+
+STATE_FILE = "state.json"
+LOCK_FILE = ".sync.lock"
+# delta-файл снимков, созданных до перехода на delta-файлы с номером
+DELTA_FILE = "sends-delta.parquet"
+CAMPAIGNS_FILE = "campaigns.parquet"
+CLIENTS_FILE = "clients.parquet"
+
+TIMESTAMP = pa.timestamp("us")
+
+SENDS_SCHEMA = pa.schema([
+    ("cc_id", pa.int32()),
+    ("campaign_id", pa.int32()),
+    ("client_id", pa.int32()),
+    ("sent_at", TIMESTAMP),
+    ("send_status", pa.string()),
+    ("opened_at", TIMESTAMP),
+    ("clicked_at", TIMESTAMP),
+    ("updated_at", TIMESTAMP),
+])
+
+CAMPAIGNS_SCHEMA = pa.schema([("id", pa.int32()), ("name", pa.string())])
+CLIENTS_SCHEMA = pa.schema([
+    ("id", pa.int32()), ("gender", pa.string()), ("segment", pa.string()),
+])
+
+SENDS_SELECT = """
+    SELECT
+        cc.id         AS cc_id,
+        cc.campaign_id,
+        cc.client_id,
+        cc.sent_at,
+        cc.status     AS send_status,
+        cc.opened_at,
+        cc.clicked_at,
+        cc.updated_at
+    FROM campaign_clients cc
+"""
+
+# Измерения, которые берутся из campaigns / clients: колонка -> (файл, ключ, значение)
+DIMENSION_COLUMNS = {
+    "campaign_name": (CAMPAIGNS_FILE, "campaign_id", "name"),
+    "gender": (CLIENTS_FILE, "client_id", "gender"),
+    "segment": (CLIENTS_FILE, "client_id", "segment"),
+}
+
+
+# Часть снимка для параллельного чтения: (файл, номера row group'ов,
+# delta-файл снимка на момент разбиения или None)
+Partition = tuple[str, tuple[int, ...], str | None]
+
+
+@dataclass(frozen=True)
+class SyncReport:
+    """Итог sync(): сколько строк пришло и в каком состоянии снимок."""
+
+    new_rows: int
+    changed_rows: int
+    total_rows: int
+    delta_rows: int
+    parts: int
+    compacted: bool
+    seconds: float
+
+
+def enabled() -> bool:
+    """Снимок включён, если задан каталог SNAPSHOT_DIR."""
+    return bool(SNAPSHOT_DIR)
+
+
+def _path(name: str) -> str:
+    return os.path.join(SNAPSHOT_DIR, name)
+
+
+def _empty_state() -> dict:
+    return {
+        "last_id": 0,
+        "updated_watermark": None,
+        "parts": [],
+        "next_part": 0,
+        "delta_rows": 0,
+        "delta_file": None,
+        # заменённые файлы: [{"file", "retired_at"}], удаляются _purge_retired()
+        "retired": [],
+        "synced_at": None,
+    }
+
+
+def _load_state() -> dict:
+    try:
+        with open(_path(STATE_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return _empty_state()
+
+
+def _delta_file(state: dict) -> str:
+    return state.get("delta_file") or DELTA_FILE
+
+
+def _retire(state: dict, names: list[str]) -> None:
+    now = time.time()
+    retired = state.setdefault("retired", [])
+    for name in names:
+        if os.path.exists(_path(name)):
+            retired.append({"file": name, "retired_at": now})
+
+
+def _purge_retired(state: dict) -> None:
+    """Удалить заменённые файлы старше SNAPSHOT_RETIRE_SECONDS."""
+    keep = []
+    for item in state.get("retired", []):
+        if time.time() - item["retired_at"] < SNAPSHOT_RETIRE_SECONDS:
+            keep.append(item)
+        elif os.path.exists(_path(item["file"])):
+            os.remove(_path(item["file"]))
+    state["retired"] = keep
+
+
+_sync_thread_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def _sync_lock():
+    """Синхронизация и уплотнение — по одной на каталог снимка."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    with _sync_thread_lock, open(_path(LOCK_FILE), "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _replace_file(tmp_path: str, name: str) -> None:
+    os.replace(tmp_path, _path(name))
+
+
+def _save_state(state: dict) -> None:
+    # state.json пишется последним: читатели видят либо старый, либо новый снимок
+    tmp_path = _path(STATE_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    _replace_file(tmp_path, STATE_FILE)
+
+
+def _to_table(frame: pd.DataFrame, schema: pa.Schema) -> pa.Table:
+    frame = frame[schema.names].copy()
+    for field in schema:
+        # колонки из одних NULL приходят как object
+        if pa.types.is_timestamp(field.type) and frame[field.name].dtype == object:
+            frame[field.name] = pd.to_datetime(frame[field.name])
+    return pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+
+
+def _write_table(table: pa.Table, name: str) -> None:
+    tmp_path = _path(name + ".tmp")
+    pq.write_table(table, tmp_path, row_group_size=ROW_GROUP_ROWS)
+    _replace_file(tmp_path, name)
+
+
+# ---------- синхронизация ----------
+
+def _sync_new_rows(conn, state: dict, chunksize: int) -> int:
+    """Дописать строки с id > last_id новым файлом. Возвращает число строк."""
+    name = f"sends-{state['next_part']:06d}.parquet"
+    tmp_path = _path(name + ".tmp")
+    writer = None
+    rows = 0
+    last_id = state["last_id"]
+
+    sql = text(SENDS_SELECT + " WHERE cc.id > :last_id ORDER BY cc.id")
+    try:
+        for chunk in pd.read_sql(sql, conn, params={"last_id": last_id}, chunksize=chunksize):
+            if chunk.empty:
+                continue
+            if writer is None:
+                writer = pq.ParquetWriter(tmp_path, SENDS_SCHEMA)
+            writer.write_table(_to_table(chunk, SENDS_SCHEMA), row_group_size=ROW_GROUP_ROWS)
+            rows += len(chunk)
+            last_id = int(chunk["cc_id"].iloc[-1])
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if rows:
+        _replace_file(tmp_path, name)
+        state["parts"].append({
+            "file": name, "id_from": state["last_id"], "id_to": last_id, "rows": rows,
+        })
+        state["next_part"] += 1
+        state["last_id"] = last_id
+    return rows
+
+
+def _read_delta(state: dict) -> pd.DataFrame:
+    if not state["delta_rows"] or not os.path.exists(_path(_delta_file(state))):
+        return SENDS_SCHEMA.empty_table().to_pandas()
+    return pq.read_table(_path(_delta_file(state)), memory_map=True).to_pandas()
+
+
+def _sync_changed_rows(conn, state: dict) -> int:
+    """Перечитать строки id <= last_id, изменённые после водяного знака, в delta."""
+    if state["updated_watermark"] is None or not state["parts"]:
+        return 0
+
+    since = (
+        pd.Timestamp(state["updated_watermark"])
+        - timedelta(seconds=SNAPSHOT_OVERLAP_SECONDS)
+    ).to_pydatetime()
+    changed = pd.read_sql(
+        text(SENDS_SELECT + " WHERE cc.updated_at >= :since AND cc.id <= :last_id"),
+        conn,
+        params={"since": since, "last_id": state["last_id"]},
+    )
+    if changed.empty:
+        return 0
+
+    delta = pd.concat([_read_delta(state), changed], ignore_index=True)
+    delta = delta.drop_duplicates("cc_id", keep="last").sort_values("cc_id")
+    # новое имя: читатели старого state.json дочитывают прежний delta-файл
+    name = f"sends-delta-{state['next_part']:06d}.parquet"
+    state["next_part"] += 1
+    _write_table(_to_table(delta, SENDS_SCHEMA), name)
+    if state["delta_rows"]:
+        _retire(state, [_delta_file(state)])
+    state["delta_file"] = name
+    state["delta_rows"] = len(delta)
+    return len(changed)
+
+
+def _sync_dimensions(conn) -> None:
+    """Таблицы измерений небольшие и переписываются целиком."""
+    campaigns = pd.read_sql(text("SELECT id, name FROM campaigns"), conn)
+    _write_table(_to_table(campaigns, CAMPAIGNS_SCHEMA), CAMPAIGNS_FILE)
+    clients = pd.read_sql(text("SELECT id, gender, segment FROM clients"), conn)
+    _write_table(_to_table(clients, CLIENTS_SCHEMA), CLIENTS_FILE)
+
+
+def _compact(state: dict) -> None:
+    """
+    Переписать файлы с применённой delta, объединяя мелкие файлы
+    до PART_TARGET_ROWS. В памяти держится один исходный файл.
+    """
+    delta = pq.read_table(_path(_delta_file(state))) if state["delta_rows"] else None
+    delta_ids = delta["cc_id"] if delta is not None else None
+
+    old_files = [part["file"] for part in state["parts"]]
+    if state["delta_rows"]:
+        old_files.append(_delta_file(state))
+    new_parts = []
+    current = None
+
+    def _close(part: dict) -> None:
+        part["writer"].close()
+        _replace_file(_path(part["file"] + ".tmp"), part["file"])
+        del part["writer"]
+        new_parts.append(part)
+
+    for part in state["parts"]:
+        table = pq.read_table(_path(part["file"]), memory_map=True)
+        if delta is not None:
+            table = table.filter(pc.invert(pc.is_in(table["cc_id"], value_set=delta_ids)))
+            in_range = pc.and_(
+                pc.greater(delta["cc_id"], part["id_from"]),
+                pc.less_equal(delta["cc_id"], part["id_to"]),
+            )
+            table = pa.concat_tables([table, delta.filter(in_range)])
+            table = table.sort_by("cc_id")
+
+        if current is None:
+            name = f"sends-{state['next_part']:06d}.parquet"
+            state["next_part"] += 1
+            current = {
+                "file": name, "id_from": part["id_from"], "id_to": part["id_to"], "rows": 0,
+                "writer": pq.ParquetWriter(_path(name + ".tmp"), SENDS_SCHEMA),
+            }
+        current["writer"].write_table(table, row_group_size=ROW_GROUP_ROWS)
+        current["id_to"] = part["id_to"]
+        current["rows"] += table.num_rows
+        if current["rows"] >= PART_TARGET_ROWS:
+            _close(current)
+            current = None
+
+    if current is not None:
+        _close(current)
+
+    state["parts"] = new_parts
+    state["delta_rows"] = 0
+    state["delta_file"] = None
+    # старые файлы ещё могут читать: удалятся позже (_purge_retired)
+    _retire(state, old_files)
+    _save_state(state)
+
+
+def _needs_compaction(state: dict) -> bool:
+    total = sum(part["rows"] for part in state["parts"])
+    return len(state["parts"]) > MAX_PARTS or (
+        state["delta_rows"] > 0 and state["delta_rows"] > DELTA_COMPACT_RATIO * total
+    )
+
+
+@timed
+def sync(chunksize: int = db.LOAD_CHUNK_ROWS) -> SyncReport:
+    """
+    Досинхронизировать снимок с БД.
+
+    Все запросы выполняются в одной REPEATABLE READ транзакции, поэтому
+    новые строки, изменения и измерения согласованы между собой.
+    Одновременные вызовы (потоки и процессы) выполняются по очереди.
+    """
+    if not enabled():
+        raise RuntimeError("SNAPSHOT_DIR is not set")
+    with _sync_lock():
+        return _sync(chunksize)
+
+
+def _sync(chunksize: int = db.LOAD_CHUNK_ROWS) -> SyncReport:
+    """sync() под уже взятой _sync_lock()."""
+    started = time.perf_counter()
+    state = _load_state()
+    _purge_retired(state)
+
+    with db.get_engine().connect() as conn:
+        conn = conn.execution_options(
+            isolation_level="REPEATABLE READ",
+            stream_results=True,
+            max_row_buffer=chunksize,
+        )
+        # первый запрос фиксирует снимок БД для всей транзакции
+        watermark = db.updated_watermark(conn)
+        # изменения — до дописывания новых строк: они касаются только id <= last_id
+        changed_rows = _sync_changed_rows(conn, state)
+        new_rows = _sync_new_rows(conn, state, chunksize)
+        _sync_dimensions(conn)
+
+    state["updated_watermark"] = watermark.isoformat()
+    state["synced_at"] = datetime.now().isoformat()
+    _save_state(state)
+
+    compacted = _needs_compaction(state)
+    if compacted:
+        _compact(state)
+
+    return SyncReport(
+        new_rows=new_rows,
+        changed_rows=changed_rows,
+        total_rows=sum(part["rows"] for part in state["parts"]),
+        delta_rows=state["delta_rows"],
+        parts=len(state["parts"]),
+        compacted=compacted,
+        seconds=time.perf_counter() - started,
+    )
+
+
+def _is_stale(max_age_seconds: int) -> bool:
+    synced_at = _load_state()["synced_at"]
+    if synced_at is None:
+        return True
+    age = datetime.now() - datetime.fromisoformat(synced_at)
+    return age.total_seconds() >= max_age_seconds
+
+
+def sync_if_stale(max_age_seconds: int = SNAPSHOT_SYNC_SECONDS) -> SyncReport | None:
+    """Синхронизировать, если с прошлой синхронизации прошло больше max_age_seconds."""
+    if not _is_stale(max_age_seconds):
+        return None
+    with _sync_lock():
+        # пока ждали блокировку, снимок могла обновить другая сессия
+        if not _is_stale(max_age_seconds):
+            return None
+        return _sync()
+
+
+# ---------- чтение ----------
+
+@functools.lru_cache(maxsize=8)
+def _dimension(name: str, value: str, mtime: float) -> tuple[pd.Index, pd.Categorical]:
+    """
+    Индекс id и значения измерения как category. Кэшируется между чтениями
+    (mtime в ключе — перечитать после синхронизации): при чтении по частям
+    хэш-таблица id строится один раз на процесс.
+    """
+    frame = pq.read_table(_path(name), columns=["id", value], memory_map=True).to_pandas()
+    return pd.Index(frame["id"].to_numpy()), pd.Categorical(frame[value])
+
+
+def _lookup(keys: pd.Series, index: pd.Index, dictionary: pd.Categorical) -> pd.Categorical:
+    """Значения измерения по ключам как category (коды вместо строк на каждую строку)."""
+    positions = index.get_indexer(keys.to_numpy())
+    codes = np.where(positions >= 0, dictionary.codes[positions], -1)
+    return pd.Categorical.from_codes(codes, dictionary.categories)
+
+
+@timed
+def read_sends(
+    columns: tuple[str, ...] = db.ANALYTICS_SEND_COLUMNS,
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    partition: Partition | None = None,
+) -> pd.DataFrame:
+    """
+    Прочитать отправки из снимка (как db.load_sends_frame(), без обращения к БД).
+
+    Читаются только нужные колонки; фильтры по кампаниям и дате отправки
+    (включительно) передаются в pyarrow и отсекают row group'ы по статистике.
+    partition — одна часть из partitions(): читается только она, delta
+    берётся та же, что при разбиении (файлы после уплотнения ещё живы).
+    """
+    unknown = set(columns) - set(SENDS_SCHEMA.names) - set(DIMENSION_COLUMNS)
+    if unknown:
+        raise ValueError(f"Неизвестные колонки: {sorted(unknown)}")
+
+    if partition is not None:
+        delta_file = partition[2]
+    else:
+        state = _load_state()
+        delta_file = _delta_file(state) if state["delta_rows"] else None
+
+    fact_columns = [c for c in SENDS_SCHEMA.names if c in columns]
+    for column in columns:
+        if column in DIMENSION_COLUMNS and DIMENSION_COLUMNS[column][1] not in fact_columns:
+            fact_columns.append(DIMENSION_COLUMNS[column][1])
+    read_columns = list(fact_columns)
+    if delta_file is not None and "cc_id" not in read_columns:
+        read_columns.append("cc_id")
+
+    filters = []
+    if campaign_ids:
+        filters.append(("campaign_id", "in", [int(cid) for cid in campaign_ids]))
+    if date_from is not None:
+        filters.append(("sent_at", ">=", pd.Timestamp(date_from)))
+    if date_to is not None:
+        filters.append(("sent_at", "<", pd.Timestamp(date_to) + timedelta(days=1)))
+
+    read_dictionary = ["send_status"] if "send_status" in read_columns else None
+
+    def _read(name: str, row_groups: tuple[int, ...] | None) -> pa.Table:
+        if row_groups is None:
+            return pq.read_table(
+                _path(name),
+                columns=read_columns,
+                filters=filters or None,
+                memory_map=True,
+                read_dictionary=read_dictionary,
+            )
+        table = pq.ParquetFile(
+            _path(name), memory_map=True, read_dictionary=read_dictionary,
+        ).read_row_groups(list(row_groups), columns=read_columns)
+        return table.filter(pq.filters_to_expression(filters)) if filters else table
+
+    if partition is not None:
+        selected = [partition[:2]]
+    else:
+        selected = [(part["file"], None) for part in state["parts"]]
+        if delta_file is not None:
+            selected.append((delta_file, None))
+
+    # id из delta исключаются из основных файлов целиком, даже если новая
+    # версия строки под фильтр уже не попадает
+    delta_ids = (
+        pq.read_table(_path(delta_file), columns=["cc_id"])["cc_id"]
+        if delta_file is not None else None
+    )
+
+    tables = []
+    for name, row_groups in selected:
+        table = _read(name, row_groups)
+        if delta_ids is not None and name != delta_file:
+            table = table.filter(pc.invert(pc.is_in(table["cc_id"], value_set=delta_ids)))
+        tables.append(table)
+
+    if tables:
+        df = pa.concat_tables(tables).to_pandas()
+    else:
+        df = SENDS_SCHEMA.empty_table().select(read_columns).to_pandas()
+    if "send_status" in df.columns:
+        df["send_status"] = df["send_status"].astype("category")
+
+    for column in columns:
+        if column not in DIMENSION_COLUMNS:
+            continue
+        name, key, value = DIMENSION_COLUMNS[column]
+        if os.path.exists(_path(name)):
+            index, dictionary = _dimension(name, value, os.path.getmtime(_path(name)))
+        else:
+            index, dictionary = pd.Index([]), pd.Categorical([])
+        df[column] = _lookup(df[key], index, dictionary)
+
+    return df[list(columns)]
+
+
+@timed
+def get_sent_date_bounds(
+    campaign_ids: list[int] | None = None,
+) -> tuple[date | None, date | None]:
+    """То же, что db.get_sent_date_bounds(), по снимку."""
+    sent_at = read_sends(("sent_at",), campaign_ids)["sent_at"]
+    if sent_at.empty:
+        return None, None
+    return sent_at.min().date(), sent_at.max().date()
+
+
+@timed
+def get_campaign_metrics(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+) -> MetricsResult:
+    """То же, что db.get_campaign_metrics(), но считается в памяти по снимку."""
+    df = read_sends(METRICS_COLUMNS, campaign_ids, date_from, date_to)
+    return compute_metrics(df)
+
+
+def _row_group_matches(
+    row_group: pq.RowGroupMetaData,
+    campaign_ids: list[int] | None,
+    date_from: date | None,
+    date_to: date | None,
+) -> bool:
+    """Может ли в row group быть строка под фильтр (по min / max; без статистики — да)."""
+    def _bounds(column: str):
+        stats = row_group.column(SENDS_SCHEMA.get_field_index(column)).statistics
+        if stats is None or not stats.has_min_max:
+            return None
+        return stats.min, stats.max
+
+    if campaign_ids:
+        bounds = _bounds("campaign_id")
+        if bounds is not None and not any(bounds[0] <= cid <= bounds[1] for cid in campaign_ids):
+            return False
+    bounds = _bounds("sent_at") if date_from is not None or date_to is not None else None
+    if bounds is not None:
+        if date_from is not None and pd.Timestamp(bounds[1]) < pd.Timestamp(date_from):
+            return False
+        if date_to is not None and pd.Timestamp(bounds[0]) >= pd.Timestamp(date_to) + timedelta(days=1):
+            return False
+    return True
+
+
+def partitions(
+    campaign_ids: list[int] | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    target_rows: int = PARTITION_ROWS,
+) -> list[Partition]:
+    """
+    Разбить снимок на части для параллельного чтения: (файл, номера row group'ов,
+    delta-файл) примерно по target_rows строк. Части не пересекаются, вместе дают то же,
+    что read_sends(); row group'ы, которые не проходят фильтр по статистике,
+    в части не попадают.
+    """
+    state = _load_state()
+    delta_file = _delta_file(state) if state["delta_rows"] else None
+    names = [part["file"] for part in state["parts"]]
+    if delta_file is not None:
+        names.append(delta_file)
+
+    result = []
+    for name in names:
+        metadata = pq.ParquetFile(_path(name), memory_map=True).metadata
+        groups, rows = [], 0
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            if not _row_group_matches(row_group, campaign_ids, date_from, date_to):
+                continue
+            groups.append(i)
+            rows += row_group.num_rows
+            if rows >= target_rows:
+                result.append((name, tuple(groups), delta_file))
+                groups, rows = [], 0
+        if groups:
+            result.append((name, tuple(groups), delta_file))
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Локальный снимок истории отправок")
+    parser.add_argument("command", choices=["sync", "status"])
+    args = parser.parse_args()
+
+    if not enabled():
+        raise SystemExit("Задайте каталог снимка в переменной SNAPSHOT_DIR")
+
+    if args.command == "sync":
+        report = sync()
+        print(
+            f"Новых строк: {report.new_rows}, изменённых: {report.changed_rows}, "
+            f"всего: {report.total_rows} (delta {report.delta_rows}, "
+            f"файлов {report.parts}{', уплотнён' if report.compacted else ''}) "
+            f"за {report.seconds:.2f} с"
+        )
+    else:
+        state = _load_state()
+        total = sum(part["rows"] for part in state["parts"])
+        print(f"Каталог: {SNAPSHOT_DIR}")
+        print(f"Строк: {total}, delta: {state['delta_rows']}, файлов: {len(state['parts'])}")
+        print(f"last_id: {state['last_id']}, updated_at: {state['updated_watermark']}")
+        print(f"Синхронизирован: {state['synced_at'] or 'никогда'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,513 @@
+"""
+Сбор открытий и кликов по письмам: HTTP-коллектор с пакетной записью в БД.
+
+Коллектор (asyncio, HTTP/1.1 с keep-alive) принимает:
+
+    GET  /o/<send_id>?s=<sig>          — пиксель открытия (отдаёт GIF 1x1);
+    GET  /c/<send_id>?u=<url>&s=<sig>  — клик по ссылке (302 на url, только http/https);
+    POST /events                       — пачка событий, по строке "open|click <send_id> [unix_ts]",
+                                         с заголовком "Authorization: Bearer <TRACKING_SECRET>".
+
+Ссылки из open_url() / click_url() подписаны HMAC-SHA256 от (вид события,
+send_id[, url]) ключом TRACKING_SECRET: без верной подписи коллектор
+отвечает 403, ничего не записывает и не редиректит — подделать события
+по чужим send_id или использовать /c/ как открытый редирект нельзя.
+
+send_id — campaign_clients.id. События копятся в памяти с дедупликацией:
+на каждую отправку хранится только самое раннее открытие и самый ранний
+клик. Раз в TRACKING_FLUSH_SECONDS (или когда в буфере TRACKING_FLUSH_EVENTS
+отправок) буфер сбрасывается: COPY во временную таблицу и одно
+множественное обновление campaign_clients (opened_at / clicked_at / статус)
+с пересчётом rollup-таблиц по разнице (rollups.apply_engagement).
+Пока идёт запись, новые события копятся в новом буфере.
+
+События по отправкам, которые ещё не в статусе SENT / OPENED / CLICKED
+(например, delivery.py ещё не записал статус), повторяются в следующих
+TRACKING_RETRY_FLUSHES сбросах, затем отбрасываются. Так же считаются
+попытки пачки, запись которой упала целиком: после TRACKING_RETRY_FLUSHES
+неудач её события отбрасываются (или дописываются в TRACKING_DEAD_LETTER
+строками формата POST /events, чтобы отправить их заново), и одна
+испорченная пачка не останавливает сбор. send_id вне int4 и нечисловые
+или выходящие за допустимый диапазон unix_ts отклоняются ответом 400.
+
+    TRACKING_SECRET=... python tracking.py serve --port 8080
+    TRACKING_BASE_URL=https://t.example.com — для open_url() / click_url()
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from urllib.parse import parse_qs, quote, urlsplit
+
+from sqlalchemy import text
+
+import rollups
+from bulk import copy_rows
+from cache import invalidate
+from db import get_engine
+from perf import timed
+
+
+TRACKING_FLUSH_SECONDS = float(os.getenv("TRACKING_FLUSH_SECONDS", "1.0"))
+TRACKING_FLUSH_EVENTS = int(os.getenv("TRACKING_FLUSH_EVENTS", "50000"))
+TRACKING_RETRY_FLUSHES = int(os.getenv("TRACKING_RETRY_FLUSHES", "3"))
+TRACKING_BASE_URL = os.getenv("TRACKING_BASE_URL", "http://localhost:8080")
+# Ключ подписи ссылок и токен POST /events; без него коллектор не запускается
+TRACKING_SECRET = os.getenv("TRACKING_SECRET", "")
+# Файл для событий, отброшенных после неудачных сбросов ("" — не сохранять)
+TRACKING_DEAD_LETTER = os.getenv("TRACKING_DEAD_LETTER", "")
+
+# campaign_clients.id — int4
+MAX_SEND_ID = 2**31 - 1
+# unix_ts от 1970 года до конца 9999 года (диапазон timestamp в PostgreSQL шире)
+MAX_EPOCH = 253_402_300_799
+
+OPEN, CLICK = "open", "click"
+
+STAGE_TABLE = "tracking_events_stage"
+
+CREATE_STAGE_SQL = f"""
+    CREATE TEMP TABLE IF NOT EXISTS {STAGE_TABLE} (
+        send_id       int,
+        opened_epoch  double precision,
+        clicked_epoch double precision
+    ) ON COMMIT DELETE ROWS
+"""
+
+# Строки блокируются в порядке id, чтобы параллельные сбросы не ловили deadlock.
+# Клик считается и открытием; opened_at / clicked_at — самые ранние события.
+MERGE_SQL = f"""
+    WITH events AS (
+        SELECT
+            send_id,
+            to_timestamp(opened_epoch) AT TIME ZONE 'UTC' AS opened_at,
+            to_timestamp(clicked_epoch) AT TIME ZONE 'UTC' AS clicked_at
+        FROM {STAGE_TABLE}
+    ),
+    target AS (
+        SELECT
+            cc.id, cc.campaign_id, cc.client_id, cc.sent_at,
+            cc.status AS old_status,
+            cc.opened_at AS old_opened_at,
+            cc.clicked_at AS old_clicked_at,
+            LEAST(cc.opened_at, e.opened_at, e.clicked_at) AS new_opened_at,
+            LEAST(cc.clicked_at, e.clicked_at) AS new_clicked_at
+        FROM events e
+        JOIN campaign_clients cc ON cc.id = e.send_id
+        WHERE UPPER(cc.status) IN ('SENT', 'OPENED', 'CLICKED')
+        ORDER BY cc.id
+        FOR UPDATE OF cc
+    ),
+    merged AS (
+        SELECT
+            t.*,
+            CASE WHEN t.new_clicked_at IS NOT NULL THEN 'CLICKED' ELSE 'OPENED' END AS new_status
+        FROM target t
+    ),
+    updated AS (
+        UPDATE campaign_clients cc
+        SET opened_at = m.new_opened_at,
+            clicked_at = m.new_clicked_at,
+            status = m.new_status
+        FROM merged m
+        WHERE cc.id = m.id
+          AND cc.sent_at = m.sent_at
+          AND (m.old_opened_at IS DISTINCT FROM m.new_opened_at
+               OR m.old_clicked_at IS DISTINCT FROM m.new_clicked_at
+               OR UPPER(m.old_status) <> m.new_status)
+        RETURNING cc.id
+    )
+    INSERT INTO {rollups.ENGAGEMENT_TABLE}
+        (id, campaign_id, client_id, sent_at, changed, old_status, new_status,
+         old_opened_at, new_opened_at, old_clicked_at, new_clicked_at)
+    SELECT
+        m.id, m.campaign_id, m.client_id, m.sent_at, u.id IS NOT NULL,
+        m.old_status, m.new_status,
+        m.old_opened_at, m.new_opened_at, m.old_clicked_at, m.new_clicked_at
+    FROM merged m
+    LEFT JOIN updated u ON u.id = m.id
+"""
+
+FORBIDDEN = ("403 Forbidden", [], b"forbidden")
+
+# 1x1 прозрачный GIF
+PIXEL = bytes.fromhex(
+    "47494638396101000100800000000000ffffff21f90401000000002c00000000010001000002024401003b"
+)
+
+
+@dataclass(frozen=True)
+class MergeReport:
+    # отправок в пачке (после дедупликации)
+    sends: int
+    # найдено строк в статусе SENT / OPENED / CLICKED
+    matched: int
+    # из них реально изменилось
+    changed: int
+    # не найдены: отложены до следующего сброса
+    retried: int
+    # не найдены после всех повторов
+    dropped: int
+    seconds: float
+
+
+def _secret() -> bytes:
+    if not TRACKING_SECRET:
+        raise RuntimeError("TRACKING_SECRET is not set")
+    return TRACKING_SECRET.encode()
+
+
+def sign(kind: str, send_id: int, url: str = "") -> str:
+    """Подпись ссылки: HMAC-SHA256 (128 бит, base64url без '=')."""
+    message = f"{kind}\n{send_id}\n{url}".encode()
+    digest = hmac.new(_secret(), message, hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def verify(signature: str, kind: str, send_id: int, url: str = "") -> bool:
+    return hmac.compare_digest(signature, sign(kind, send_id, url))
+
+
+def open_url(send_id: int) -> str:
+    return f"{TRACKING_BASE_URL}/o/{send_id}?s={sign(OPEN, send_id)}"
+
+
+def click_url(send_id: int, url: str) -> str:
+    return f"{TRACKING_BASE_URL}/c/{send_id}?u={quote(url, safe='')}&s={sign(CLICK, send_id, url)}"
+
+
+def events_authorized(authorization: str) -> bool:
+    """Заголовок Authorization запроса POST /events: "Bearer <TRACKING_SECRET>"."""
+    return hmac.compare_digest(authorization.encode(), b"Bearer " + _secret())
+
+
+def parse_send_id(value: str) -> int:
+    """send_id из запроса; ValueError, если это не положительный int4."""
+    send_id = int(value)
+    if not 0 < send_id <= MAX_SEND_ID:
+        raise ValueError(f"send_id out of range: {send_id}")
+    return send_id
+
+
+def parse_epoch(value: str) -> float:
+    """unix_ts из запроса; ValueError для nan / inf и значений вне [0, MAX_EPOCH]."""
+    at = float(value)
+    if not math.isfinite(at) or not 0 <= at <= MAX_EPOCH:
+        raise ValueError(f"timestamp out of range: {value}")
+    return at
+
+
+@timed
+def merge_events(rows: list[tuple[int, float | None, float | None]]) -> tuple[int, int, list[int]]:
+    """
+    Применить пачку событий (send_id, opened_epoch, clicked_epoch) одной транзакцией.
+
+    Возвращает (найдено строк, изменено строк, send_id, которые не найдены).
+    """
+    if not rows:
+        return 0, 0, []
+
+    with get_engine().begin() as conn:
+        conn.execute(text(CREATE_STAGE_SQL))
+        conn.execute(text(rollups.CREATE_ENGAGEMENT_SQL))
+        with conn.connection.cursor() as cur:
+            copy_rows(cur, STAGE_TABLE, ("send_id", "opened_epoch", "clicked_epoch"), rows)
+
+        conn.execute(text(MERGE_SQL))
+        matched, changed = conn.execute(text(f"""
+            SELECT COUNT(*), COUNT(*) FILTER (WHERE changed) FROM {rollups.ENGAGEMENT_TABLE}
+        """)).one()
+        if changed:
+            rollups.apply_engagement(conn)
+        missing = list(conn.execute(text(f"""
+            SELECT s.send_id
+            FROM {STAGE_TABLE} s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM {rollups.ENGAGEMENT_TABLE} e WHERE e.id = s.send_id
+            )
+        """)).scalars())
+
+    if changed:
+        invalidate("campaign_clients", "campaign_daily_stats", "client_activity", "campaign_daily_sketches")
+    return matched, changed, missing
+
+
+class EventBuffer:
+    """
+    События в памяти: send_id -> [самое раннее открытие, самый ранний клик]
+    (unix-время). Используется из одного event loop, без блокировок.
+    """
+
+    def __init__(self):
+        self.events: dict[int, list] = {}
+        self.received = 0
+        # send_id -> сколько сбросов событие уже не нашло строку
+        self._attempts: dict[int, int] = {}
+        self._retry: dict[int, list] = {}
+
+    def add(self, send_id: int, kind: str, at: float) -> None:
+        self.received += 1
+        slot = self.events.get(send_id)
+        if slot is None:
+            slot = self.events[send_id] = [None, None]
+        i = 0 if kind == OPEN else 1
+        if slot[i] is None or at < slot[i]:
+            slot[i] = at
+
+    def __len__(self) -> int:
+        return len(self.events)
+
+    def drain(self) -> list[tuple[int, float | None, float | None]]:
+        """Забрать накопленное (вместе с отложенными повторами) и начать новый буфер."""
+        events, self.events = self.events, {}
+        for send_id, (opened, clicked) in self._retry.items():
+            slot = events.setdefault(send_id, [None, None])
+            slot[0] = min(filter(None, (slot[0], opened)), default=None)
+            slot[1] = min(filter(None, (slot[1], clicked)), default=None)
+        self._retry = {}
+        return [(send_id, opened, clicked) for send_id, (opened, clicked) in events.items()]
+
+    def restore(self, rows: list[tuple]) -> list[tuple]:
+        """
+        Вернуть пачку в буфер целиком (запись не удалась). Попытки считаются
+        как в requeue(): события, не записанные за TRACKING_RETRY_FLUSHES
+        сбросов, не возвращаются, а отдаются вызывающему.
+        """
+        dropped = []
+        for row in rows:
+            send_id, opened, clicked = row
+            attempts = self._attempts.get(send_id, 0) + 1
+            if attempts > TRACKING_RETRY_FLUSHES:
+                self._attempts.pop(send_id, None)
+                dropped.append(row)
+                continue
+            self._attempts[send_id] = attempts
+            self._retry[send_id] = [opened, clicked]
+        return dropped
+
+    def requeue(self, rows: list[tuple], missing: list[int]) -> tuple[int, int]:
+        """Отложить ненайденные события до следующего сброса. Возвращает (отложено, отброшено)."""
+        missing = set(missing)
+        retried = dropped = 0
+        for send_id, opened, clicked in rows:
+            if send_id not in missing:
+                self._attempts.pop(send_id, None)
+                continue
+            attempts = self._attempts.get(send_id, 0) + 1
+            if attempts > TRACKING_RETRY_FLUSHES:
+                self._attempts.pop(send_id, None)
+                dropped += 1
+                continue
+            self._attempts[send_id] = attempts
+            self._retry[send_id] = [opened, clicked]
+            retried += 1
+        return retried, dropped
+
+
+class TrackingCollector:
+    """HTTP-коллектор событий с периодическим сбросом буфера в БД."""
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 8080, merge=merge_events):
+        self.host = host
+        self.port = port
+        self.buffer = EventBuffer()
+        self.reports: list[MergeReport] = []
+        self._merge = merge
+        self._flush_lock = asyncio.Lock()
+        self._flush_needed = asyncio.Event()
+
+    def record(self, send_id: int, kind: str, at: float | None = None) -> None:
+        self.buffer.add(send_id, kind, at if at is not None else time.time())
+        if len(self.buffer) >= TRACKING_FLUSH_EVENTS:
+            self._flush_needed.set()
+
+    async def flush(self) -> MergeReport | None:
+        async with self._flush_lock:
+            rows = self.buffer.drain()
+            if not rows:
+                return None
+            started = time.perf_counter()
+            try:
+                matched, changed, missing = await asyncio.to_thread(self._merge, rows)
+            except Exception:
+                # БД недоступна или пачка не записывается: повторим при следующих
+                # сбросах, но не больше TRACKING_RETRY_FLUSHES раз
+                dropped = self.buffer.restore(rows)
+                if dropped:
+                    self._dead_letter(dropped)
+                raise
+            retried, dropped = self.buffer.requeue(rows, missing)
+            report = MergeReport(
+                sends=len(rows),
+                matched=matched,
+                changed=changed,
+                retried=retried,
+                dropped=dropped,
+                seconds=time.perf_counter() - started,
+            )
+            self.reports.append(report)
+            del self.reports[:-100]
+            return report
+
+    def _dead_letter(self, rows: list[tuple]) -> None:
+        print(f"Отброшено событий после {TRACKING_RETRY_FLUSHES} неудачных сбросов: {len(rows)}", flush=True)
+        if not TRACKING_DEAD_LETTER:
+            return
+        with open(TRACKING_DEAD_LETTER, "a", encoding="ascii") as f:
+            for send_id, opened, clicked in rows:
+                if opened is not None:
+                    f.write(f"{OPEN} {send_id} {opened!r}\n")
+                if clicked is not None:
+                    f.write(f"{CLICK} {send_id} {clicked!r}\n")
+
+    async def _flusher(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), TRACKING_FLUSH_SECONDS)
+            except TimeoutError:
+                pass
+            self._flush_needed.clear()
+            try:
+                await self.flush()
+            except Exception as exc:
+                print("Сброс событий не удался:", exc, flush=True)
+
+    # ---------- HTTP ----------
+
+    def _handle(
+        self,
+        method: str,
+        target: str,
+        body: bytes,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[str, list[tuple[str, str]], bytes]:
+        """Обработать запрос и вернуть (статус, заголовки, тело)."""
+        parts = urlsplit(target)
+        path = parts.path
+        query = parse_qs(parts.query)
+        signature = query.get("s", [""])[0]
+        try:
+            if method == "GET" and path.startswith("/o/"):
+                send_id = parse_send_id(path[3:].removesuffix(".gif"))
+                if not verify(signature, OPEN, send_id):
+                    return FORBIDDEN
+                self.record(send_id, OPEN)
+                return "200 OK", [
+                    ("Content-Type", "image/gif"),
+                    ("Cache-Control", "no-store"),
+                ], PIXEL
+
+            if method == "GET" and path.startswith("/c/"):
+                send_id = parse_send_id(path[3:])
+                url = query.get("u", [""])[0]
+                if not verify(signature, CLICK, send_id, url):
+                    return FORBIDDEN
+                if urlsplit(url).scheme not in ("http", "https"):
+                    return "400 Bad Request", [], b"bad url"
+                self.record(send_id, CLICK)
+                return "302 Found", [("Location", url)], b""
+
+            if method == "POST" and path == "/events":
+                if not events_authorized((headers or {}).get("authorization", "")):
+                    return FORBIDDEN
+                # пачка принимается целиком или отклоняется целиком
+                events = []
+                for line in body.decode("ascii").splitlines():
+                    fields = line.split()
+                    if not fields:
+                        continue
+                    kind, send_id = fields[0], parse_send_id(fields[1])
+                    if kind not in (OPEN, CLICK):
+                        return "400 Bad Request", [], f"bad event kind: {kind}".encode()
+                    events.append((send_id, kind, parse_epoch(fields[2]) if len(fields) > 2 else None))
+                for send_id, kind, at in events:
+                    self.record(send_id, kind, at)
+                return "200 OK", [("Content-Type", "text/plain")], str(len(events)).encode()
+        except (ValueError, IndexError, UnicodeDecodeError):
+            return "400 Bad Request", [], b"bad request"
+
+        return "404 Not Found", [], b"not found"
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                request_line, *header_lines = head[:-4].decode("latin-1").split("\r\n")
+                method, target, version = request_line.split(" ", 2)
+                headers = {}
+                for line in header_lines:
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                body = b""
+                length = int(headers.get("content-length", "0") or 0)
+                if length:
+                    body = await reader.readexactly(length)
+
+                status, extra, payload = self._handle(method, target, body, headers)
+                keep_alive = (
+                    headers.get("connection", "").lower() != "close"
+                    and version == "HTTP/1.1"
+                )
+                lines = [f"HTTP/1.1 {status}", f"Content-Length: {len(payload)}"]
+                lines += [f"{name}: {value}" for name, value in extra]
+                if not keep_alive:
+                    lines.append("Connection: close")
+                writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, ValueError):
+            return
+        except asyncio.CancelledError:
+            # остановка сервера: незакрытые keep-alive соединения просто закрываем
+            return
+        finally:
+            writer.close()
+
+    async def serve(self, started: threading.Event | None = None) -> None:
+        _secret()  # без ключа подписи не запускаемся
+        server = await asyncio.start_server(self._serve_connection, self.host, self.port)
+        flusher = asyncio.create_task(self._flusher())
+        if started is not None:
+            started.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            flusher.cancel()
+            # остаток буфера записываем при остановке
+            await self.flush()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Сбор открытий и кликов")
+    parser.add_argument("command", choices=["serve"])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    if not TRACKING_SECRET:
+        raise SystemExit("Задайте TRACKING_SECRET: ключ подписи ссылок и токен POST /events")
+
+    collector = TrackingCollector(args.host, args.port)
+    print(f"Коллектор слушает {args.host}:{args.port}, сброс раз в {TRACKING_FLUSH_SECONDS} с")
+    try:
+        asyncio.run(collector.serve())
+    except KeyboardInterrupt:
+        pass
+    print(f"Принято событий: {collector.buffer.received}")
+
+
+if __name__ == "__main__":
+    main()